@@ -0,0 +1,71 @@
+import collections
+import threading
+import time
+
+MAX_SOURCES = 4096  # addresses with rate state before refilled ones are forgotten
+
+
+class AdmissionControl:
+    """Per-address limits for connections a listener accepts.
+    
+    Every address has a token bucket of new connections (rate per second,
+    burst at once) and a cap on connections it has open at once. Callers
+    admit() a connection right after accept() and release() it when it
+    closes or no longer counts (a chat connection that finished its
+    handshake). A limit of 0 turns that limit off.
+    """
+    
+    def __init__(self, rate=20, burst=40, max_open=8):
+        self.rate = rate
+        self.burst = burst
+        self.max_open = max_open
+        self.buckets = {}  # ip: (tokens, monotonic time of the last update)
+        self.open = collections.Counter()
+        self.refused = 0
+        self.lock = threading.Lock()
+    
+    def admit(self, ip):
+        """Count a new connection from ip, False if it is over a limit"""
+        now = time.monotonic()
+        with self.lock:
+            if self.max_open and self.open[ip] >= self.max_open:
+                self.refused += 1
+                return False
+            if self.rate:
+                tokens, updated = self.buckets.get(ip, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens < 1:
+                    self.buckets[ip] = (tokens, now)
+                    self.refused += 1
+                    return False
+                self.buckets[ip] = (tokens - 1, now)
+                if len(self.buckets) > MAX_SOURCES:
+                    self.prune(now)
+            self.open[ip] += 1
+            return True
+    
+    def release(self, ip):
+        with self.lock:
+            self.open[ip] -= 1
+            if self.open[ip] <= 0:
+                del self.open[ip]
+    
+    def prune(self, now):
+        """Forget addresses whose bucket is full again, they are like new ones"""
+        for ip in [ip for ip, (tokens, updated) in self.buckets.items()
+                   if tokens + (now - updated) * self.rate >= self.burst]:
+            del self.buckets[ip]
+
+
+class PendingConnection:
+    """An accepted chat connection that hasn't sent its connect yet"""
+    
+    __slots__ = ('sock', 'ip', 'deadline', 'received', 'conn', 'secured')
+    
+    def __init__(self, sock, ip, deadline):
+        self.sock = sock        # the accepted socket
+        self.ip = ip
+        self.deadline = deadline
+        self.received = b''     # bytes before we know whether it is TLS
+        self.conn = None        # sock or a TlsSocket around it, once the first bytes tell
+        self.secured = False    # TLS handshake finished
@@ -0,0 +1,531 @@
+import asyncio
+import base64
+import itertools
+import json
+import os
+import struct
+import time
+import uuid
+from datetime import datetime
+
+import handshake
+from delivery import SendWindow, ReceiveWindow
+from transport import FrameDecoder, encode_message, KIND_MESSAGE, MAX_FRAME_SIZE
+
+# A messenger peer on asyncio, for services that want to chat and move
+# files programmatically.
+#
+# It uses the app's wire code: framing from transport.py and the numbered,
+# cumulatively acked delivery from delivery.py, so it talks to LocalMessenger
+# like any other user. Messages written in the same loop iteration go out in
+# one write; send() waits while the peer's window is full and while the
+# socket buffer is over WRITE_LIMIT, and a full inbox stops reading, so a
+# slow side slows the other down instead of piling up memory.
+#
+# The handshake offers framing and numbered delivery only, no multiplexing,
+# compression, deltas or striping, so peers use the plain paths: files go
+# over the file port with the metadata / READY / COMPLETE exchange.
+
+CHUNK_SIZE = 256 * 1024
+WRITE_LIMIT = 1024 * 1024       # buffered bytes per connection before send() waits
+INBOX_SIZE = 10000              # received messages not yet iterated before reading stops
+ACK_DELAY = 0.2                 # seconds before acking, so a burst shares one ack
+ACK_EVERY = 32                  # ...unless this many are waiting
+INLINE_FILE_LIMIT = 64 * 1024   # files up to this size travel with the offer
+CAPABILITIES = {handshake.FRAMES, handshake.RESUME}
+OFFER_REPLY_TIMEOUT = 30        # seconds before an unanswered offer is rejected
+OFFER_TIMEOUT = 60              # seconds send_file waits for an answer
+
+
+class PeerLink:
+    """One chat connection to a user"""
+    
+    def __init__(self, peer, user_id, reader, writer, protocol, caps):
+        self.peer = peer
+        self.user_id = user_id
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+        self.caps = caps  # negotiated in the handshake
+        self.framed = handshake.FRAMES in caps  # peer reads frames, bare JSON otherwise
+        self.pending = bytearray()
+        self.flush_scheduled = False
+        self.ack_handle = None
+        self.closed = False
+    
+    def write(self, message):
+        """Queue a message, everything queued in one loop iteration is sent together"""
+        if self.closed:
+            raise ConnectionError(f"Connection to {self.user_id} closed")
+        if self.framed:
+            self.pending += encode_message(message)
+        else:
+            self.pending += json.dumps(message).encode('utf-8')
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+    
+    def flush(self):
+        self.flush_scheduled = False
+        if self.pending and not self.closed:
+            self.writer.write(bytes(self.pending))
+        self.pending.clear()
+    
+    async def backpressure(self):
+        if self.writer.transport.get_write_buffer_size() + len(self.pending) > WRITE_LIMIT:
+            self.flush()
+            await self.writer.drain()
+    
+    def close(self):
+        self.closed = True
+        if self.ack_handle:
+            self.ack_handle.cancel()
+        self.writer.close()
+
+
+class FileOffer:
+    """A file someone wants to send us, answer with accept(), save() or reject()"""
+    
+    def __init__(self, peer, message):
+        self.peer = peer
+        self.message = message
+        self.from_id = message.get('from_id')
+        self.from_name = message.get('from_name')
+        self.transfer_id = message.get('transfer_id')
+        self.filename = os.path.basename(str(message.get('filename')))
+        self.size = message.get('filesize')
+        self.answered = False
+    
+    @property
+    def key(self):
+        return (self.from_id, self.transfer_id)
+    
+    def answer(self, reply):
+        if self.answered:
+            raise ValueError("Offer was answered already")
+        self.answered = True
+        self.peer.send_control(self.from_id, dict(reply, from_id=self.peer.user_id,
+                                                  transfer_id=self.transfer_id))
+    
+    async def reject(self):
+        self.answer({'type': 'file_reject'})
+    
+    async def accept(self):
+        """Accept and iterate over the file's data as it arrives"""
+        if 'data' in self.message:
+            self.answer({'type': 'file_accept', 'received': True})
+            yield base64.b64decode(self.message['data'])
+            return
+        
+        arrival = asyncio.get_running_loop().create_future()
+        self.peer.incoming[self.key] = arrival
+        try:
+            self.answer({'type': 'file_accept'})
+            reader, writer, done = await asyncio.wait_for(arrival, OFFER_TIMEOUT)
+        finally:
+            self.peer.incoming.pop(self.key, None)
+        try:
+            writer.write(b'READY')
+            remaining = self.size
+            while remaining > 0:
+                chunk = await reader.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("Sender closed the connection early")
+                remaining -= len(chunk)
+                yield chunk
+            writer.write(b'COMPLETE')
+            await writer.drain()
+        finally:
+            writer.close()
+            done.set_result(None)
+    
+    async def save(self, target):
+        """Accept into a path or a binary file object, returns the byte count"""
+        written = 0
+        f = open(target, 'wb') if isinstance(target, (str, os.PathLike)) else target
+        try:
+            async for chunk in self.accept():
+                f.write(chunk)
+                written += len(chunk)
+        finally:
+            if f is not target:
+                f.close()
+        return written
+
+
+class AsyncPeer:
+    """A messenger user run from asyncio code.
+    
+    await start() to listen, connect(ip) to dial, send() to chat,
+    `async for message in peer.messages()` to receive, send_file() and
+    `async for offer in peer.offers()` for files. Other users dial us on
+    the usual ports, so give each peer its own IP.
+    """
+    
+    def __init__(self, user_id, name, ip, port=12345, file_port=12346, max_in_flight=256):
+        self.user_id = user_id
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.file_port = file_port
+        self.max_in_flight = max_in_flight
+        self.epoch = uuid.uuid4().hex[:8]
+        self.links = {}           # user_id: PeerLink
+        self.directory = {}       # user_id: {'name', 'ip', 'file_port'} from their connect
+        self.send_windows = {}    # user_id: SendWindow
+        self.receive_windows = {} # user_id: ReceiveWindow
+        self.offer_replies = {}   # our transfer_id: future of the file_accept/file_reject
+        self.incoming = {}        # (from_id, transfer_id): future of the accepted data connection
+        self.transfer_ids = itertools.count(int(time.time() * 1000))
+        self.servers = []
+        self.inbox = None
+        self.offer_queue = None
+        self.window_space = None
+    
+    async def start(self):
+        self.inbox = asyncio.Queue(INBOX_SIZE)
+        self.offer_queue = asyncio.Queue()
+        self.window_space = asyncio.Condition()
+        self.servers = [await asyncio.start_server(self.on_chat_connection, self.ip, self.port),
+                        await asyncio.start_server(self.on_file_connection, self.ip, self.file_port)]
+    
+    async def close(self):
+        for server in self.servers:
+            server.close()
+        for link in list(self.links.values()):
+            link.close()
+        for server in self.servers:
+            await server.wait_closed()
+    
+    async def __aenter__(self):
+        await self.start()
+        return self
+    
+    async def __aexit__(self, *exc):
+        await self.close()
+    
+    def connect_message(self, msg_type):
+        message = {
+            'type': msg_type,
+            'user_id': self.user_id,
+            'name': self.name,
+            'ip': self.ip,
+            'file_port': self.file_port,
+            'addresses': []
+        }
+        message.update(handshake.hello(CAPABILITIES))
+        return message
+    
+    # Connections
+    
+    async def connect(self, ip, port=None, timeout=10):
+        """Dial a user, returns their user_id once they answered"""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port or self.port), timeout)
+        try:
+            writer.write(json.dumps(self.connect_message('connect')).encode('utf-8'))
+            decoder = FrameDecoder()
+            messages = self.read_messages(reader, decoder)
+            while True:
+                message = await asyncio.wait_for(messages.__anext__(), timeout)
+                if message.get('type') == 'connect_ack':
+                    break
+        except BaseException:
+            writer.close()
+            raise
+        link = self.add_link(message, reader, writer)
+        asyncio.ensure_future(self.read_loop(link, messages))
+        return link.user_id
+    
+    async def on_chat_connection(self, reader, writer):
+        messages = self.read_messages(reader, FrameDecoder())
+        try:
+            message = await asyncio.wait_for(messages.__anext__(), 5)
+        except (asyncio.TimeoutError, StopAsyncIteration, ConnectionError, ValueError):
+            writer.close()
+            return
+        if message.get('type') != 'connect' or not message.get('user_id'):
+            writer.close()
+            return
+        writer.write(json.dumps(self.connect_message('connect_ack')).encode('utf-8'))
+        link = self.add_link(message, reader, writer)
+        await self.read_loop(link, messages)
+    
+    def add_link(self, message, reader, writer):
+        user_id = message['user_id']
+        old = self.links.get(user_id)
+        if old is not None:
+            old.close()
+        self.directory[user_id] = {'name': message.get('name'), 'ip': message.get('ip'),
+                                   'file_port': message.get('file_port', self.file_port)}
+        protocol, caps = handshake.negotiate(CAPABILITIES, message)
+        link = self.links[user_id] = PeerLink(self, user_id, reader, writer, protocol, caps)
+        # Whatever the last connection lost goes out again
+        window = self.send_windows.get(user_id)
+        if window:
+            for pending in window.pending():
+                link.write(pending)
+        return link
+    
+    async def read_messages(self, reader, decoder):
+        """Decoded JSON messages from a chat connection"""
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            for item in decoder.feed(data):
+                if item[0] == 'json':
+                    yield item[1]
+                elif item[1] == KIND_MESSAGE:
+                    try:
+                        yield json.loads(item[4].decode('utf-8'))
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        pass
+    
+    async def read_loop(self, link, messages):
+        try:
+            async for message in messages:
+                if isinstance(message, dict):
+                    await self.on_message(link, message)
+        except (ConnectionError, ValueError) as e:
+            print(f"Connection to {link.user_id} lost: {e}")
+        finally:
+            link.close()
+            if self.links.get(link.user_id) is link:
+                del self.links[link.user_id]
+    
+    def send_control(self, user_id, message):
+        link = self.links.get(user_id)
+        if link is None:
+            raise ConnectionError(f"{user_id} is not connected")
+        link.write(message)
+    
+    # Chat
+    
+    def send_window(self, user_id):
+        window = self.send_windows.get(user_id)
+        if window is None:
+            window = self.send_windows[user_id] = SendWindow(self.epoch, self.max_in_flight)
+        return window
+    
+    async def send(self, user_id, text):
+        """Send a chat message, returns its msg_id.
+        
+        Waits while max_in_flight messages to the user are unacknowledged.
+        Unacked messages are sent again when the user reconnects.
+        """
+        window = self.send_window(user_id)
+        if window.full():
+            async with self.window_space:
+                await self.window_space.wait_for(lambda: not window.full())
+        link = self.links.get(user_id)
+        if link is None:
+            raise ConnectionError(f"{user_id} is not connected")
+        message = {
+            'type': 'message',
+            'msg_id': uuid.uuid4().hex,
+            'from_id': self.user_id,
+            'from_name': self.name,
+            'message': text,
+            'timestamp': datetime.now().isoformat()
+        }
+        if handshake.RESUME in link.caps:
+            window.add(message)
+        link.write(message)
+        await link.backpressure()
+        return message['msg_id']
+    
+    async def messages(self):
+        """Received chat messages, as dicts like the IPC 'message' event"""
+        while True:
+            yield await self.inbox.get()
+    
+    async def on_message(self, link, message):
+        msg_type = message.get('type')
+        from_id = link.user_id
+        
+        if msg_type == 'message':
+            seq = message.get('seq')
+            if seq is not None:
+                window = self.receive_windows.get(from_id)
+                if window is None:
+                    window = self.receive_windows[from_id] = ReceiveWindow()
+                new = window.receive(message.get('epoch'), seq)
+                self.schedule_ack(link, window)
+                if not new:
+                    return
+            elif message.get('queued') and message.get('msg_id'):
+                link.write({'type': 'message_ack', 'from_id': self.user_id, 'msg_ids': [message['msg_id']]})
+            await self.inbox.put({'from_id': from_id, 'from_name': message.get('from_name'),
+                                  'text': message.get('message'), 'msg_id': message.get('msg_id'),
+                                  'timestamp': message.get('timestamp')})
+        
+        elif msg_type == 'message_ack':
+            window = self.send_windows.get(from_id)
+            if window and 'ack' in message and message.get('epoch') == self.epoch:
+                if window.ack(message['ack'], message.get('sack', [])):
+                    async with self.window_space:
+                        self.window_space.notify_all()
+        
+        elif msg_type == 'file_request':
+            offer = FileOffer(self, message)
+            offer.from_id = from_id
+            asyncio.get_running_loop().call_later(OFFER_REPLY_TIMEOUT, self.expire_offer, offer)
+            await self.offer_queue.put(offer)
+        
+        elif msg_type in ('file_accept', 'file_reject'):
+            reply = self.offer_replies.get(message.get('transfer_id'))
+            if reply and not reply.done() and message.get('from_id', from_id) == from_id:
+                reply.set_result(message)
+    
+    def schedule_ack(self, link, window):
+        """Cumulative ack after ACK_DELAY, or at once when ACK_EVERY are waiting"""
+        if window.unacked >= ACK_EVERY:
+            self.send_ack(link, window)
+        elif link.ack_handle is None:
+            link.ack_handle = asyncio.get_running_loop().call_later(ACK_DELAY, self.send_ack, link, window)
+    
+    def send_ack(self, link, window):
+        if link.ack_handle:
+            link.ack_handle.cancel()
+            link.ack_handle = None
+        if not link.closed and window.unacked:
+            link.write(dict(window.ack_fields(), type='message_ack', from_id=self.user_id, msg_ids=[]))
+    
+    # Files
+    
+    async def offers(self):
+        """Incoming file offers (FileOffer)"""
+        while True:
+            yield await self.offer_queue.get()
+    
+    def expire_offer(self, offer):
+        if not offer.answered and offer.key not in self.incoming:
+            try:
+                offer.answer({'type': 'file_reject'})
+            except (ConnectionError, ValueError):
+                pass
+    
+    async def send_file(self, user_id, source, filename, size=None):
+        """Offer a file and stream it once accepted, returns when the receiver has it.
+        
+        source is bytes, a binary file object, or a (async) iterable of
+        bytes chunks; iterables and pipes need the size up front.
+        """
+        if isinstance(source, (bytes, bytearray)):
+            size = len(source)
+        elif size is None and hasattr(source, 'seekable') and source.seekable():
+            start = source.tell()
+            size = source.seek(0, os.SEEK_END) - start
+            source.seek(start)
+        if size is None:
+            raise ValueError("size is needed to stream from an iterable or unseekable file")
+        if user_id not in self.links:
+            raise ConnectionError(f"{user_id} is not connected")
+        
+        transfer_id = next(self.transfer_ids)
+        request = {
+            'type': 'file_request',
+            'from_id': self.user_id,
+            'from_name': self.name,
+            'filename': filename,
+            'filesize': size,
+            'directory': False,
+            'transfer_id': transfer_id
+        }
+        # Small files ride along with the offer, saving a round trip
+        if isinstance(source, (bytes, bytearray)) and size <= INLINE_FILE_LIMIT:
+            request['data'] = base64.b64encode(source).decode('ascii')
+        reply = self.offer_replies[transfer_id] = asyncio.get_running_loop().create_future()
+        try:
+            self.send_control(user_id, request)
+            answer = await asyncio.wait_for(reply, OFFER_TIMEOUT)
+        finally:
+            del self.offer_replies[transfer_id]
+        if answer.get('type') == 'file_reject':
+            raise ConnectionRefusedError(f"{filename} was declined")
+        if answer.get('received'):
+            return transfer_id
+        
+        peer = self.directory[user_id]
+        reader, writer = await asyncio.open_connection(peer['ip'], peer['file_port'])
+        try:
+            metadata = json.dumps({
+                'type': 'file_metadata',
+                'filename': filename,
+                'filesize': size,
+                'directory': False,
+                'delta': False,
+                'compress': False,
+                'striped': False,
+                'transfer_id': transfer_id,
+                'sender_id': self.user_id,
+                'sender_name': self.name
+            }).encode('utf-8')
+            writer.write(struct.pack('!I', len(metadata)) + metadata)
+            ack = await reader.readexactly(5)
+            if ack == b'NOSPC':
+                raise OSError("Receiver is out of disk space")
+            if ack != b'READY':
+                raise ConnectionError(f"Receiver not ready: {ack!r}")
+            
+            sent = 0
+            async for chunk in self.chunks(source):
+                if sent + len(chunk) > size:
+                    raise ValueError("Source is larger than the announced size")
+                writer.write(chunk)
+                sent += len(chunk)
+                await writer.drain()
+            if sent != size:
+                raise ValueError(f"Source ended after {sent} of {size} bytes")
+            if await reader.read(1024) != b'COMPLETE':
+                raise ConnectionError("Transfer failed")
+        finally:
+            writer.close()
+        return transfer_id
+    
+    async def chunks(self, source):
+        """Byte chunks from bytes, a file object or a (async) iterable"""
+        if isinstance(source, (bytes, bytearray)):
+            view = memoryview(source)
+            for start in range(0, len(view), CHUNK_SIZE):
+                yield bytes(view[start:start + CHUNK_SIZE])
+        elif hasattr(source, 'read'):
+            loop = asyncio.get_running_loop()
+            while True:
+                chunk = await loop.run_in_executor(None, source.read, CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        elif hasattr(source, '__aiter__'):
+            async for chunk in source:
+                yield chunk
+        else:
+            for chunk in source:
+                yield chunk
+    
+    async def on_file_connection(self, reader, writer):
+        """A sender connected to our file port for an offer we accepted"""
+        try:
+            length = struct.unpack('!I', await asyncio.wait_for(reader.readexactly(4), 30))[0]
+            if length > MAX_FRAME_SIZE:
+                raise ValueError("Metadata too large")
+            metadata = json.loads((await reader.readexactly(length)).decode('utf-8'))
+            arrival = self.incoming.pop((metadata.get('sender_id'), metadata.get('transfer_id')), None)
+            if arrival is None or arrival.done() or metadata.get('type') != 'file_metadata':
+                writer.write(b'NOACC')
+                await writer.drain()
+                writer.close()
+                return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            print(f"File connection dropped: {e}")
+            writer.close()
+            return
+        # FileOffer.accept() reads the data, the connection lives until it is done
+        done = asyncio.get_running_loop().create_future()
+        arrival.set_result((reader, writer, done))
+        await done
+    
+    def peers(self):
+        """Connected users, what they told us about themselves and the features in use"""
+        return {user_id: dict(self.directory[user_id], protocol=link.protocol, caps=sorted(link.caps))
+                for user_id, link in list(self.links.items())}
@@ -9,6 +9,8 @@ import time
 import json
 import socket
 import select
+from transport import FrameDecoder
+from admission import AdmissionControl
 
 class SimpleChatApp:
     def __init__(self):
@@ -31,10 +33,34 @@ class SimpleChatApp:
         self.connected_ips = []
         self.connected_names = {}
         self.message_queue = []
+        self.known_ips = []        # every peer we have talked to, saved in config
+        self.ip_sockets = {}       # ip: socket
+        self.client_ips = {}       # socket: ip
+        self.decoders = {}         # socket: FrameDecoder, messages can arrive back to back
+        
+        # Reconnect settings
+        self.reconnect_state = {}  # ip: {"attempts": n, "next_try": timestamp}
+        self.reconnect_lock = threading.Lock()
+        self.reconnect_wakeup = threading.Event()
+        self.dialing = set()
+        self.dial_times = {}       # ip: time of our last successful dial
+        self.max_parallel_dials = 8
+        self.reconnect_base_delay = 1.0
+        self.reconnect_max_delay = 60.0
+        
+        # Listener limits: accepted sockets must send their connect within
+        # handshake_timeout, and one address may only open so many so fast
+        self.listen_backlog = 128
+        self.handshake_timeout = 10.0
+        self.accept_rate = 20
+        self.accept_burst = 40
+        self.max_handshakes_per_ip = 8
+        self.handshakes = {}  # accepted socket: (ip, deadline) until its connect arrives
         
         # Configuration
         self.config_file = "chat_config.json"
         self.load_config()
+        self.admission = AdmissionControl(self.accept_rate, self.accept_burst, self.max_handshakes_per_ip)
         
         # Create chat interface
         self.create_chat_interface()
@@ -46,6 +72,9 @@ class SimpleChatApp:
         self.chat_thread_running = True
         threading.Thread(target=self.check_for_messages, daemon=True).start()
         
+        # Reconnect to saved peers
+        self.start_reconnect_manager()
+        
     def get_local_ip(self):
         """Get local IP address of the machine"""
         try:
@@ -66,7 +95,12 @@ class SimpleChatApp:
                     config = json.load(f)
                     self.my_name = config.get('username', self.my_name)
                     self.my_port = config.get('port', self.my_port)
-                    self.connected_ips = config.get('connected_ips', [])
+                    self.known_ips = config.get('connected_ips', [])
+                    self.max_parallel_dials = config.get('max_parallel_dials', self.max_parallel_dials)
+                    self.listen_backlog = config.get('listen_backlog', self.listen_backlog)
+                    self.accept_rate = config.get('accept_rate', self.accept_rate)
+                    self.accept_burst = config.get('accept_burst', self.accept_burst)
+                    self.max_handshakes_per_ip = config.get('max_handshakes_per_ip', self.max_handshakes_per_ip)
         except Exception as e:
             print(f"Error loading config: {e}")
     
@@ -76,7 +110,12 @@ class SimpleChatApp:
             config = {
                 'username': self.my_name,
                 'port': self.my_port,
-                'connected_ips': self.connected_ips
+                'connected_ips': self.known_ips,
+                'max_parallel_dials': self.max_parallel_dials,
+                'listen_backlog': self.listen_backlog,
+                'accept_rate': self.accept_rate,
+                'accept_burst': self.accept_burst,
+                'max_handshakes_per_ip': self.max_handshakes_per_ip
             }
             with open(self.config_file, 'w') as f:
                 json.dump(config, f, indent=2)
@@ -277,7 +316,7 @@ class SimpleChatApp:
             self.chat_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.chat_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.chat_server.bind(('0.0.0.0', self.my_port))
-            self.chat_server.listen(5)
+            self.chat_server.listen(self.listen_backlog)
             self.chat_server.setblocking(False)
             self.add_chat_message(f"Chat server started on port {self.my_port}", "system")
         except Exception as e:
@@ -304,11 +343,32 @@ class SimpleChatApp:
     def connect_to_ip_thread(self, ip):
         """Thread for connecting to IP"""
         try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(5)
+            self.dial_ip(ip, timeout=5)
+            self.mark_alive(ip)
+            
+            self.root.after(0, self.status_label.config, 
+                          {"text": f"✓ Connected to {ip}", "fg": '#00FF00'})
+            self.root.after(0, self.update_users_list)
+            self.root.after(0, self.add_chat_message, 
+                          f"Connected to {ip}", "system")
+            
+        except Exception as e:
+            self.root.after(0, self.status_label.config,
+                          {"text": f"✗ Failed to connect: {str(e)}", "fg": '#FF0000'})
+    
+    def dial_ip(self, ip, timeout=3):
+        """Open a connection to an IP and send our username"""
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.settimeout(timeout)
+        try:
             client_socket.connect((ip, self.my_port))  # Try their port
             client_socket.setblocking(False)
             
+            # They dialed us while we were connecting
+            if ip in self.ip_sockets:
+                client_socket.close()
+                return self.ip_sockets[ip]
+            
             # Send our username
             connect_msg = json.dumps({
                 'type': 'connect',
@@ -316,21 +376,102 @@ class SimpleChatApp:
                 'ip': self.my_ip
             })
             client_socket.send(connect_msg.encode('utf-8'))
-            
-            # Add to connected clients
-            self.chat_clients.append(client_socket)
+        except:
+            client_socket.close()
+            raise
+        
+        # Add to connected clients
+        self.chat_clients.append(client_socket)
+        self.register_peer(ip, client_socket)
+        self.connected_names.setdefault(ip, f"User_{ip}")
+        self.dial_times[ip] = time.time()
+        return client_socket
+    
+    def register_peer(self, ip, sock):
+        """Remember which socket belongs to which IP"""
+        self.ip_sockets[ip] = sock
+        self.client_ips[sock] = ip
+        self.end_handshake(sock)
+        if ip not in self.connected_ips:
             self.connected_ips.append(ip)
-            self.connected_names[ip] = f"User_{ip}"
+        if ip not in self.known_ips:
+            self.known_ips.append(ip)
+            self.save_config()
+    
+    def start_reconnect_manager(self):
+        """Dial saved peers concurrently and keep dropped ones retrying"""
+        now = time.time()
+        with self.reconnect_lock:
+            for ip in self.known_ips:
+                if ip != self.my_ip:
+                    self.reconnect_state[ip] = {"attempts": 0, "next_try": now}
+        threading.Thread(target=self.reconnect_loop, daemon=True).start()
+    
+    def reconnect_delay(self, attempts):
+        """Exponential backoff with jitter so peers don't redial in lockstep"""
+        ceiling = min(self.reconnect_max_delay, self.reconnect_base_delay * (2 ** attempts))
+        return random.uniform(ceiling / 2, ceiling)
+    
+    def schedule_reconnect(self, ip):
+        """Queue a dropped peer for reconnection"""
+        if not self.chat_thread_running:
+            return
+        with self.reconnect_lock:
+            state = self.reconnect_state.setdefault(ip, {"attempts": 0, "next_try": 0})
+            state["next_try"] = time.time() + self.reconnect_delay(state["attempts"])
+        self.reconnect_wakeup.set()
+    
+    def mark_alive(self, ip):
+        """Liveness signal from a peer - stop retrying it"""
+        with self.reconnect_lock:
+            self.reconnect_state.pop(ip, None)
+    
+    def reconnect_loop(self):
+        """Dispatch due reconnect attempts, at most max_parallel_dials at once"""
+        while self.chat_thread_running:
+            now = time.time()
+            wait = self.reconnect_max_delay
+            due = []
             
-            self.root.after(0, self.status_label.config, 
-                          {"text": f"✓ Connected to {ip}", "fg": '#00FF00'})
-            self.root.after(0, self.update_users_list)
-            self.root.after(0, self.add_chat_message, 
-                          f"Connected to {ip}", "system")
+            with self.reconnect_lock:
+                for ip, state in list(self.reconnect_state.items()):
+                    if ip in self.ip_sockets:
+                        del self.reconnect_state[ip]
+                    elif ip in self.dialing:
+                        continue
+                    elif state["next_try"] <= now:
+                        if len(self.dialing) < self.max_parallel_dials:
+                            self.dialing.add(ip)
+                            due.append(ip)
+                        else:
+                            wait = min(wait, 0.1)
+                    else:
+                        wait = min(wait, state["next_try"] - now)
             
-        except Exception as e:
-            self.root.after(0, self.status_label.config,
-                          {"text": f"✗ Failed to connect: {str(e)}", "fg": '#FF0000'})
+            for ip in due:
+                threading.Thread(target=self.reconnect_thread, args=(ip,), daemon=True).start()
+            
+            self.reconnect_wakeup.wait(max(wait, 0.05))
+            self.reconnect_wakeup.clear()
+    
+    def reconnect_thread(self, ip):
+        """Single reconnect attempt for a saved peer"""
+        try:
+            if ip not in self.ip_sockets:
+                self.dial_ip(ip)
+                self.root.after(0, self.add_chat_message, f"Reconnected to {ip}", "system")
+            self.mark_alive(ip)
+            self.root.after(0, self.update_users_list)
+        except Exception:
+            with self.reconnect_lock:
+                state = self.reconnect_state.get(ip)
+                if state is not None and ip not in self.ip_sockets:
+                    state["attempts"] += 1
+                    state["next_try"] = time.time() + self.reconnect_delay(state["attempts"])
+        finally:
+            with self.reconnect_lock:
+                self.dialing.discard(ip)
+            self.reconnect_wakeup.set()
     
     def disconnect_all(self):
         """Disconnect from all users"""
@@ -343,6 +484,12 @@ class SimpleChatApp:
         self.chat_clients.clear()
         self.connected_ips.clear()
         self.connected_names.clear()
+        self.ip_sockets.clear()
+        self.client_ips.clear()
+        
+        # Stop retrying until the user connects again
+        with self.reconnect_lock:
+            self.reconnect_state.clear()
         
         self.update_users_list()
         self.add_chat_message("Disconnected from all users", "system")
@@ -447,12 +594,18 @@ class SimpleChatApp:
         """Remove a disconnected client"""
         try:
             client.close()
-            self.chat_clients.remove(client)
+            self.decoders.pop(client, None)
+            self.end_handshake(client)
+            if client in self.chat_clients:
+                self.chat_clients.remove(client)
             
-            # Find IP to remove from connected lists
-            for ip, sock in list(self.connected_names.items()):
-                # We don't have direct mapping, so we'll update list when we detect disconnection
-                pass
+            # Drop the IP from connected lists and try to get it back
+            ip = self.client_ips.pop(client, None)
+            if ip and self.ip_sockets.get(ip) is client:
+                del self.ip_sockets[ip]
+                if ip in self.connected_ips:
+                    self.connected_ips.remove(ip)
+                self.schedule_reconnect(ip)
             
             self.root.after(0, self.update_users_list)
         except:
@@ -467,18 +620,16 @@ class SimpleChatApp:
                 
                 for sock in readable:
                     if sock == self.chat_server:
-                        # New connection
-                        client_socket, client_address = self.chat_server.accept()
-                        client_socket.setblocking(False)
-                        self.chat_clients.append(client_socket)
-                        self.root.after(0, self.add_chat_message, 
-                                      f"New connection from {client_address[0]}", "system")
+                        self.accept_connections()
                     else:
                         # Message from existing client
                         try:
-                            data = sock.recv(1024).decode('utf-8')
+                            data = sock.recv(65536)
                             if data:
-                                self.process_incoming_message(data, sock)
+                                decoder = self.decoders.setdefault(sock, FrameDecoder())
+                                for item in decoder.feed(data):
+                                    if item[0] == 'json':
+                                        self.process_incoming_message(item[1], sock)
                             else:
                                 # Client disconnected
                                 self.remove_client(sock)
@@ -486,13 +637,41 @@ class SimpleChatApp:
                             # Client disconnected
                             self.remove_client(sock)
                 
+                # Connections that never said who they are
+                now = time.monotonic()
+                for sock in [s for s, (ip, deadline) in self.handshakes.items() if deadline <= now]:
+                    self.remove_client(sock)
+            
             except Exception as e:
                 time.sleep(0.1)
     
-    def process_incoming_message(self, data, sock):
+    def accept_connections(self):
+        """Take every waiting connection, not one per wakeup"""
+        while True:
+            try:
+                client_socket, client_address = self.chat_server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Accept failed: {e}")
+                return
+            if not self.admission.admit(client_address[0]):
+                client_socket.close()
+                continue
+            client_socket.setblocking(False)
+            self.chat_clients.append(client_socket)
+            self.handshakes[client_socket] = (client_address[0], time.monotonic() + self.handshake_timeout)
+            self.root.after(0, self.add_chat_message,
+                          f"New connection from {client_address[0]}", "system")
+    
+    def end_handshake(self, sock):
+        entry = self.handshakes.pop(sock, None)
+        if entry:
+            self.admission.release(entry[0])
+    
+    def process_incoming_message(self, message_data, sock):
         """Process incoming message"""
         try:
-            message_data = json.loads(data)
             msg_type = message_data.get('type')
             
             if msg_type == 'connect':
@@ -500,10 +679,25 @@ class SimpleChatApp:
                 name = message_data.get('name', 'Unknown')
                 ip = message_data.get('ip', '0.0.0.0')
                 
-                if ip not in self.connected_ips and ip != self.my_ip:
-                    self.connected_ips.append(ip)
-                    self.connected_names[ip] = name
+                if ip == self.my_ip:
+                    return
                     
+                # Both sides dialed at once: keep the connection opened by
+                # the lower IP, drop the other one
+                existing = self.ip_sockets.get(ip)
+                if existing is not None and existing is not sock:
+                    if self.my_ip < ip and time.time() - self.dial_times.get(ip, 0) < 10:
+                        self.remove_client(sock)
+                        return
+                    self.client_ips.pop(existing, None)
+                    self.remove_client(existing)
+                
+                was_connected = ip in self.connected_ips
+                self.register_peer(ip, sock)
+                self.connected_names[ip] = name
+                self.mark_alive(ip)
+                
+                if not was_connected:
                     self.root.after(0, self.update_users_list)
                     self.root.after(0, self.add_chat_message,
                                   f"{name} ({ip}) connected", "system")
@@ -514,6 +708,8 @@ class SimpleChatApp:
                 message = message_data.get('message', '')
                 ip = message_data.get('ip', '0.0.0.0')
                 
+                self.mark_alive(ip)
+                
                 # Update name if we have it
                 if ip in self.connected_names and self.connected_names[ip] != name:
                     self.connected_names[ip] = name
@@ -527,6 +723,7 @@ class SimpleChatApp:
     def on_closing(self):
         """Clean up when closing"""
         self.chat_thread_running = False
+        self.reconnect_wakeup.set()
         
         # Close all connections
         if self.chat_server:
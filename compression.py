@@ -0,0 +1,122 @@
+import os
+import struct
+import zlib
+
+from transport import FLAG_COMPRESSED, recv_exact
+
+# Chat frames are short, so they are deflated against a preset dictionary
+# of what they usually contain. zlib favours the end of the dictionary.
+CHAT_DICTIONARY = (
+    b' the and that this with have you for not are but was what just will can'
+    b' from about there would when they your know like think please thanks'
+    b' http://https://www. .com .txt .pdf .png .jpg .zip\n\n'
+    b'{"type": "file_request", "from_id": "", "from_name": "", "filename": "",'
+    b' "filesize": , "directory": false, "transfer_id": }'
+    b'{"type": "file_accept", "from_id": "", "transfer_id": }'
+    b'{"type": "file_reject", "from_id": "", "transfer_id": }'
+    b'{"type": "message", "from_id": "", "from_name": "", "message": "",'
+    b' "timestamp": "2026-01-01T00:00:00.000000"}'
+)
+MIN_MESSAGE_SIZE = 128  # below this the deflate overhead isn't worth it
+
+# Stream blocks: flag (0 raw, 1 deflated), length
+BLOCK_HEADER = struct.Struct('!BI')
+MAX_BLOCK_OUTPUT = 16 * 1024 * 1024
+
+# Formats that are compressed already, not worth the CPU
+COMPRESSED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.aac', '.ogg', '.flac', '.m4a', '.opus',
+    '.mp4', '.mkv', '.avi', '.mov', '.webm',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.jar', '.apk', '.pdf'
+}
+
+
+def deflate_message(payload):
+    """Compress a chat frame payload, returns (payload, flags)"""
+    if len(payload) < MIN_MESSAGE_SIZE:
+        return payload, 0
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 15, 9, zlib.Z_DEFAULT_STRATEGY, CHAT_DICTIONARY)
+    data = compressor.compress(payload) + compressor.flush()
+    if len(data) >= len(payload):
+        return payload, 0
+    return data, FLAG_COMPRESSED
+
+
+def inflate_message(payload):
+    decompressor = zlib.decompressobj(zdict=CHAT_DICTIONARY)
+    data = decompressor.decompress(payload, MAX_BLOCK_OUTPUT)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Compressed message too large")
+    return data
+
+
+def worth_compressing(path):
+    """False for files whose format is compressed already"""
+    return os.path.splitext(path)[1].lower() not in COMPRESSED_EXTENSIONS
+
+
+def compress_chunks(chunks, level=1, sample_blocks=4, min_ratio=0.9, retry_after=64):
+    """Wrap (chunk, progress) pairs into deflated or raw blocks.
+    
+    One deflate stream runs across the blocks, so small blocks still share
+    context. Every sample_blocks compressed blocks the ratio is checked; data
+    that doesn't shrink below min_ratio is sent raw, and compression is
+    retried after retry_after blocks in case the content changes.
+    """
+    compressor = zlib.compressobj(level)
+    compressing = True
+    sampled_in = sampled_out = 0
+    sampled = raw = 0
+    for chunk, advance in chunks:
+        if compressing:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield BLOCK_HEADER.pack(1, len(data)) + data, advance
+            sampled_in += len(chunk)
+            sampled_out += len(data)
+            sampled += 1
+            if sampled >= sample_blocks:
+                compressing = sampled_out < sampled_in * min_ratio
+                sampled_in = sampled_out = sampled = 0
+        else:
+            yield BLOCK_HEADER.pack(0, len(chunk)) + chunk, advance
+            raw += 1
+            if raw >= retry_after:
+                compressing = True
+                raw = 0
+
+
+class InflatingReader:
+    """Socket-like reader for a stream written by compress_chunks().
+    
+    on_wire, if given, is called with the size of every block read off the
+    socket, before it is inflated (for rate limits that count wire bytes).
+    """
+    
+    def __init__(self, sock, on_wire=None):
+        self.sock = sock
+        self.on_wire = on_wire
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b''
+        self.offset = 0
+    
+    def recv(self, size):
+        while self.offset >= len(self.buffer):
+            header = self.sock.recv(BLOCK_HEADER.size)
+            if not header:
+                return b''
+            header += recv_exact(self.sock, BLOCK_HEADER.size - len(header))
+            compressed, length = BLOCK_HEADER.unpack(header)
+            data = recv_exact(self.sock, length)
+            if self.on_wire:
+                self.on_wire(BLOCK_HEADER.size + length)
+            if compressed:
+                data = self.decompressor.decompress(data, MAX_BLOCK_OUTPUT)
+                if self.decompressor.unconsumed_tail:
+                    raise ValueError("Compressed block too large")
+            self.buffer = data
+            self.offset = 0
+        chunk = self.buffer[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
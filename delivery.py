@@ -0,0 +1,99 @@
+import collections
+import threading
+
+MAX_SACK = 64  # out-of-order seqs listed per ack
+
+
+class SendWindow:
+    """Outgoing chat messages to one peer that are not acknowledged yet.
+    
+    Messages are numbered per peer. The receiver acks cumulatively (every
+    seq up to n) plus a short list of seqs it got beyond a gap, so after a
+    reconnect only what is really missing is sent again. At most `limit`
+    messages are in flight; the rest wait in the outbox. Numbering starts
+    over with a new epoch each time the app starts.
+    """
+    
+    def __init__(self, epoch, limit=256):
+        self.epoch = epoch
+        self.limit = limit
+        self.next_seq = 0
+        self.unacked = collections.OrderedDict()  # seq: message
+        self.msg_ids = set()
+        self.lock = threading.Lock()
+        self.space = threading.Condition(self.lock)  # notified when acks free slots
+    
+    def full(self):
+        return len(self.unacked) >= self.limit
+    
+    def wait_for_space(self, timeout):
+        """Block until a message may be sent or timeout, returns not full()"""
+        with self.space:
+            return self.space.wait_for(lambda: len(self.unacked) < self.limit, timeout)
+    
+    def add(self, message):
+        """Number a message and hold it until acked, returns the seq"""
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            message['seq'] = seq
+            message['epoch'] = self.epoch
+            self.unacked[seq] = message
+            self.msg_ids.add(message.get('msg_id'))
+            return seq
+    
+    def ack(self, cumulative, selective=()):
+        """Drop acknowledged messages and return them"""
+        with self.lock:
+            acked = []
+            while self.unacked:
+                seq = next(iter(self.unacked))
+                if seq > cumulative:
+                    break
+                acked.append(self.unacked.pop(seq))
+            for seq in selective:
+                message = self.unacked.pop(seq, None)
+                if message is not None:
+                    acked.append(message)
+            for message in acked:
+                self.msg_ids.discard(message.get('msg_id'))
+            if acked:
+                self.space.notify_all()
+            return acked
+    
+    def pending(self):
+        with self.lock:
+            return list(self.unacked.values())
+    
+    def __contains__(self, msg_id):
+        return msg_id in self.msg_ids
+
+
+class ReceiveWindow:
+    """What we have received from one peer, for duplicate checks and acks"""
+    
+    def __init__(self):
+        self.epoch = None
+        self.cumulative = -1  # every seq up to here arrived
+        self.above = set()    # seqs that arrived after a gap
+        self.unacked = 0      # messages since our last ack
+    
+    def receive(self, epoch, seq):
+        """Record a seq, returns False for a duplicate"""
+        if epoch != self.epoch:
+            # The sender restarted and numbers from 0 again
+            self.epoch = epoch
+            self.cumulative = -1
+            self.above.clear()
+        self.unacked += 1
+        if seq <= self.cumulative or seq in self.above:
+            return False
+        self.above.add(seq)
+        while self.cumulative + 1 in self.above:
+            self.cumulative += 1
+            self.above.remove(self.cumulative)
+        return True
+    
+    def ack_fields(self):
+        self.unacked = 0
+        return {'epoch': self.epoch, 'ack': self.cumulative, 'sack': sorted(self.above)[:MAX_SACK]}
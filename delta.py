@@ -0,0 +1,198 @@
+import hashlib
+import struct
+import zlib
+
+from transport import recv_exact
+
+# rsync-style delta transfer. The receiver describes its old copy as a list
+# of per-block checksums, the sender answers with copy instructions for the
+# blocks the receiver already has and literal bytes for everything else.
+ADLER_MOD = 65521
+SIGNATURE_HEADER = struct.Struct('!II')  # block size, block count
+SIGNATURE_ENTRY = struct.Struct('!I16s')  # weak, strong checksum
+
+OP_COPY = b'C'     # block index, block count
+OP_LITERAL = b'L'  # length, then the bytes
+OP_END = b'E'      # crc32 of the whole new file
+COPY_ARGS = struct.Struct('!II')
+
+MIN_DELTA_SIZE = 1024 * 1024  # smaller files are cheaper to send whole
+ROLLING_BUDGET = 16 * 1024 * 1024  # bytes searched byte-by-byte per transfer
+
+
+def block_size_for(size):
+    """Block size for a basis file, about the square root of its size"""
+    return max(8 * 1024, min(1024 * 1024, int(size ** 0.5) // 1024 * 1024))
+
+
+def strong_sum(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def file_signature(path):
+    """Checksums of every full block of a file, ready to send"""
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        block_size = block_size_for(f.tell())
+        f.seek(0)
+        entries = []
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                break
+            entries.append(SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_sum(block)))
+    return SIGNATURE_HEADER.pack(block_size, len(entries)) + b''.join(entries)
+
+
+def parse_signature(data):
+    """Block size and a weak: {strong: index} lookup"""
+    block_size, count = SIGNATURE_HEADER.unpack_from(data)
+    blocks = {}
+    for index in range(count):
+        weak, strong = SIGNATURE_ENTRY.unpack_from(data, SIGNATURE_HEADER.size + index * SIGNATURE_ENTRY.size)
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    return block_size, blocks
+
+
+def delta_chunks(path, signature, chunk_size=64 * 1024):
+    """Encode a file against a signature.
+    
+    Yields (wire bytes, source bytes covered) pairs. Blocks are first tried
+    at the offset right after the previous match, which is all an in-place
+    edit needs. After a miss the next block's worth of offsets is searched
+    with a rolling checksum so inserted or deleted bytes resynchronise too,
+    within a total budget that keeps unrelated files from crawling.
+    """
+    block_size, blocks = parse_signature(signature)
+    whole = 0
+    budget = ROLLING_BUDGET
+    out = bytearray()
+    literal = bytearray()
+    run = None  # [first block, count]
+    covered = 0
+    
+    def lookup(data, weak):
+        strongs = blocks.get(weak)
+        return strongs.get(strong_sum(data)) if strongs else None
+    
+    def flush_literal():
+        if literal:
+            out.extend(OP_LITERAL + struct.pack('!I', len(literal)) + literal)
+            literal.clear()
+    
+    def flush_run():
+        nonlocal run
+        if run:
+            out.extend(OP_COPY + COPY_ARGS.pack(*run))
+            run = None
+    
+    with open(path, 'rb') as f:
+        buf = b''
+        pos = 0
+        eof = False
+        while True:
+            if not eof and len(buf) - pos < 2 * block_size:
+                data = f.read(max(4 * 1024 * 1024, 2 * block_size))
+                whole = zlib.crc32(data, whole)
+                eof = not data
+                buf = buf[pos:] + data
+                pos = 0
+            if len(buf) - pos < block_size:
+                break
+            
+            start = pos
+            window = buf[pos:pos + block_size]
+            index = lookup(window, zlib.adler32(window))
+            if index is None and budget > 0 and blocks:
+                # Roll the weak checksum forward one byte at a time
+                weak = zlib.adler32(window)
+                a, b = weak & 0xffff, weak >> 16
+                end = min(pos + block_size, len(buf) - block_size)
+                budget -= end - pos
+                for offset in range(pos, end):
+                    old, new = buf[offset], buf[offset + block_size]
+                    a = (a - old + new) % ADLER_MOD
+                    b = (b - block_size * old + a - 1) % ADLER_MOD
+                    weak = b << 16 | a
+                    if weak in blocks and lookup(buf[offset + 1:offset + 1 + block_size], weak) is not None:
+                        literal.extend(buf[pos:offset + 1])
+                        pos = offset + 1
+                        break
+            
+            if pos == start and index is not None:
+                flush_literal()
+                if run and run[0] + run[1] == index:
+                    run[1] += 1
+                else:
+                    flush_run()
+                    run = [index, 1]
+                pos += block_size
+            elif pos == start:
+                flush_run()
+                literal.extend(window)
+                pos += block_size
+            else:
+                flush_run()
+            covered_now = pos - start
+            covered += covered_now
+            
+            if len(literal) >= chunk_size:
+                flush_literal()
+            if len(out) >= chunk_size:
+                yield bytes(out), covered
+                out.clear()
+                covered = 0
+        
+        flush_run()
+        literal.extend(buf[pos:])
+        covered += len(buf) - pos
+        flush_literal()
+        out.extend(OP_END + struct.pack('!I', whole))
+        yield bytes(out), covered
+
+
+def apply_delta(sock, basis_path, signature, target, on_progress=None):
+    """Rebuild a file from a delta stream, returns the bytes written.
+    
+    `target` is an open binary file. on_progress(written, received) is
+    called as data lands, received counting only bytes off the network.
+    """
+    block_size = SIGNATURE_HEADER.unpack_from(signature)[0]
+    whole = 0
+    written = 0
+    with open(basis_path, 'rb') as basis:
+        while True:
+            op = recv_exact(sock, 1)
+            if op == OP_END:
+                if struct.unpack('!I', recv_exact(sock, 4))[0] != whole:
+                    raise Exception("Delta result does not match the sender's file")
+                return written
+            
+            if op == OP_COPY:
+                index, count = COPY_ARGS.unpack(recv_exact(sock, COPY_ARGS.size))
+                basis.seek(index * block_size)
+                remaining = count * block_size
+                while remaining:
+                    data = basis.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        raise Exception("Delta refers past the end of the old copy")
+                    target.write(data)
+                    whole = zlib.crc32(data, whole)
+                    remaining -= len(data)
+                    written += len(data)
+                    if on_progress:
+                        on_progress(written, 0)
+            elif op == OP_LITERAL:
+                remaining = struct.unpack('!I', recv_exact(sock, 4))[0]
+                while remaining:
+                    data = sock.recv(min(remaining, 65536))
+                    if not data:
+                        raise Exception("Sender closed the connection early")
+                    target.write(data)
+                    whole = zlib.crc32(data, whole)
+                    remaining -= len(data)
+                    written += len(data)
+                    if on_progress:
+                        on_progress(written, len(data))
+            else:
+                raise Exception("Corrupt delta stream")
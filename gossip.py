@@ -0,0 +1,58 @@
+import hashlib
+
+BUCKETS = 64
+RECORD_FIELDS = ('name', 'ip', 'file_port', 'version')  # what gossip carries, the rest is local
+
+
+def bucket_of(user_id):
+    return int.from_bytes(hashlib.sha1(user_id.encode('utf-8')).digest()[:4], 'big') % BUCKETS
+
+
+class DirectoryDigest:
+    """Two-level hash summary of directory versions, for anti-entropy.
+    
+    Every entry is versioned by the user it describes. Entries are spread
+    over BUCKETS buckets by ID; each bucket hashes its (user_id, version)
+    pairs and the root hashes the buckets. Peers first compare roots (one
+    hash when in sync), then bucket hashes, then the versions in buckets
+    that differ only, so what is exchanged grows with the changes rather
+    than with the directory.
+    """
+    
+    def __init__(self, versions):
+        self.members = [{} for _ in range(BUCKETS)]
+        for user_id, version in versions.items():
+            self.members[bucket_of(user_id)][user_id] = version
+        self.buckets = []
+        for members in self.members:
+            h = hashlib.sha1()
+            for user_id in sorted(members):
+                h.update(f"{user_id}:{members[user_id]};".encode('utf-8'))
+            self.buckets.append(h.hexdigest()[:16])
+        self.root = hashlib.sha1(''.join(self.buckets).encode('ascii')).hexdigest()[:16]
+    
+    def differing(self, buckets):
+        """Indices of buckets whose hash differs from a peer's list"""
+        if not isinstance(buckets, list) or len(buckets) != BUCKETS:
+            return list(range(BUCKETS))
+        return [index for index, h in enumerate(buckets) if h != self.buckets[index]]
+    
+    def versions_in(self, indices):
+        versions = {}
+        for index in indices:
+            if 0 <= index < BUCKETS:
+                versions.update(self.members[index])
+        return versions
+
+
+def compare(mine, theirs):
+    """(IDs to send them, IDs to pull from them) from two version maps"""
+    send = [user_id for user_id, version in mine.items() if theirs.get(user_id, 0) < version]
+    pull = [user_id for user_id, version in theirs.items()
+            if isinstance(version, int) and mine.get(user_id, 0) < version]
+    return send, pull
+
+
+def record(info):
+    """The part of a directory entry that is gossiped"""
+    return {field: info[field] for field in RECORD_FIELDS if field in info}
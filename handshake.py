@@ -0,0 +1,55 @@
+PROTOCOL_VERSION = 2
+
+# Wire features a connection uses once both ends offer them
+FRAMES = 'frames'    # length-prefixed frames instead of bare JSON (transport.py)
+MUX = 'mux'          # file streams share the chat connection
+DEFLATE = 'deflate'  # compressed chat frames and file data (compression.py)
+RESUME = 'resume'    # numbered chat, cumulative acks and resend after a reconnect (delivery.py)
+DELTA = 'delta'      # a file sent again travels as a delta against the last copy (delta.py)
+STRIPE = 'stripe'    # large files spread over several address pairs (striping.py)
+TLS = 'tls'          # accepts encrypted connections (tls.py); tells the peer how to dial next time
+
+CAPABILITIES = (FRAMES, MUX, DEFLATE, RESUME, DELTA, STRIPE, TLS)
+
+
+def hello(caps):
+    """Version and capability fields for connect and connect_ack.
+    
+    The old flags go along so version 1 peers still pick their features.
+    """
+    return {
+        'protocol': PROTOCOL_VERSION,
+        'caps': sorted(caps),
+        'mux': MUX in caps,
+        'compress': DEFLATE in caps
+    }
+
+
+def offered(message):
+    """(protocol version, capabilities) a peer's connect or connect_ack offers"""
+    caps = message.get('caps')
+    if isinstance(caps, list):
+        return message.get('protocol', PROTOCOL_VERSION), {cap for cap in caps if isinstance(cap, str)}
+    
+    # Version 1: read the features off the individual fields. Receivers that
+    # predate deltas ignore the request for one and take the whole file.
+    caps = {DELTA}
+    if 'mux' in message:
+        caps.add(FRAMES)
+    if message.get('mux'):
+        caps.add(MUX)
+    if message.get('compress'):
+        caps.add(DEFLATE)
+    if message.get('addresses'):
+        caps.add(STRIPE)
+    if 'version' in message:
+        caps.add(RESUME)
+    return 1, caps
+
+
+def negotiate(ours, message):
+    """(protocol version, capabilities both sides have) for a connection"""
+    protocol, theirs = offered(message)
+    if not isinstance(protocol, int):
+        protocol = 1
+    return min(protocol, PROTOCOL_VERSION), set(ours) & theirs
@@ -0,0 +1,415 @@
+"""Headless relay hub.
+
+Clients connect to the hub once instead of to every peer, and the hub routes
+their messages: to one user ('to'), to the members of a room ('room'), or,
+for chat.py clients, to everyone in the lobby. A message going to many
+connections is encoded once and the same bytes are queued on each of them.
+
+On systems with SO_REUSEPORT the listener can be sharded over worker
+processes. Workers are linked by socket pairs and tell each other about
+their users, so a message is forwarded at most once to each other worker.
+    
+    python hub.py --port 12345 --workers 4
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import sys
+
+from transport import FrameDecoder, KIND_MESSAGE, encode_frame
+
+MAX_QUEUED = 4 * 1024 * 1024  # unsent bytes before a slow client is dropped
+LOBBY = None  # room key of legacy chat.py clients
+
+
+class Packet:
+    """A routed message, encoded at most once per wire format"""
+    
+    __slots__ = ('message', 'payload', 'frame')
+    
+    def __init__(self, message, payload=None):
+        self.message = message
+        self.payload = payload
+        self.frame = None
+    
+    def encoded(self, framed):
+        if self.payload is None:
+            self.payload = json.dumps(self.message).encode('utf-8')
+        if not framed:
+            return self.payload
+        if self.frame is None:
+            self.frame = encode_frame(KIND_MESSAGE, 0, self.payload)
+        return self.frame
+
+
+class HubConnection:
+    """A client or worker link with its unsent output"""
+    
+    __slots__ = ('sock', 'decoder', 'out', 'queued', 'user', 'framed', 'rooms', 'worker', 'closed')
+    
+    def __init__(self, sock, worker=None):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.out = collections.deque()
+        self.queued = 0
+        self.user = None      # user info from hub_hello, or the name/ip of a chat.py client
+        self.framed = worker is not None
+        self.rooms = set()
+        self.worker = worker  # index of the other worker for worker links
+        self.closed = False
+
+
+class Hub:
+    """One hub process: a selector loop over the listener, clients and worker links"""
+    
+    def __init__(self, host='0.0.0.0', port=12345, backlog=1024, worker_index=0, worker_links=None,
+                 reuse_port=False):
+        self.selector = selectors.DefaultSelector()
+        self.worker_index = worker_index
+        self.users = {}         # user_id: HubConnection, clients of this worker
+        self.rooms = {}         # room: set of HubConnection, LOBBY for chat.py clients
+        self.remote_users = {}  # user_id: (worker index, user info), clients of other workers
+        self.links = {}         # worker index: HubConnection
+        self.presence_changes = []  # users who came or went since the last batch
+        
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(backlog)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        
+        for index, sock in (worker_links or {}).items():
+            sock.setblocking(False)
+            link = HubConnection(sock, worker=index)
+            self.links[index] = link
+            self.selector.register(sock, selectors.EVENT_READ, link)
+    
+    def serve_forever(self):
+        while True:
+            for key, events in self.selector.select():
+                if key.data is None:
+                    self.accept()
+                    continue
+                conn = key.data
+                if events & selectors.EVENT_WRITE:
+                    self.flush(conn)
+                if events & selectors.EVENT_READ and not conn.closed:
+                    self.read(conn)
+            self.flush_presence()
+    
+    def accept(self):
+        """Take every pending connection, not just one per wakeup"""
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Accept failed: {e}")
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.selector.register(sock, selectors.EVENT_READ, HubConnection(sock))
+    
+    def read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close(conn)
+            return
+        try:
+            items = conn.decoder.feed(data)
+        except ValueError:
+            self.close(conn)
+            return
+        for item in items:
+            if item[0] == 'json':
+                self.handle(conn, Packet(item[1]))
+            elif item[1] == KIND_MESSAGE and not item[2]:
+                # Compressed frames can't be routed, clients don't compress to the hub
+                try:
+                    payload = item[4]
+                    self.handle(conn, Packet(json.loads(payload.decode('utf-8')), payload))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    pass
+            if conn.closed:
+                return
+    
+    def handle(self, conn, packet):
+        message = packet.message
+        if not isinstance(message, dict):
+            return
+        if conn.worker is not None:
+            self.handle_link(conn, packet)
+            return
+        
+        msg_type = message.get('type')
+        if msg_type == 'hub_hello':
+            self.hello(conn, message)
+        elif msg_type == 'connect' and conn.user is None and 'user_id' not in message:
+            # chat.py client: joins the lobby, its peers learn about it
+            conn.user = {'name': message.get('name'), 'ip': message.get('ip')}
+            self.route_room(LOBBY, packet, conn)
+            for member in list(self.rooms.get(LOBBY, ())):
+                self.send(conn, Packet({'type': 'connect', **member.user}))
+            self.join(conn, LOBBY)
+        elif conn.user is None:
+            return
+        elif msg_type == 'hub_join':
+            self.join(conn, message.get('room'))
+        elif msg_type == 'hub_leave':
+            self.leave(conn, message.get('room'))
+        elif message.get('from_id', conn.user.get('user_id')) != conn.user.get('user_id'):
+            return  # claims to be someone else
+        elif 'to' in message:
+            self.route_user(message['to'], packet)
+        elif message.get('room') is not None:
+            self.route_room(message['room'], packet, conn)
+        elif LOBBY in conn.rooms:
+            self.route_room(LOBBY, packet, conn)
+    
+    def hello(self, conn, message):
+        user_id = message.get('user_id')
+        if not user_id or conn.user is not None:
+            return
+        old = self.users.get(user_id)
+        if old is not None:
+            self.close(old)
+        conn.user = {
+            'user_id': user_id,
+            'name': message.get('name'),
+            'ip': message.get('ip'),
+            'file_port': message.get('file_port')
+        }
+        conn.framed = bool(message.get('frames'))
+        self.users[user_id] = conn
+        
+        users = [c.user for c in self.users.values() if c is not conn]
+        users += [info for _, info in self.remote_users.values()]
+        self.send(conn, Packet({'type': 'hub_welcome', 'users': users}))
+        self.presence(conn.user, True)
+    
+    def presence(self, user, online):
+        self.presence_changes.append({'user': user, 'online': online})
+    
+    def flush_presence(self):
+        """Tell local clients and the other workers who came or went.
+        
+        Changes are batched per loop pass, so a burst of logins costs each
+        client one message rather than one per login.
+        """
+        if not self.presence_changes:
+            return
+        packet = Packet({'type': 'hub_presence', 'changes': self.presence_changes, 'worker': self.worker_index})
+        self.presence_changes = []
+        for conn in list(self.users.values()):
+            self.send(conn, packet)
+        for link in list(self.links.values()):
+            self.send(link, packet)
+    
+    def join(self, conn, room):
+        if room is LOBBY and conn.user.get('user_id'):
+            return
+        self.rooms.setdefault(room, set()).add(conn)
+        conn.rooms.add(room)
+    
+    def leave(self, conn, room):
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(conn)
+            if not members:
+                del self.rooms[room]
+        conn.rooms.discard(room)
+    
+    def route_user(self, user_id, packet, forward=True):
+        conn = self.users.get(user_id)
+        if conn is not None:
+            self.send(conn, packet)
+        elif forward and user_id in self.remote_users:
+            link = self.links.get(self.remote_users[user_id][0])
+            if link is not None:
+                self.send(link, packet)
+    
+    def route_room(self, room, packet, sender=None, forward=True):
+        for member in list(self.rooms.get(room, ())):
+            if member is not sender:
+                self.send(member, packet)
+        if forward:
+            # Each other worker delivers to its own members of the room
+            for link in list(self.links.values()):
+                self.send(link, packet)
+    
+    def handle_link(self, link, packet):
+        """Message from another worker, delivered to our clients only"""
+        message = packet.message
+        if message.get('type') == 'hub_presence':
+            for change in message.get('changes', []):
+                user = change.get('user') or {}
+                user_id = user.get('user_id')
+                if change.get('online'):
+                    self.remote_users[user_id] = (link.worker, user)
+                elif self.remote_users.get(user_id, (None,))[0] == link.worker:
+                    del self.remote_users[user_id]
+            for conn in list(self.users.values()):
+                self.send(conn, packet)
+        elif 'to' in message:
+            self.route_user(message['to'], packet, forward=False)
+        elif message.get('room') is not None:
+            self.route_room(message['room'], packet, forward=False)
+        else:
+            self.route_room(LOBBY, packet, forward=False)
+    
+    def send(self, conn, packet):
+        if not conn or conn.closed:
+            return
+        data = packet.encoded(conn.framed)
+        if not conn.out:
+            # Try the socket straight away, most writes fit in its buffer
+            try:
+                sent = conn.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.close(conn)
+                return
+            if sent == len(data):
+                return
+            data = memoryview(data)[sent:]
+            self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+        conn.out.append(data)
+        conn.queued += len(data)
+        if conn.queued > MAX_QUEUED and conn.worker is None:
+            print(f"Dropping slow client {conn.user}")
+            self.close(conn)
+    
+    def flush(self, conn):
+        while conn.out:
+            data = conn.out[0]
+            try:
+                sent = conn.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.close(conn)
+                return
+            conn.queued -= sent
+            if sent < len(data):
+                conn.out[0] = memoryview(data)[sent:]
+                return
+            conn.out.popleft()
+        self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+    
+    def close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        conn.out.clear()
+        for room in list(conn.rooms):
+            self.leave(conn, room)
+        if conn.worker is not None:
+            print(f"Lost link to worker {conn.worker}")
+            self.links.pop(conn.worker, None)
+            return
+        user_id = conn.user and conn.user.get('user_id')
+        if user_id and self.users.get(user_id) is conn:
+            del self.users[user_id]
+            self.presence(conn.user, False)
+
+
+def raise_file_limit():
+    """Allow a socket per seat, the default soft limit is often 1024"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 65536 if hard == resource.RLIM_INFINITY else min(hard, 65536)
+    if soft < wanted:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def run_worker(host, port, backlog, index, links, reuse_port, foreign=()):
+    # Ends of other workers' links came along with the fork; held open here
+    # they would hide a dead worker from the ones it was linked to
+    for sock in foreign:
+        sock.close()
+    raise_file_limit()
+    hub = Hub(host, port, backlog, index, links, reuse_port)
+    print(f"Hub worker {index} listening on {host}:{port} (pid {os.getpid()})")
+    try:
+        hub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_hub(host='0.0.0.0', port=12345, workers=1, backlog=1024):
+    """Run the hub, sharded over worker processes where SO_REUSEPORT allows"""
+    if workers > 1 and not (hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork')):
+        print("SO_REUSEPORT is not available here, running a single hub process")
+        workers = 1
+    if workers == 1:
+        run_worker(host, port, backlog, 0, {}, False)
+        return
+    
+    # A socket pair between every two workers
+    links = [{} for _ in range(workers)]
+    for a in range(workers):
+        for b in range(a + 1, workers):
+            links[a][b], links[b][a] = socket.socketpair()
+    
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for index in range(workers):
+        foreign = [sock for other, other_links in enumerate(links) if other != index
+                   for sock in other_links.values()]
+        process = context.Process(target=run_worker,
+                                  args=(host, port, backlog, index, links[index], True, foreign), daemon=True)
+        process.start()
+        processes.append(process)
+        # Only the worker keeps its ends, later forks don't inherit them
+        for sock in links[index].values():
+            sock.close()
+    # Take the workers down with us, also on SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay hub for Operation and Simple Chat clients")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--workers', type=int, default=1, help="listener processes sharing the port")
+    parser.add_argument('--backlog', type=int, default=1024)
+    args = parser.parse_args()
+    run_hub(args.host, args.port, args.workers, args.backlog)
+
+
+if __name__ == '__main__':
+    main()
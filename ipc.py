@@ -0,0 +1,328 @@
+import collections
+import json
+import os
+import socket
+import sys
+import threading
+from transport import FrameDecoder, PeerWriter, encode_message, KIND_MESSAGE, PRIORITY_CHAT, send_all
+
+# Local control API on a Unix socket, for scripts and bots.
+#
+# Requests and replies are JSON messages framed like chat messages
+# (encode_message; bare JSON objects are accepted too). Every request has an
+# "id" and an "op"; the reply carries the same id plus "ok" and either the
+# result or "error". Requests may be pipelined: all requests in one read are
+# handled in order and their replies go back in one write. After
+# {"op": "subscribe"} inbound events arrive as {"event": name, ...} messages.
+
+EVENTS = ('message', 'room_message', 'file_offer', 'file_received')
+MAX_BACKLOG = 10000  # queued events before a subscriber that doesn't read is dropped
+
+
+def default_path(app_data_dir):
+    return os.path.join(app_data_dir, 'ipc.sock')
+
+
+class IpcConnection:
+    __slots__ = ('sock', 'writer', 'decoder', 'events')
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.writer = PeerWriter(sock)
+        self.decoder = FrameDecoder()
+        self.events = set()
+    
+    def backlog(self):
+        return sum(len(queue) for queue in self.writer.queues)
+
+
+class IpcServer:
+    """Accepts local API clients and runs their requests against the core"""
+    
+    def __init__(self, core, path):
+        self.core = core
+        self.path = path
+        self.server = None
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.ops = {
+            'ping': self.op_ping,
+            'send': self.op_send,
+            'room_send': self.op_room_send,
+            'send_file': self.op_send_file,
+            'directory': self.op_directory,
+            'rooms': self.op_rooms,
+            'transfers': self.op_transfers,
+            'accept_offer': self.op_accept_offer,
+            'reject_offer': self.op_reject_offer,
+            'subscribe': self.op_subscribe,
+            'unsubscribe': self.op_unsubscribe,
+        }
+    
+    def start(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                probe.close()
+                raise OSError(f"Another messenger is serving {self.path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.path)  # left over from a crash
+            finally:
+                probe.close()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)  # only our own user may connect
+        try:
+            self.server.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.server.listen(16)
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+    
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return  # closed
+            threading.Thread(target=self.serve, args=(IpcConnection(sock),), daemon=True).start()
+    
+    def serve(self, client):
+        with self.lock:
+            self.clients.add(client)
+        try:
+            while True:
+                data = client.sock.recv(262144)
+                if not data:
+                    break
+                replies = []
+                for item in client.decoder.feed(data):
+                    if item[0] == 'json':
+                        request = item[1]
+                    elif item[1] == KIND_MESSAGE:
+                        try:
+                            request = json.loads(item[4].decode('utf-8'))
+                        except (json.JSONDecodeError, UnicodeDecodeError):
+                            continue
+                    else:
+                        continue
+                    replies.append(encode_message(self.handle(client, request)))
+                if replies:
+                    client.writer.write(b''.join(replies), PRIORITY_CHAT)
+        except Exception as e:
+            print(f"IPC client dropped: {e}")
+        finally:
+            self.drop(client)
+    
+    def handle(self, client, request):
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': "Request must be a JSON object"}
+        reply = {'id': request.get('id')}
+        op = self.ops.get(request.get('op'))
+        if op is None:
+            reply.update(ok=False, error=f"Unknown op: {request.get('op')}")
+            return reply
+        try:
+            reply.update(op(client, request) or {})
+            reply['ok'] = True
+        except KeyError as e:
+            reply.update(ok=False, error=f"Missing field: {e.args[0]}")
+        except (ValueError, TypeError, OSError) as e:
+            reply.update(ok=False, error=str(e) or type(e).__name__)
+        return reply
+    
+    def drop(self, client):
+        with self.lock:
+            self.clients.discard(client)
+        client.writer.close()
+        try:
+            client.sock.close()
+        except OSError:
+            pass
+    
+    def emit(self, event, data):
+        """Push an event to the clients subscribed to it"""
+        with self.lock:
+            clients = [c for c in self.clients if event in c.events]
+        if not clients:
+            return
+        frame = encode_message(dict(data, event=event))
+        for client in clients:
+            if client.backlog() > MAX_BACKLOG:
+                print("IPC subscriber is not reading, dropping it")
+                self.drop(client)
+                continue
+            try:
+                client.writer.write(frame, PRIORITY_CHAT)
+            except ConnectionError:
+                self.drop(client)
+    
+    def close(self):
+        if self.server:
+            self.server.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            self.drop(client)
+    
+    # Operations
+    
+    def op_ping(self, client, request):
+        return {'user_id': self.core.user_id, 'name': self.core.current_user}
+    
+    def op_send(self, client, request):
+        user_id = request['to']
+        if user_id not in self.core.user_directory:
+            raise ValueError(f"Unknown user: {user_id}")
+        text = str(request['text'])
+        msg_id = self.core.send_message_to_user(user_id, text)
+        return {'msg_id': msg_id, 'queued': not self.core.reachable(user_id)}
+    
+    def op_room_send(self, client, request):
+        room_id = request['room']
+        if room_id not in self.core.rooms.rooms:
+            raise ValueError(f"Unknown room: {room_id}")
+        return {'msg_id': self.core.send_room_message(room_id, str(request['text']))}
+    
+    def op_send_file(self, client, request):
+        user_id = request['to']
+        path = os.path.abspath(request['path'])
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No such file: {path}")
+        if user_id not in self.core.connected_users:
+            raise ValueError(f"{user_id} is not connected")
+        transfer_id = self.core.send_file(user_id, path, request.get('priority', 1))
+        if transfer_id is None:
+            raise ValueError("Transfer could not be offered")
+        return {'transfer_id': transfer_id}
+    
+    def op_directory(self, client, request):
+        users = []
+        for user_id, info in list(self.core.user_directory.items()):
+            if user_id == self.core.user_id:
+                continue
+            online = self.core.reachable(user_id)
+            if request.get('online') and not online:
+                continue
+            features = self.core.peer_features.get(user_id)
+            users.append({'user_id': user_id, 'name': info.get('name'), 'ip': info.get('ip'),
+                          'online': online, 'last_seen': info.get('last_seen'),
+                          'protocol': features and features['protocol'],
+                          'caps': features and sorted(features['caps']),
+                          'encryption': features and features.get('encryption')})
+        return {'users': users}
+    
+    def op_rooms(self, client, request):
+        return {'rooms': [{'room': room_id, 'name': room['name'], 'members': list(room['members'])}
+                          for room_id, room in list(self.core.rooms.rooms.items())]}
+    
+    def op_transfers(self, client, request):
+        transfers = []
+        for transfer in self.core.file_transfers.values():
+            transfers.append({field: transfer.get(field) for field in
+                              ('type', 'filename', 'size', 'progress', 'status', 'user_id', 'save_path',
+                               'link_latency')})
+        return {'transfers': transfers}
+    
+    def op_accept_offer(self, client, request):
+        return {'accepted': self.core.accept_offer((request['from_id'], request['transfer_id']))}
+    
+    def op_reject_offer(self, client, request):
+        return {'rejected': self.core.reject_offer((request['from_id'], request['transfer_id']))}
+    
+    def op_subscribe(self, client, request):
+        events = request.get('events') or list(EVENTS)
+        unknown = set(events) - set(EVENTS)
+        if unknown:
+            raise ValueError(f"Unknown events: {', '.join(sorted(unknown))}")
+        client.events.update(events)
+        return {'events': sorted(client.events)}
+    
+    def op_unsubscribe(self, client, request):
+        client.events.difference_update(request.get('events') or EVENTS)
+        return {'events': sorted(client.events)}
+
+
+class IpcClient:
+    """Blocking client for the control socket, for scripts.
+    
+    call() sends one request and waits for its reply. send() only queues a
+    request, so many can be pipelined; replies() then collects theirs.
+    """
+    
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.decoder = FrameDecoder()
+        self.items = collections.deque()
+        self.next_id = 0
+        self.pending = bytearray()
+        self.events = []  # events that arrived while waiting for replies
+    
+    def send(self, op, **args):
+        self.next_id += 1
+        self.pending += encode_message(dict(args, op=op, id=self.next_id))
+        return self.next_id
+    
+    def flush(self):
+        if self.pending:
+            send_all(self.sock, bytes(self.pending))
+            self.pending.clear()
+    
+    def receive(self):
+        """Next message from the server, reply or event"""
+        while not self.items:
+            data = self.sock.recv(262144)
+            if not data:
+                raise ConnectionError("Messenger closed the connection")
+            self.items.extend(self.decoder.feed(data))
+        item = self.items.popleft()
+        return item[1] if item[0] == 'json' else json.loads(item[4].decode('utf-8'))
+    
+    def replies(self, count):
+        """Collect count replies, events are kept in self.events"""
+        self.flush()
+        replies = {}
+        while len(replies) < count:
+            message = self.receive()
+            if 'event' in message:
+                self.events.append(message)
+            else:
+                replies[message.get('id')] = message
+        return replies
+    
+    def call(self, op, **args):
+        request_id = self.send(op, **args)
+        reply = self.replies(1)[request_id]
+        if not reply.get('ok'):
+            raise RuntimeError(reply.get('error'))
+        return reply
+    
+    def close(self):
+        self.sock.close()
+
+
+def main(argv):
+    """python ipc.py send USER_ID TEXT | directory | subscribe"""
+    app_data_dir = (os.path.join(os.getenv('APPDATA'), 'LocalMessenger') if sys.platform == 'win32'
+                    else os.path.expanduser("~/.localmessenger"))
+    client = IpcClient(default_path(app_data_dir))
+    if argv[:1] == ['send'] and len(argv) >= 3:
+        print(client.call('send', to=argv[1], text=' '.join(argv[2:])))
+    elif argv[:1] == ['directory']:
+        for user in client.call('directory')['users']:
+            print(f"{'🟢' if user['online'] else '⚫'} {user['name']} ({user['user_id']})")
+    elif argv[:1] == ['subscribe']:
+        client.call('subscribe')
+        while True:
+            print(json.dumps(client.receive()))
+    else:
+        print(main.__doc__)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,22 +1,21 @@
+import sys
+
+if __name__ == "__main__" and "--headless" in sys.argv:
+    # No window: run the network core alone, without loading Tk at all
+    import messenger_core
+    messenger_core.main(sys.argv[1:])
+    sys.exit(0)
+
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from datetime import datetime
 import os
 import platform
-import sys
-import threading
-import time
-import json
-import socket
-import select
-import hashlib
 import getpass
 import subprocess
-import base64
-import struct
-from pathlib import Path
+from messenger_core import MessengerCore
 
-class LocalMessenger:
+class LocalMessenger(MessengerCore):
     def __init__(self):
         self.root = tk.Tk()
         
@@ -25,44 +24,9 @@ class LocalMessenger:
         self.root.geometry("550x650")  # Increased size for file transfer
         self.root.configure(bg='#1a1a1a')
         
-        # User and connection state
-        self.current_user = None
-        self.user_id = None
-        self.user_ip = None
-        self.user_port = 12345
-        self.file_port = 12346  # Separate port for file transfers
-        
-        # Messenger state
-        self.messenger_active = False
-        self.messenger_server = None
-        self.file_server = None
-        self.connected_users = {}  # user_id: socket
-        self.user_directory = {}   # user_id: {"name": "", "ip": "", "last_seen": ""}
-        
-        # File transfer state
-        self.file_transfers = {}  # transfer_id: {type, filename, size, progress, status}
-        self.current_file_transfer_id = 0
-        
-        # Platform-specific paths
-        self.system = platform.system()
-        
-        # Configuration files
-        if self.system == "Windows":
-            self.app_data_dir = os.path.join(os.getenv('APPDATA'), 'LocalMessenger')
-            self.download_dir = os.path.join(os.getenv('USERPROFILE'), 'Downloads', 'Operation')
-        else:  # Linux, macOS, etc.
-            self.app_data_dir = os.path.expanduser("~/.localmessenger")
-            self.download_dir = os.path.expanduser("~/Downloads/Operation")
-        
-        self.config_file = os.path.join(self.app_data_dir, 'config.json')
-        self.contacts_file = os.path.join(self.app_data_dir, 'contacts.json')
-        
-        # Create app data directory
-        os.makedirs(self.app_data_dir, exist_ok=True)
-        os.makedirs(self.download_dir, exist_ok=True)
-        
-        # Load configuration
-        self.load_config()
+        MessengerCore.__init__(self)
+        self.selected_contact_id = None
+        self.selected_room = None
         
         # Setup auto-start
         self.setup_autostart()
@@ -73,6 +37,29 @@ class LocalMessenger:
         else:
             self.show_login_screen()
     
+    def call_later(self, ms, func, *args):
+        self.root.after(ms, func, *args)
+    
+    def set_status(self, text, color=None):
+        self.status_label.config(text=text, fg=color or '#FF8800')
+    
+    def on_chat_message(self, from_id, from_name, text):
+        if from_id == self.selected_contact_id:
+            self.add_chat_message(text, from_name)
+        else:
+            self.add_chat_message(f"New message from {from_name}", "system")
+    
+    def on_room_chat(self, room_id, message):
+        if room_id == self.selected_room:
+            self.add_chat_message(message.get('message', ''), message.get('from_name'))
+        else:
+            self.add_chat_message(f"New message in {self.rooms.name_of(room_id)}", "system")
+    
+    def leave_room(self, room_id):
+        if self.selected_room == room_id:
+            self.selected_room = None
+        MessengerCore.leave_room(self, room_id)
+    
     def setup_autostart(self):
         """Setup auto-start based on platform"""
         if self.system == "Windows":
@@ -284,74 +271,6 @@ X-GNOME-Autostart-enabled=true
         except Exception as e:
             print(f"macOS autostart setup failed: {e}")
     
-    def generate_user_id(self, username):
-        """Generate unique user ID based on username and machine"""
-        machine_id = platform.node()  # Computer name
-        timestamp = str(time.time())
-        combined = f"{username}_{machine_id}_{timestamp}"
-        return hashlib.md5(combined.encode()).hexdigest()[:8]  # 8-char user ID
-    
-    def get_local_ip(self):
-        """Get local IP address - cross-platform"""
-        try:
-            if self.system == "Windows":
-                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                s.connect(("8.8.8.8", 80))
-                local_ip = s.getsockname()[0]
-                s.close()
-            else:  # Linux/macOS
-                # Try multiple methods for Linux
-                try:
-                    import netifaces
-                    for interface in netifaces.interfaces():
-                        addrs = netifaces.ifaddresses(interface)
-                        if netifaces.AF_INET in addrs:
-                            for addr_info in addrs[netifaces.AF_INET]:
-                                ip = addr_info['addr']
-                                if ip != '127.0.0.1' and not ip.startswith('169.254'):
-                                    return ip
-                except ImportError:
-                    # Fallback method
-                    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    s.connect(("8.8.8.8", 80))
-                    local_ip = s.getsockname()[0]
-                    s.close()
-            return local_ip
-        except:
-            return "127.0.0.1"
-    
-    def load_config(self):
-        """Load saved configuration"""
-        try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r') as f:
-                    config = json.load(f)
-                    self.current_user = config.get('username')
-                    self.user_id = config.get('user_id')
-                    self.user_ip = config.get('user_ip')
-                    self.user_port = config.get('port', 12345)
-            
-            if os.path.exists(self.contacts_file):
-                with open(self.contacts_file, 'r') as f:
-                    self.user_directory = json.load(f)
-        except:
-            pass
-    
-    def save_config(self):
-        """Save configuration"""
-        config = {
-            'username': self.current_user,
-            'user_id': self.user_id,
-            'user_ip': self.user_ip,
-            'port': self.user_port
-        }
-        with open(self.config_file, 'w') as f:
-            json.dump(config, f, indent=2)
-        
-        # Save contacts
-        with open(self.contacts_file, 'w') as f:
-            json.dump(self.user_directory, f, indent=2)
-    
     def show_login_screen(self):
         """Show login/register screen"""
         self.clear_window()
@@ -462,44 +381,11 @@ X-GNOME-Autostart-enabled=true
         """Start the messenger interface"""
         self.clear_window()
         
-        # Start messenger server
-        self.start_messenger_server()
-        
-        # Start file server
-        self.start_file_server()
-        
         # Create main interface
         self.create_messenger_interface()
         
-        # Start background thread for checking messages
-        self.messenger_active = True
-        threading.Thread(target=self.check_messages, daemon=True).start()
-        threading.Thread(target=self.check_file_transfers, daemon=True).start()
-        
-        # Broadcast presence
-        self.broadcast_presence()
-    
-    def start_messenger_server(self):
-        """Start server to listen for connections"""
-        try:
-            self.messenger_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.messenger_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.messenger_server.bind(('0.0.0.0', self.user_port))
-            self.messenger_server.listen(5)
-            self.messenger_server.setblocking(False)
-        except Exception as e:
-            print(f"Error starting messenger server: {e}")
-    
-    def start_file_server(self):
-        """Start file transfer server"""
-        try:
-            self.file_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.file_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.file_server.bind(('0.0.0.0', self.file_port))
-            self.file_server.listen(5)
-            self.file_server.setblocking(False)
-        except Exception as e:
-            print(f"Error starting file server: {e}")
+        # Servers and background threads
+        self.start_network()
     
     def create_messenger_interface(self):
         """Create the main messenger interface"""
@@ -658,6 +544,17 @@ X-GNOME-Autostart-enabled=true
         )
         refresh_btn.pack(side='left', padx=5)
         
+        room_btn = tk.Button(
+            add_frame,
+            text="👥 Room",
+            font=('Arial', 9),
+            fg='white',
+            bg='#555555',
+            command=self.show_room_dialog,
+            width=8
+        )
+        room_btn.pack(side='left', padx=5)
+        
         # Contacts list
         contacts_frame = tk.Frame(self.root, bg='#1a1a1a')
         contacts_frame.pack(fill='both', expand=True, padx=10, pady=5)
@@ -725,6 +622,39 @@ X-GNOME-Autostart-enabled=true
         )
         self.transfers_label.pack(side='left', padx=10)
         
+        manage_btn = tk.Button(
+            transfers_frame,
+            text="Manage",
+            font=('Arial', 8),
+            fg='white',
+            bg='#555555',
+            command=self.show_transfers_window,
+            width=7
+        )
+        manage_btn.pack(side='right')
+        
+        many_btn = tk.Button(
+            transfers_frame,
+            text="📎 Many",
+            font=('Arial', 8),
+            fg='white',
+            bg='#555555',
+            command=self.show_multi_send_dialog,
+            width=7
+        )
+        many_btn.pack(side='right', padx=5)
+        
+        limits_btn = tk.Button(
+            transfers_frame,
+            text="⚙ Limits",
+            font=('Arial', 8),
+            fg='white',
+            bg='#555555',
+            command=self.show_rate_limits_dialog,
+            width=7
+        )
+        limits_btn.pack(side='right', padx=5)
+        
         # Chat area
         chat_frame = tk.Frame(self.root, bg='#1a1a1a')
         chat_frame.pack(fill='both', expand=True, padx=10, pady=5)
@@ -776,6 +706,17 @@ X-GNOME-Autostart-enabled=true
         )
         attach_btn.pack(side='left', padx=(0, 5))
         
+        folder_btn = tk.Button(
+            input_frame,
+            text="📂",
+            font=('Arial', 12),
+            fg='white',
+            bg='#FF9800',
+            command=self.send_folder_dialog,
+            width=3
+        )
+        folder_btn.pack(side='left', padx=(0, 5))
+        
         self.send_btn = tk.Button(
             input_frame,
             text="Send",
@@ -808,7 +749,7 @@ X-GNOME-Autostart-enabled=true
         self.add_chat_message(f"Your User ID: {self.user_id}", "system")
         self.add_chat_message(f"Platform: {self.system}", "system")
         self.add_chat_message("Share your ID with others to connect", "system")
-        self.add_chat_message("Click 📎 to send files to selected contact", "system")
+        self.add_chat_message("Click 📎 to send files or 📂 to send a folder to selected contact", "system")
         self.add_chat_message(f"Files are saved to: {self.download_dir}", "system")
     
     def send_file_dialog(self):
@@ -832,6 +773,16 @@ X-GNOME-Autostart-enabled=true
         if filename:
             self.send_file(self.selected_contact_id, filename)
     
+    def send_folder_dialog(self):
+        """Open folder dialog to send a whole directory"""
+        if not self.selected_contact_id:
+            self.status_label.config(text="✗ Select a contact first", fg='#FF0000')
+            return
+        
+        folder = filedialog.askdirectory(title="Select folder to send")
+        if folder:
+            self.send_file(self.selected_contact_id, folder)
+    
     def send_file_to_selected(self):
         """Send file to selected contact"""
         if not self.selected_contact_id:
@@ -839,239 +790,102 @@ X-GNOME-Autostart-enabled=true
             return
         self.send_file_dialog()
     
-    def send_file(self, user_id, filepath):
-        """Send a file to a user"""
-        try:
-            if not os.path.exists(filepath):
-                self.add_chat_message(f"File not found: {filepath}", "system")
-                return
-            
-            filename = os.path.basename(filepath)
-            filesize = os.path.getsize(filepath)
-            
-            if filesize > 100 * 1024 * 1024:  # 100MB limit
-                self.add_chat_message(f"File too large: {filename} ({filesize/1024/1024:.1f}MB)", "system")
+    def show_multi_send_dialog(self):
+        """Pick several connected contacts and send them one file"""
+        online = [uid for uid in self.user_directory if uid in self.connected_users]
+        if not online:
+            messagebox.showwarning("No Contacts Online", "None of your contacts are connected.")
+            return
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Send to Several")
+        dialog.configure(bg='#1a1a1a')
+        dialog.transient(self.root)
+        
+        listbox = tk.Listbox(
+            dialog,
+            font=('Arial', 10),
+            bg='#2a2a2a',
+            fg='white',
+            selectbackground='#3a3a3a',
+            selectmode='multiple',
+            height=10,
+            width=40
+        )
+        listbox.pack(fill='both', expand=True, padx=10, pady=10)
+        for uid in online:
+            listbox.insert('end', f"{self.user_directory[uid].get('name', 'Unknown')} ({uid})")
+        
+        def choose_file():
+            user_ids = [online[i] for i in listbox.curselection()]
+            if not user_ids:
+                messagebox.showwarning("No Contacts Selected", "Select at least one contact.", parent=dialog)
                 return
-            
-            # Generate transfer ID
-            transfer_id = self.current_file_transfer_id
-            self.current_file_transfer_id += 1
-            
-            # Add to transfers
-            self.file_transfers[transfer_id] = {
-                'type': 'sending',
-                'filename': filename,
-                'size': filesize,
-                'progress': 0,
-                'status': 'pending',
-                'user_id': user_id,
-                'filepath': filepath
-            }
-            
-            # Update transfers display
-            self.update_transfers_display()
-            
-            # Send file request
-            if user_id in self.connected_users:
-                file_request = json.dumps({
-                    'type': 'file_request',
-                    'from_id': self.user_id,
-                    'from_name': self.current_user,
-                    'filename': filename,
-                    'filesize': filesize,
-                    'transfer_id': transfer_id
-                })
-                self.connected_users[user_id].send(file_request.encode('utf-8'))
-                
-                self.add_chat_message(f"📁 Sending file: {filename} ({filesize/1024/1024:.1f}MB)", "system")
-                self.status_label.config(text=f"📁 Sending file: {filename}", fg='#00FF00')
-                
-                # Start file transfer thread
-                threading.Thread(target=self.send_file_thread, 
-                               args=(user_id, filepath, transfer_id), daemon=True).start()
-            else:
-                self.add_chat_message(f"User not connected", "system")
-                del self.file_transfers[transfer_id]
-                
-        except Exception as e:
-            self.add_chat_message(f"Error sending file: {str(e)}", "system")
+            filename = filedialog.askopenfilename(title="Select file to send", parent=dialog)
+            if filename:
+                dialog.destroy()
+                self.send_file_to_many(user_ids, filename)
+        
+        tk.Button(
+            dialog,
+            text="Choose File...",
+            font=('Arial', 10, 'bold'),
+            fg='white',
+            bg='#4CAF50',
+            command=choose_file,
+            width=14
+        ).pack(pady=(0, 10))
     
-    def send_file_thread(self, user_id, filepath, transfer_id):
-        """Thread for sending file"""
-        try:
-            # Connect to user's file port
-            if user_id not in self.user_directory:
-                self.root.after(0, lambda: self.add_chat_message("User not found", "system"))
-                return
-            
-            user_ip = self.user_directory[user_id]['ip']
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(30)
-            client_socket.connect((user_ip, self.file_port))
-            
-            # Send file metadata
-            filename = os.path.basename(filepath)
-            filesize = os.path.getsize(filepath)
-            
-            metadata = json.dumps({
-                'type': 'file_metadata',
-                'filename': filename,
-                'filesize': filesize,
-                'transfer_id': transfer_id,
-                'sender_id': self.user_id,
-                'sender_name': self.current_user
-            })
-            
-            # Send metadata length first
-            metadata_len = len(metadata)
-            client_socket.send(struct.pack('!I', metadata_len))
-            client_socket.send(metadata.encode('utf-8'))
-            
-            # Wait for acknowledgment
-            ack = client_socket.recv(1024).decode('utf-8')
-            if ack != 'READY':
-                raise Exception("Receiver not ready")
-            
-            # Send file data
-            sent_bytes = 0
-            with open(filepath, 'rb') as f:
-                while True:
-                    chunk = f.read(4096)
-                    if not chunk:
-                        break
-                    client_socket.send(chunk)
-                    sent_bytes += len(chunk)
-                    
-                    # Update progress
-                    progress = (sent_bytes / filesize) * 100
-                    if transfer_id in self.file_transfers:
-                        self.file_transfers[transfer_id]['progress'] = progress
-                        self.root.after(0, self.update_transfers_display)
-            
-            # Wait for completion acknowledgment
-            completion = client_socket.recv(1024).decode('utf-8')
-            if completion == 'COMPLETE':
-                if transfer_id in self.file_transfers:
-                    self.file_transfers[transfer_id]['status'] = 'completed'
-                    self.file_transfers[transfer_id]['progress'] = 100
-                    self.root.after(0, self.update_transfers_display)
-                    self.root.after(0, lambda: self.add_chat_message(f"✓ File sent: {filename}", "system"))
-            else:
-                raise Exception("Transfer failed")
-            
-            client_socket.close()
+    def show_rate_limits_dialog(self):
+        """Dialog for editing the bandwidth limits"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Bandwidth Limits")
+        dialog.configure(bg='#1a1a1a')
+        dialog.transient(self.root)
+        
+        entries = {}
+        labels = [('upload', "Upload, all peers"), ('download', "Download, all peers"),
+                  ('peer_upload', "Upload, per peer"), ('peer_download', "Download, per peer")]
+        for row, (key, text) in enumerate(labels):
+            tk.Label(
+                dialog,
+                text=f"{text} (KB/s, 0 = unlimited):",
+                font=('Arial', 9),
+                fg='#AAAAAA',
+                bg='#1a1a1a'
+            ).grid(row=row, column=0, sticky='w', padx=10, pady=5)
             
-        except Exception as e:
-            if transfer_id in self.file_transfers:
-                self.file_transfers[transfer_id]['status'] = 'failed'
-                self.root.after(0, self.update_transfers_display)
-                self.root.after(0, lambda: self.add_chat_message(f"✗ File transfer failed: {str(e)}", "system"))
-    
-    def check_file_transfers(self):
-        """Check for incoming file transfers"""
-        while self.messenger_active and self.file_server:
+            entry = tk.Entry(
+                dialog,
+                font=('Arial', 9),
+                width=10,
+                bg='#2a2a2a',
+                fg='white',
+                insertbackground='white'
+            )
+            entry.insert(0, str(self.rate_limits[key]))
+            entry.grid(row=row, column=1, padx=10, pady=5)
+            entries[key] = entry
+        
+        def apply_limits():
             try:
-                readable, _, _ = select.select([self.file_server], [], [], 0.1)
-                
-                for sock in readable:
-                    if sock == self.file_server:
-                        # New file transfer connection
-                        client_socket, addr = self.file_server.accept()
-                        threading.Thread(target=self.handle_file_transfer, 
-                                       args=(client_socket, addr), daemon=True).start()
-                
-            except Exception as e:
-                time.sleep(0.1)
-    
-    def handle_file_transfer(self, sock, addr):
-        """Handle incoming file transfer"""
-        try:
-            sock.settimeout(30)
-            
-            # Receive metadata length
-            metadata_len_data = sock.recv(4)
-            if not metadata_len_data:
-                sock.close()
+                limits = {key: max(0, int(entry.get().strip() or 0)) for key, entry in entries.items()}
+            except ValueError:
+                messagebox.showwarning("Invalid Limit", "Limits must be whole numbers.", parent=dialog)
                 return
-            
-            metadata_len = struct.unpack('!I', metadata_len_data)[0]
-            
-            # Receive metadata
-            metadata = sock.recv(metadata_len).decode('utf-8')
-            metadata_json = json.loads(metadata)
-            
-            filename = metadata_json.get('filename')
-            filesize = metadata_json.get('filesize')
-            transfer_id = metadata_json.get('transfer_id')
-            sender_id = metadata_json.get('sender_id')
-            sender_name = metadata_json.get('sender_name', 'Unknown')
-            
-            # Send ready signal
-            sock.send('READY'.encode('utf-8'))
-            
-            # Create unique filename
-            safe_filename = "".join(c for c in filename if c.isalnum() or c in (' ', '.', '_', '-')).rstrip()
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            unique_filename = f"{timestamp}_{safe_filename}"
-            save_path = os.path.join(self.download_dir, unique_filename)
-            
-            # Create transfer entry
-            if transfer_id not in self.file_transfers:
-                self.file_transfers[transfer_id] = {
-                    'type': 'receiving',
-                    'filename': filename,
-                    'size': filesize,
-                    'progress': 0,
-                    'status': 'downloading',
-                    'user_id': sender_id,
-                    'save_path': save_path
-                }
-                self.root.after(0, self.update_transfers_display)
-            
-            # Receive file data
-            received_bytes = 0
-            with open(save_path, 'wb') as f:
-                while received_bytes < filesize:
-                    chunk = sock.recv(min(4096, filesize - received_bytes))
-                    if not chunk:
-                        break
-                    f.write(chunk)
-                    received_bytes += len(chunk)
-                    
-                    # Update progress
-                    progress = (received_bytes / filesize) * 100
-                    if transfer_id in self.file_transfers:
-                        self.file_transfers[transfer_id]['progress'] = progress
-                        self.root.after(0, self.update_transfers_display)
-            
-            # Send completion acknowledgment
-            sock.send('COMPLETE'.encode('utf-8'))
-            sock.close()
-            
-            # Update transfer status
-            if transfer_id in self.file_transfers:
-                self.file_transfers[transfer_id]['status'] = 'completed'
-                self.file_transfers[transfer_id]['progress'] = 100
-                self.root.after(0, self.update_transfers_display)
-                
-                # Show notification
-                self.root.after(0, lambda: self.add_chat_message(
-                    f"📁 Received file from {sender_name}: {filename}", "system"))
-                self.root.after(0, lambda: self.status_label.config(
-                    text=f"✓ File received: {filename}", fg='#00FF00'))
-                
-                # Open file location button
-                self.root.after(3000, lambda: self.show_file_received_notification(save_path, filename))
-            
-        except Exception as e:
-            print(f"File transfer error: {e}")
-            if transfer_id in self.file_transfers:
-                self.file_transfers[transfer_id]['status'] = 'failed'
-                self.root.after(0, self.update_transfers_display)
-            try:
-                sock.close()
-            except:
-                pass
+            self.set_rate_limits(**limits)
+            dialog.destroy()
+            self.status_label.config(text="✓ Bandwidth limits updated", fg='#00FF00')
+        
+        tk.Button(
+            dialog,
+            text="Apply",
+            font=('Arial', 10, 'bold'),
+            fg='white',
+            bg='#4CAF50',
+            command=apply_limits,
+            width=10
+        ).grid(row=len(labels), column=0, columnspan=2, pady=10)
     
     def show_file_received_notification(self, filepath, filename):
         """Show notification for received file"""
@@ -1117,9 +931,84 @@ X-GNOME-Autostart-enabled=true
     
     def update_transfers_display(self):
         """Update file transfers display"""
-        active_count = sum(1 for t in self.file_transfers.values() 
-                          if t['status'] in ['downloading', 'uploading', 'pending'])
-        self.transfers_label.config(text=f"{active_count} active")
+        self.file_transfers.evict()
+        active_count = sum(self.active_sends.values()) + self.file_transfers.active_count('receiving')
+        queued_count = len(self.transfer_queue)
+        text = f"{active_count} active"
+        if queued_count:
+            text += f", {queued_count} queued"
+        
+        # Show the running transfer that will finish last
+        etas = [(self.transfer_eta(t), t) for t in self.file_transfers.active_records()
+                if t['status'] in ['downloading', 'uploading']]
+        etas = [(eta, t) for eta, t in etas if eta is not None]
+        if etas:
+            eta, transfer = max(etas, key=lambda item: item[0])
+            text += f" | {transfer['filename']} {transfer['progress']:.0f}% ETA {self.format_eta(eta)}"
+        self.transfers_label.config(text=text)
+    
+    def show_transfers_window(self):
+        """Window listing transfers with pause/resume/cancel controls"""
+        window = tk.Toplevel(self.root)
+        window.title("File Transfers")
+        window.configure(bg='#1a1a1a')
+        window.geometry("500x300")
+        
+        listbox = tk.Listbox(
+            window,
+            font=('Arial', 9),
+            bg='#2a2a2a',
+            fg='white',
+            selectbackground='#3a3a3a'
+        )
+        listbox.pack(fill='both', expand=True, padx=10, pady=10)
+        shown_ids = []
+        
+        def refresh():
+            if not window.winfo_exists():
+                return
+            selection = listbox.curselection()
+            selected_id = shown_ids[selection[0]] if selection else None
+            listbox.delete(0, tk.END)
+            shown_ids.clear()
+            for transfer_id, transfer in self.file_transfers.items():
+                arrow = "⬆" if transfer['type'] == 'sending' else "⬇"
+                line = f"{arrow} {transfer['filename']} - {transfer['status']} {transfer['progress']:.0f}%"
+                if transfer['status'] == 'queued' and transfer.get('queue_position'):
+                    line += f" (#{transfer['queue_position']} in queue)"
+                eta = self.transfer_eta(transfer) if transfer['status'] in ('uploading', 'downloading') else None
+                if eta is not None:
+                    line += f" ETA {self.format_eta(eta)}"
+                listbox.insert(tk.END, line)
+                shown_ids.append(transfer_id)
+                if transfer_id == selected_id:
+                    listbox.selection_set(tk.END)
+            window.after(1000, refresh)
+        
+        def selected(action):
+            selection = listbox.curselection()
+            if selection:
+                self.file_transfers.touch(shown_ids[selection[0]])
+                action(shown_ids[selection[0]])
+        
+        button_frame = tk.Frame(window, bg='#1a1a1a')
+        button_frame.pack(pady=(0, 10))
+        
+        for text, action, color in [("Pause", self.pause_transfer, '#555555'),
+                                    ("Resume", self.resume_transfer, '#4CAF50'),
+                                    ("Prioritize", self.prioritize_transfer, '#2196F3'),
+                                    ("Cancel", self.cancel_transfer, '#F44336')]:
+            tk.Button(
+                button_frame,
+                text=text,
+                font=('Arial', 9),
+                fg='white',
+                bg=color,
+                command=lambda action=action: selected(action),
+                width=9
+            ).pack(side='left', padx=5)
+        
+        refresh()
     
     def perform_search(self, event=None):
         """Search contacts by username or user ID"""
@@ -1169,15 +1058,21 @@ X-GNOME-Autostart-enabled=true
         online_count = 0
         offline_count = 0
         
+        # Rooms on top
+        for room_id, room in list(self.rooms.rooms.items()):
+            self.contacts_listbox.insert(tk.END, f"👥 {room['name']} · {len(room['members'])} members [{room_id}]")
+            self.contacts_listbox.itemconfig(tk.END, foreground='#00BFFF')
+        
         # First show online users
         for user_id, info in self.user_directory.items():
             if user_id == self.user_id:
                 continue
             
-            if user_id in self.connected_users:  # Online
+            if self.reachable(user_id):  # Online
                 name = info.get("name", "Unknown")
                 status = "🟢"
-                display_text = f"{status} {name} ({user_id})"
+                relayed = "" if user_id in self.connected_users else " ↪"
+                display_text = f"{status} {name}{relayed} ({user_id})"
                 
                 self.contacts_listbox.insert(tk.END, display_text)
                 self.contacts_listbox.itemconfig(tk.END, foreground='#00FF00')
@@ -1188,7 +1083,7 @@ X-GNOME-Autostart-enabled=true
             if user_id == self.user_id:
                 continue
             
-            if user_id not in self.connected_users:  # Offline
+            if not self.reachable(user_id):  # Offline
                 name = info.get("name", "Unknown")
                 status = "⚫"
                 display_text = f"{status} {name} ({user_id})"
@@ -1226,46 +1121,6 @@ X-GNOME-Autostart-enabled=true
         else:
             self.status_label.config(text="✗ User ID not found", fg='#FF0000')
     
-    def try_connect_to_user(self, user_id, ip):
-        """Try to connect to user"""
-        threading.Thread(target=self.connect_thread, args=(user_id, ip), daemon=True).start()
-    
-    def connect_thread(self, user_id, ip):
-        """Thread for connecting to user"""
-        try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(5)
-            client_socket.connect((ip, self.user_port))
-            client_socket.setblocking(False)
-            
-            connect_msg = json.dumps({
-                'type': 'connect',
-                'user_id': self.user_id,
-                'name': self.current_user,
-                'ip': self.user_ip,
-                'file_port': self.file_port
-            })
-            client_socket.send(connect_msg.encode('utf-8'))
-            
-            self.connected_users[user_id] = client_socket
-            
-            if user_id not in self.user_directory:
-                self.user_directory[user_id] = {
-                    "name": "Unknown",
-                    "ip": ip,
-                    "last_seen": datetime.now().isoformat(),
-                    "is_online": True,
-                    "file_port": self.file_port
-                }
-            
-            self.root.after(0, self.status_label.config,
-                          {"text": f"✓ Connected to user", "fg": '#00FF00'})
-            self.root.after(0, self.update_contacts_list)
-            
-        except Exception as e:
-            self.root.after(0, self.status_label.config,
-                          {"text": f"✗ Connection failed: {str(e)}", "fg": '#FF0000'})
-    
     def on_contact_select(self, event):
         """Handle contact selection"""
         selection = self.contacts_listbox.curselection()
@@ -1275,13 +1130,16 @@ X-GNOME-Autostart-enabled=true
         index = selection[0]
         item_text = self.contacts_listbox.get(index)
         
-        if "(" in item_text and ")" in item_text:
+        if item_text.startswith("👥"):
+            self.show_room(item_text[item_text.rfind("[") + 1:item_text.rfind("]")])
+        elif "(" in item_text and ")" in item_text:
             start = item_text.rfind("(") + 1
             end = item_text.rfind(")")
             user_id = item_text[start:end]
             
             if user_id in self.user_directory:
                 self.selected_contact_id = user_id
+                self.selected_room = None
                 user_name = self.user_directory[user_id].get("name", "Unknown")
                 
                 self.chat_display.config(state='normal')
@@ -1289,6 +1147,9 @@ X-GNOME-Autostart-enabled=true
                 self.chat_display.config(state='disabled')
                 
                 self.add_chat_message(f"Chat with {user_name}", "system")
+                connection = self.describe_connection(user_id)
+                if connection:
+                    self.add_chat_message(f"Connection: {connection}", "system")
                 self.add_chat_message(f"Click 📎 to send files", "system")
                 
                 self.message_entry.config(state='normal')
@@ -1334,6 +1195,16 @@ X-GNOME-Autostart-enabled=true
     
     def send_chat_message(self, event=None):
         """Send chat message to selected contact"""
+        if self.selected_room:
+            message = self.message_entry.get().strip()
+            self.message_entry.delete(0, tk.END)
+            if message == '/leave':
+                self.leave_room(self.selected_room)
+            elif message:
+                self.add_chat_message(message, "you")
+                self.send_room_message(self.selected_room, message)
+            return
+        
         if not self.selected_contact_id:
             self.status_label.config(text="✗ Select a contact first", fg='#FF0000')
             return
@@ -1345,32 +1216,86 @@ X-GNOME-Autostart-enabled=true
         self.message_entry.delete(0, tk.END)
         self.add_chat_message(message, "you")
         
-        if self.selected_contact_id in self.connected_users:
-            self.send_message_to_user(self.selected_contact_id, message)
-        else:
-            self.add_chat_message("Contact is not connected", "system")
+        if not self.reachable(self.selected_contact_id):
+            self.add_chat_message("Contact is not connected, the message will be sent when they are", "system")
+            self.schedule_reconnect(self.selected_contact_id)
+        self.send_message_to_user(self.selected_contact_id, message)
     
-    def send_message_to_user(self, user_id, message):
-        """Send message to specific user"""
-        try:
-            if user_id in self.connected_users:
-                msg_data = json.dumps({
-                    'type': 'message',
-                    'from_id': self.user_id,
-                    'from_name': self.current_user,
-                    'message': message,
-                    'timestamp': datetime.now().isoformat()
-                })
-                self.connected_users[user_id].send(msg_data.encode('utf-8'))
-        except:
-            if user_id in self.connected_users:
-                del self.connected_users[user_id]
-            self.update_contacts_list()
-            self.add_chat_message("Connection lost", "system")
+    def show_room_dialog(self):
+        """Create a room, or add people to the selected one"""
+        room_id = self.selected_room
+        members = self.rooms.members_of(room_id) if room_id else {}
+        online = [uid for uid in self.user_directory
+                  if uid in self.connected_users and uid not in members and uid != self.user_id]
+        if not online:
+            messagebox.showwarning("No Contacts Online", "None of your other contacts are connected.")
+            return
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title(f"Add to {self.rooms.name_of(room_id)}" if room_id else "New Room")
+        dialog.configure(bg='#1a1a1a')
+        dialog.transient(self.root)
+        
+        name_entry = tk.Entry(dialog, font=('Arial', 10), bg='#2a2a2a', fg='white', insertbackground='white')
+        if not room_id:
+            name_entry.pack(fill='x', padx=10, pady=(10, 0))
+            name_entry.insert(0, "Team")
+        
+        listbox = tk.Listbox(
+            dialog,
+            font=('Arial', 10),
+            bg='#2a2a2a',
+            fg='white',
+            selectbackground='#3a3a3a',
+            selectmode='multiple',
+            height=10,
+            width=40
+        )
+        listbox.pack(fill='both', expand=True, padx=10, pady=10)
+        for uid in online:
+            listbox.insert('end', f"{self.user_directory[uid].get('name', 'Unknown')} ({uid})")
+        
+        def confirm():
+            user_ids = [online[i] for i in listbox.curselection()]
+            if not user_ids:
+                messagebox.showwarning("No Contacts Selected", "Select at least one contact.", parent=dialog)
+                return
+            dialog.destroy()
+            if room_id:
+                self.invite_to_room(room_id, user_ids)
+            else:
+                self.show_room(self.create_room(name_entry.get().strip() or "Room", user_ids))
+        
+        tk.Button(
+            dialog,
+            text="Add" if room_id else "Create",
+            font=('Arial', 10, 'bold'),
+            fg='white',
+            bg='#4CAF50',
+            command=confirm,
+            width=14
+        ).pack(pady=(0, 10))
     
-    def broadcast_presence(self):
-        """Broadcast presence to network"""
-        pass
+    def show_room(self, room_id):
+        """Open a room in the chat area with its recent history"""
+        if room_id not in self.rooms.rooms:
+            return
+        self.selected_room = room_id
+        self.selected_contact_id = None
+        
+        self.chat_display.config(state='normal')
+        self.chat_display.delete('1.0', tk.END)
+        self.chat_display.config(state='disabled')
+        
+        members = self.rooms.members_of(room_id)
+        self.add_chat_message(f"Room {self.rooms.name_of(room_id)}: {', '.join(members.values())}", "system")
+        for message in self.rooms.catchup(room_id):
+            sender = "you" if message.get('from_id') == self.user_id else message.get('from_name', 'Unknown')
+            self.add_chat_message(message.get('message', ''), sender)
+        self.add_chat_message("Type /leave to leave the room", "system")
+        
+        self.message_entry.config(state='normal')
+        self.send_btn.config(state='normal')
     
     def refresh_contacts(self):
         """Refresh contacts list"""
@@ -1381,130 +1306,11 @@ X-GNOME-Autostart-enabled=true
             fg='#FF8800'
         ))
     
-    def check_messages(self):
-        """Check for incoming messages"""
-        while self.messenger_active:
-            try:
-                sockets = [self.messenger_server] + list(self.connected_users.values())
-                readable, _, _ = select.select(sockets, [], [], 0.1)
-                
-                for sock in readable:
-                    if sock == self.messenger_server:
-                        client_socket, addr = self.messenger_server.accept()
-                        client_socket.setblocking(False)
-                        threading.Thread(target=self.handle_new_connection, 
-                                       args=(client_socket, addr), daemon=True).start()
-                    else:
-                        try:
-                            data = sock.recv(4096)
-                            if data:
-                                self.process_incoming_data(data, sock)
-                            else:
-                                self.remove_connection(sock)
-                        except:
-                            self.remove_connection(sock)
-                
-            except Exception as e:
-                time.sleep(0.1)
-    
-    def handle_new_connection(self, sock, addr):
-        """Handle new incoming connection"""
-        try:
-            sock.settimeout(5)
-            data = sock.recv(1024)
-            sock.setblocking(False)
-            
-            if data:
-                self.process_incoming_data(data, sock)
-        except:
-            sock.close()
-    
-    def process_incoming_data(self, data, sock):
-        """Process incoming data"""
-        try:
-            message = json.loads(data.decode('utf-8'))
-            msg_type = message.get('type')
-            
-            if msg_type == 'connect':
-                user_id = message.get('user_id')
-                user_name = message.get('name')
-                user_ip = message.get('ip')
-                file_port = message.get('file_port', self.file_port)
-                
-                self.user_directory[user_id] = {
-                    "name": user_name,
-                    "ip": user_ip,
-                    "last_seen": datetime.now().isoformat(),
-                    "is_online": True,
-                    "file_port": file_port
-                }
-                
-                self.connected_users[user_id] = sock
-                self.save_config()
-                
-                self.root.after(0, self.update_contacts_list)
-                self.root.after(0, self.add_chat_message,
-                              f"{user_name} connected", "system")
-                
-                response = json.dumps({
-                    'type': 'connect_ack',
-                    'user_id': self.user_id,
-                    'name': self.current_user,
-                    'ip': self.user_ip,
-                    'file_port': self.file_port
-                })
-                sock.send(response.encode('utf-8'))
-            
-            elif msg_type == 'connect_ack':
-                user_id = message.get('user_id')
-                user_name = message.get('name')
-                user_ip = message.get('ip')
-                file_port = message.get('file_port', self.file_port)
-                
-                self.user_directory[user_id] = {
-                    "name": user_name,
-                    "ip": user_ip,
-                    "last_seen": datetime.now().isoformat(),
-                    "is_online": True,
-                    "file_port": file_port
-                }
-                
-                self.save_config()
-                self.root.after(0, self.update_contacts_list)
-                self.root.after(0, self.add_chat_message,
-                              f"Connected to {user_name}", "system")
-            
-            elif msg_type == 'message':
-                from_id = message.get('from_id')
-                from_name = message.get('from_name')
-                msg_text = message.get('message')
-                
-                if from_id in self.user_directory:
-                    self.user_directory[from_id]['last_seen'] = datetime.now().isoformat()
-                    self.user_directory[from_id]['is_online'] = True
-                
-                if from_id == self.selected_contact_id:
-                    self.root.after(0, self.add_chat_message, msg_text, from_name)
-                else:
-                    self.root.after(0, self.add_chat_message,
-                                  f"New message from {from_name}", "system")
-            
-            elif msg_type == 'file_request':
-                from_id = message.get('from_id')
-                from_name = message.get('from_name')
-                filename = message.get('filename')
-                filesize = message.get('filesize')
-                transfer_id = message.get('transfer_id')
-                
-                # Ask user to accept file
-                self.root.after(0, self.show_file_request_dialog,
-                              from_id, from_name, filename, filesize, transfer_id)
-                
-        except json.JSONDecodeError:
-            pass
-    
     def show_file_request_dialog(self, from_id, from_name, filename, filesize, transfer_id):
         """Show dialog to accept/reject file transfer"""
+        offer = self.pending_offers.get((from_id, transfer_id))
+        if offer is None:
+            return  # already answered, withdrawn or timed out
         filesize_mb = filesize / 1024 / 1024
         
         # Create a dialog window
@@ -1514,6 +1320,7 @@ X-GNOME-Autostart-enabled=true
         dialog.geometry("400x200")
         dialog.transient(self.root)
         dialog.grab_set()
+        offer['dialog'] = dialog
         
         # Center the dialog
         dialog.update_idletasks()
@@ -1527,6 +1334,9 @@ X-GNOME-Autostart-enabled=true
         message = f"{from_name} wants to send you a file:\n\n"
         message += f"📁 {filename}\n"
         message += f"📏 Size: {filesize_mb:.1f} MB\n\n"
+        has_room = self.has_room_for(filesize)
+        if not has_room:
+            message += f"⚠ Not enough disk space ({self.free_disk_space()/1024/1024:.0f} MB free)\n\n"
         message += "Do you want to accept this file?"
         
         label = tk.Label(
@@ -1544,39 +1354,12 @@ X-GNOME-Autostart-enabled=true
         button_frame.pack(pady=10)
         
         def accept_file():
-            # Create transfer entry
-            self.file_transfers[transfer_id] = {
-                'type': 'receiving',
-                'filename': filename,
-                'size': filesize,
-                'progress': 0,
-                'status': 'pending',
-                'user_id': from_id
-            }
-            self.update_transfers_display()
-            
-            # Send acceptance
-            if from_id in self.connected_users:
-                response = json.dumps({
-                    'type': 'file_accept',
-                    'transfer_id': transfer_id
-                })
-                self.connected_users[from_id].send(response.encode('utf-8'))
-            
-            dialog.destroy()
-            self.add_chat_message(f"Accepting file: {filename}", "system")
+            if self.accept_offer((from_id, transfer_id)):
+                self.add_chat_message(f"Accepting file: {filename}", "system")
         
         def reject_file():
-            # Send rejection
-            if from_id in self.connected_users:
-                response = json.dumps({
-                    'type': 'file_reject',
-                    'transfer_id': transfer_id
-                })
-                self.connected_users[from_id].send(response.encode('utf-8'))
-            
-            dialog.destroy()
-            self.add_chat_message(f"Rejected file: {filename}", "system")
+            if self.reject_offer((from_id, transfer_id)):
+                self.add_chat_message(f"Rejected file: {filename}", "system")
         
         accept_btn = tk.Button(
             button_frame,
@@ -1588,6 +1371,8 @@ X-GNOME-Autostart-enabled=true
             width=10
         )
         accept_btn.pack(side='left', padx=10)
+        if not has_room:
+            accept_btn.config(state='disabled')
         
         reject_btn = tk.Button(
             button_frame,
@@ -1600,59 +1385,17 @@ X-GNOME-Autostart-enabled=true
         )
         reject_btn.pack(side='left', padx=10)
         
-        # Auto-reject after 30 seconds
-        def auto_reject():
-            if dialog.winfo_exists():
-                reject_file()
-        
-        dialog.after(30000, auto_reject)
+        # receive_offer() auto-rejects after 30 seconds and closes this dialog
+        dialog.protocol("WM_DELETE_WINDOW", reject_file)
     
-    def remove_connection(self, sock):
-        """Remove a connection"""
-        user_id_to_remove = None
-        for user_id, user_sock in self.connected_users.items():
-            if user_sock == sock:
-                user_id_to_remove = user_id
-                break
-        
-        if user_id_to_remove:
-            del self.connected_users[user_id_to_remove]
-            
-            if user_id_to_remove in self.user_directory:
-                self.user_directory[user_id_to_remove]['is_online'] = False
-            
-            self.root.after(0, self.update_contacts_list)
-            self.root.after(0, self.add_chat_message,
-                          f"User disconnected", "system")
-        
-        try:
-            sock.close()
-        except:
-            pass
+    def close_offer_dialog(self, offer):
+        dialog = offer['dialog']
+        if dialog is not None:
+            self.root.after(0, lambda: dialog.winfo_exists() and dialog.destroy())
     
     def on_closing(self):
         """Clean shutdown"""
-        self.messenger_active = False
-        
-        # Close all connections
-        for sock in self.connected_users.values():
-            try:
-                sock.close()
-            except:
-                pass
-        
-        if self.messenger_server:
-            try:
-                self.messenger_server.close()
-            except:
-                pass
-        
-        if self.file_server:
-            try:
-                self.file_server.close()
-            except:
-                pass
-        
+        self.shutdown()
         self.root.destroy()
         sys.exit(0)
     
@@ -0,0 +1,3040 @@
+from datetime import datetime
+import os
+import platform
+import threading
+import time
+import json
+import socket
+import select
+import hashlib
+import getpass
+import argparse
+import signal
+import base64
+import uuid
+import struct
+import random
+import zlib
+import errno
+import shutil
+import collections
+import heapq
+from transport import (FrameDecoder, MuxSession, MuxStream, PeerWriter, FairShare, TokenBucket,
+                       SharedFileReader, KIND_MESSAGE, FLAG_COMPRESSED, PRIORITY_CONTROL, PRIORITY_CHAT,
+                       PRIORITY_BULK, send_all, recv_exact, encode_message, encode_frame)
+import delta
+import compression
+import striping
+from transfers import TransferRegistry
+from rooms import RoomIndex
+from outbox import Outbox
+from delivery import SendWindow, ReceiveWindow
+from routing import RouteTable, SeenCache, ROUTABLE, MAX_HOPS
+import gossip
+import handshake
+import ipc
+import tls
+from admission import AdmissionControl, PendingConnection
+
+
+class Scheduler:
+    """Runs callbacks after a delay on one thread, in place of Tk's after()"""
+    
+    def __init__(self):
+        self.queue = []  # (due, seq, func, args)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.thread = None
+    
+    def after(self, ms, func, *args):
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.queue, (time.monotonic() + ms / 1000, self.seq, func, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue or self.queue[0][0] > time.monotonic():
+                    # Sleeps until the next callback is due, no polling while idle
+                    self.cond.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+                _, _, func, args = heapq.heappop(self.queue)
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Scheduled call {getattr(func, '__name__', func)} failed: {e}")
+
+
+class MessengerCore:
+    """Network engine: connections, transfers, rooms, delivery and storage.
+    
+    Runs without a display. Front-ends subclass it and override the hooks
+    (add_chat_message, update_contacts_list, show_file_request_dialog, ...),
+    which default to logging or doing nothing.
+    """
+    
+    def __init__(self):
+        # User and connection state
+        self.current_user = None
+        self.user_id = None
+        self.user_ip = None
+        self.user_port = 12345
+        self.file_port = 12346  # Separate port for file transfers
+        
+        # Messenger state
+        self.messenger_active = False
+        self.messenger_server = None
+        self.file_server = None
+        self.connected_users = {}  # user_id: socket
+        self.user_directory = {}   # user_id: {"name": "", "ip": "", "last_seen": ""}
+        
+        # Group rooms
+        self.rooms = RoomIndex()
+        self.room_sync_times = {}  # room_id: when we last asked a member for missed messages
+        self.rooms_save_pending = False
+        
+        # Directory gossip: peers swap digests and pull the entries they miss
+        self.gossip_interval = 30     # seconds between comparisons with a random peer
+        self.gossip_batch = 200       # entries per dir_entries message
+        self.directory_digest = None  # DirectoryDigest, rebuilt after a version changes
+        self.directory_save_pending = False
+        
+        # Store-and-forward: messages for offline contacts wait in an outbox
+        self.outbox = None          # Outbox, opened once the app data folder exists
+        self.outbox_lock = threading.Lock()
+        self.outbox_batch = 50      # queued messages sent per batch while draining
+        self.outbox_pace = 0.05     # seconds to wait for acks while the send window is full
+        self.outbox_flush_pending = False
+        self.draining = set()       # user_ids with a drain running
+        self.pending_acks = {}      # user_id: msg_ids of their unnumbered messages to acknowledge
+        self.seen_message_ids = collections.OrderedDict()  # recent msg_ids, to drop resent copies
+        self.max_seen_message_ids = 10000
+        
+        # Delivery: chat messages are numbered per peer and kept until acked
+        self.delivery_epoch = uuid.uuid4().hex[:8]  # new each start, receivers reset their counters
+        self.send_windows = {}      # user_id: SendWindow
+        self.receive_windows = {}   # user_id: ReceiveWindow
+        self.max_in_flight = 256    # unacked messages per peer, the rest wait in the outbox
+        self.resend_pending = set() # user_ids whose unacked messages go out again
+        self.ack_delay = 200        # ms before acking, so a burst shares one ack
+        self.ack_every = 32         # ...unless this many are waiting
+        
+        # File transfer state
+        self.file_transfers = TransferRegistry()  # our ID or (sender_id, their ID): record
+        self.max_file_size_mb = 100
+        self.disk_reserve = 50 * 1024 * 1024  # free space to leave after a download
+        
+        # File offers: nothing is streamed until the recipient accepts
+        self.pending_offers = {}  # (from_id, transfer_id): incoming offer awaiting the user
+        self.offer_reply_timeout = 30  # seconds before an unanswered offer is rejected
+        self.offer_timeout = 60        # seconds a sender waits for an answer
+        self.inline_file_limit = 64 * 1024  # files up to this size travel with the offer
+        self.prewarm_channels = False  # connect the data channel while the user decides
+        self.received_files = {}  # "sender_id/filename": latest saved copy, basis for deltas
+        self.max_received_index = 1000
+        
+        # Striping: large files spread over several address pairs (opt-in)
+        self.striping_enabled = False
+        self.stripe_addresses = []  # our addresses to stripe over, empty = detect
+        self.peer_addresses = {}    # user_id: addresses the peer advertised
+        self.max_stripes = 4
+        self.stripe_min_size = 16 * 1024 * 1024
+        self.stripe_sinks = {}      # (sender_id, transfer_id): StripeSink of a running download
+        
+        # Outgoing transfer queue
+        self.transfer_queue = []       # transfer_ids waiting for a slot
+        self.transfer_lock = threading.Lock()
+        self.active_sends = {}         # user_id: running outgoing transfers
+        self.max_active_transfers = 4
+        self.max_transfers_per_peer = 2
+        self.transfer_seq = 0
+        self.fair_share = FairShare()  # splits bandwidth between running sends
+        
+        # Bandwidth limits in KB/s, 0 = unlimited
+        self.rate_limits = {'upload': 0, 'download': 0, 'peer_upload': 0, 'peer_download': 0}
+        self.rate_buckets = {'upload': TokenBucket(), 'download': TokenBucket()}
+        self.peer_buckets = {}  # (direction, user_id): TokenBucket
+        self.buckets_lock = threading.Lock()
+        
+        # Reconnect state
+        self.reconnect_state = {}  # user_id: {"attempts": n, "next_try": timestamp}
+        self.reconnect_lock = threading.Lock()
+        self.reconnect_wakeup = threading.Event()
+        self.dialing = set()       # user_ids with a dial in flight
+        self.dial_times = {}       # user_id: time of our last successful dial
+        self.max_parallel_dials = 8
+        self.dial_timeout = 3
+        self.reconnect_base_delay = 1.0
+        self.reconnect_max_delay = 60.0
+        
+        # Relay hub (hub.py): users it reports are reached through it
+        # unless we have a direct connection
+        self.hub_address = ''      # "host" or "host:port", empty = full mesh only
+        self.hub_socket = None
+        self.hub_users = set()     # user_ids online at the hub
+        
+        # Multi-hop: reach users on other segments through peers that relay
+        self.forwarding_enabled = False  # relay for others (opt-in), routes are used either way
+        self.routes = RouteTable()
+        self.route_seen = SeenCache()   # routed message IDs, drops copies and loops
+        self.sent_adverts = {}          # neighbour_id: routes we last told them
+        self.advert_pending = False
+        self.hub_wakeup = threading.Event()
+        
+        # Local control API for scripts (Unix socket in the app data folder)
+        self.ipc_enabled = True
+        self.ipc_server = None
+        self.event_handlers = []  # callables(event, data) for inbound events
+        
+        # Encryption (tls.py): certificates pinned per user_id, plaintext
+        # only with peers that don't offer it unless encryption is required
+        self.encryption_enabled = True
+        self.require_encryption = False
+        self.tls = None  # TlsIdentity once the network starts
+        
+        # Listeners under connection floods: new chat connections finish
+        # their handshake on the message loop within handshake_timeout, and
+        # each address may only open so many connections so fast
+        self.listen_backlog = 128
+        self.handshake_timeout = 5.0
+        self.max_pending_handshakes = 256
+        self.accept_rate = 20                  # new connections per second from one address, 0 = no limit
+        self.accept_burst = 40
+        self.max_handshakes_per_ip = 8         # chat connections from one address still in their handshake
+        self.max_file_connections_per_ip = 64  # file and stripe connections open at once from one address
+        self.pending = {}  # accepted socket: PendingConnection
+        
+        # Wire state
+        self.multiplex_enabled = True  # carry chat and files over one connection
+        self.compression_enabled = True
+        self.peer_features = {}  # user_id: {'protocol': n, 'caps': set} negotiated in the handshake
+        self.mux_sessions = {}  # socket: MuxSession, for peers that multiplex
+        self.decoders = {}      # socket: FrameDecoder
+        self.peer_writers = {}  # socket: PeerWriter, serializes and prioritizes writes
+        self.writers_lock = threading.Lock()
+        
+        # Platform-specific paths
+        self.system = platform.system()
+        
+        # Configuration files
+        if self.system == "Windows":
+            self.app_data_dir = os.path.join(os.getenv('APPDATA'), 'LocalMessenger')
+            self.download_dir = os.path.join(os.getenv('USERPROFILE'), 'Downloads', 'Operation')
+        else:  # Linux, macOS, etc.
+            self.app_data_dir = os.path.expanduser("~/.localmessenger")
+            self.download_dir = os.path.expanduser("~/Downloads/Operation")
+        
+        self.config_file = os.path.join(self.app_data_dir, 'config.json')
+        self.contacts_file = os.path.join(self.app_data_dir, 'contacts.json')
+        self.received_index_file = os.path.join(self.app_data_dir, 'received.json')
+        self.rooms_file = os.path.join(self.app_data_dir, 'rooms.json')
+        
+        # Create app data directory
+        os.makedirs(self.app_data_dir, exist_ok=True)
+        os.makedirs(self.download_dir, exist_ok=True)
+        self.outbox = Outbox(os.path.join(self.app_data_dir, 'outbox'))
+        
+        # Load configuration
+        self.load_config()
+        self.apply_rate_limits()
+        self.chat_admission = AdmissionControl(self.accept_rate, self.accept_burst, self.max_handshakes_per_ip)
+        self.file_admission = AdmissionControl(self.accept_rate, self.accept_burst, self.max_file_connections_per_ip)
+        self.scheduler = Scheduler()
+        self.selector_wakeup = socket.socketpair()  # nudges check_messages when sockets are added
+    
+    def call_later(self, ms, func, *args):
+        """Run func after ms milliseconds (on the Tk thread in the GUI)"""
+        self.scheduler.after(ms, func, *args)
+    
+    # Front-end hooks. Headless, events are logged and prompts are left to
+    # time out (incoming file offers are rejected after offer_reply_timeout).
+    
+    def add_chat_message(self, message, sender="system"):
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] {sender}: {message}")
+    
+    def on_chat_message(self, from_id, from_name, text):
+        """A direct message arrived"""
+        self.add_chat_message(text, from_name)
+    
+    def on_room_chat(self, room_id, message):
+        """A new message in one of our rooms"""
+        self.add_chat_message(f"[{self.rooms.name_of(room_id)}] {message.get('message', '')}", message.get('from_name'))
+    
+    def set_status(self, text, color=None):
+        pass
+    
+    def update_contacts_list(self):
+        pass
+    
+    def update_transfers_display(self):
+        pass
+    
+    def show_file_request_dialog(self, from_id, from_name, filename, filesize, transfer_id):
+        self.add_chat_message(f"File offer from {from_name}: {filename} ({filesize} bytes)", "system")
+    
+    def close_offer_dialog(self, offer):
+        pass
+    
+    def show_file_received_notification(self, filepath, filename):
+        pass
+    
+    def start_network(self):
+        """Open the servers and start the background threads"""
+        self.setup_encryption()
+        self.start_messenger_server()
+        self.start_file_server()
+        
+        self.messenger_active = True
+        threading.Thread(target=self.check_messages, daemon=True).start()
+        threading.Thread(target=self.check_file_transfers, daemon=True).start()
+        
+        # Broadcast presence
+        self.broadcast_presence()
+        
+        # Reconnect to known contacts
+        self.publish_own_record()
+        self.start_reconnect_manager()
+        threading.Thread(target=self.gossip_loop, daemon=True).start()
+        if self.hub_address:
+            threading.Thread(target=self.hub_link_loop, daemon=True).start()
+        if self.ipc_enabled and hasattr(socket, 'AF_UNIX'):
+            self.start_ipc_server()
+    
+    def setup_encryption(self):
+        """Load or create our certificate"""
+        if not self.encryption_enabled:
+            return
+        try:
+            self.tls = tls.TlsIdentity(self.app_data_dir, self.user_id)
+        except Exception as e:
+            print(f"Encryption unavailable, connections stay plaintext: {e}")
+    
+    def wants_tls(self, user_id):
+        """Whether to dial a user with TLS: unless they are known not to speak it"""
+        return self.tls is not None and self.user_directory.get(user_id, {}).get('tls', True)
+    
+    def secure_channel(self, sock, user_id, timeout=30):
+        """Encrypt a new file or stripe connection to a user that speaks TLS"""
+        if self.tls is not None and self.user_directory.get(user_id, {}).get('tls'):
+            # Resume the chat connection's session instead of a full handshake
+            chat = self.connected_users.get(user_id)
+            if isinstance(chat, tls.TlsSocket) and chat.peer_id == user_id:
+                self.tls.save_session(user_id, chat)
+            return self.tls.dial(sock, user_id, timeout)
+        if self.require_encryption:
+            raise ConnectionError(f"{user_id} does not support encryption")
+        return sock
+    
+    def accept_tls(self, sock, timeout):
+        """Take the TLS handshake of an accepted connection, if it starts one"""
+        if tls.sniff(sock, timeout):
+            if self.tls is None:
+                raise ConnectionError("TLS connection while encryption is off")
+            return self.tls.accept(sock, timeout)
+        return sock
+    
+    def admit_peer(self, user_id, sock):
+        """Whether a connection may speak for user_id.
+        
+        Users with a pinned certificate must connect with TLS and show it;
+        anyone else is let in (unverified) unless encryption is required.
+        """
+        if isinstance(sock, tls.TlsSocket):
+            if sock.peer_id is not None:
+                ok = sock.peer_id == user_id  # we checked the pin when dialing
+            else:
+                ok = not self.tls.pinned(user_id) or self.tls.verified_id(sock) == user_id
+            if not ok:
+                print(f"Rejected connection claiming to be {user_id}: certificate does not match")
+            return ok
+        if sock is self.hub_socket or isinstance(sock, MuxStream):
+            return True
+        if self.require_encryption or (self.tls is not None and self.tls.pinned(user_id)):
+            print(f"Rejected unencrypted connection from {user_id}")
+            return False
+        return True
+    
+    def start_ipc_server(self):
+        server = ipc.IpcServer(self, ipc.default_path(self.app_data_dir))
+        try:
+            server.start()
+        except OSError as e:
+            print(f"Control socket not started: {e}")
+            return
+        self.ipc_server = server
+        self.event_handlers.append(server.emit)
+    
+    def emit(self, event, data):
+        """Pass an inbound event to API subscribers"""
+        for handler in self.event_handlers:
+            try:
+                handler(event, data)
+            except Exception as e:
+                print(f"Event handler failed: {e}")
+    
+    def wake_selector(self):
+        """Have check_messages pick up a socket added from another thread"""
+        try:
+            self.selector_wakeup[1].send(b'\0')
+        except OSError:
+            pass
+    
+    def generate_user_id(self, username):
+        """Generate unique user ID based on username and machine"""
+        machine_id = platform.node()  # Computer name
+        timestamp = str(time.time())
+        combined = f"{username}_{machine_id}_{timestamp}"
+        return hashlib.md5(combined.encode()).hexdigest()[:8]  # 8-char user ID
+    
+    def get_local_ip(self):
+        """Get local IP address - cross-platform"""
+        try:
+            if self.system == "Windows":
+                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                s.connect(("8.8.8.8", 80))
+                local_ip = s.getsockname()[0]
+                s.close()
+            else:  # Linux/macOS
+                # Try multiple methods for Linux
+                try:
+                    import netifaces
+                    for interface in netifaces.interfaces():
+                        addrs = netifaces.ifaddresses(interface)
+                        if netifaces.AF_INET in addrs:
+                            for addr_info in addrs[netifaces.AF_INET]:
+                                ip = addr_info['addr']
+                                if ip != '127.0.0.1' and not ip.startswith('169.254'):
+                                    return ip
+                except ImportError:
+                    # Fallback method
+                    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    s.connect(("8.8.8.8", 80))
+                    local_ip = s.getsockname()[0]
+                    s.close()
+            return local_ip
+        except:
+            return "127.0.0.1"
+    
+    def local_addresses(self):
+        """Our IPv4 addresses, one per usable interface, for striped transfers"""
+        if self.stripe_addresses:
+            return list(self.stripe_addresses)
+        addresses = []
+        try:
+            import netifaces
+            for interface in netifaces.interfaces():
+                for addr_info in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []):
+                    ip = addr_info['addr']
+                    if not ip.startswith('127.') and not ip.startswith('169.254') and ip not in addresses:
+                        addresses.append(ip)
+        except ImportError:
+            pass
+        return addresses or [self.user_ip]
+    
+    def load_config(self):
+        """Load saved configuration"""
+        try:
+            if os.path.exists(self.config_file):
+                with open(self.config_file, 'r') as f:
+                    config = json.load(f)
+                    self.current_user = config.get('username')
+                    self.user_id = config.get('user_id')
+                    self.user_ip = config.get('user_ip')
+                    self.user_port = config.get('port', 12345)
+                    self.max_parallel_dials = config.get('max_parallel_dials', self.max_parallel_dials)
+                    self.multiplex_enabled = config.get('multiplex', self.multiplex_enabled)
+                    self.compression_enabled = config.get('compression', self.compression_enabled)
+                    self.max_active_transfers = config.get('max_active_transfers', self.max_active_transfers)
+                    self.max_transfers_per_peer = config.get('max_transfers_per_peer', self.max_transfers_per_peer)
+                    self.rate_limits.update(config.get('rate_limits', {}))
+                    self.max_file_size_mb = config.get('max_file_size_mb', self.max_file_size_mb)
+                    self.inline_file_limit = config.get('inline_file_limit', self.inline_file_limit)
+                    self.prewarm_channels = config.get('prewarm_channels', self.prewarm_channels)
+                    self.striping_enabled = config.get('striping', self.striping_enabled)
+                    self.stripe_addresses = config.get('stripe_addresses', self.stripe_addresses)
+                    self.max_stripes = config.get('max_stripes', self.max_stripes)
+                    self.hub_address = config.get('hub', self.hub_address)
+                    self.forwarding_enabled = config.get('forwarding', self.forwarding_enabled)
+                    self.ipc_enabled = config.get('ipc', self.ipc_enabled)
+                    self.encryption_enabled = config.get('encryption', self.encryption_enabled)
+                    self.require_encryption = config.get('require_encryption', self.require_encryption)
+                    self.listen_backlog = config.get('listen_backlog', self.listen_backlog)
+                    self.handshake_timeout = config.get('handshake_timeout', self.handshake_timeout)
+                    self.accept_rate = config.get('accept_rate', self.accept_rate)
+                    self.accept_burst = config.get('accept_burst', self.accept_burst)
+                    self.max_handshakes_per_ip = config.get('max_handshakes_per_ip', self.max_handshakes_per_ip)
+                    self.max_file_connections_per_ip = config.get('max_file_connections_per_ip',
+                                                                  self.max_file_connections_per_ip)
+            
+            if os.path.exists(self.contacts_file):
+                with open(self.contacts_file, 'r') as f:
+                    self.user_directory = json.load(f)
+            
+            if os.path.exists(self.received_index_file):
+                with open(self.received_index_file, 'r') as f:
+                    self.received_files = json.load(f)
+            
+            if os.path.exists(self.rooms_file):
+                with open(self.rooms_file, 'r') as f:
+                    self.rooms.load_json(json.load(f))
+        except:
+            pass
+    
+    def save_config(self):
+        """Save configuration"""
+        config = {
+            'username': self.current_user,
+            'user_id': self.user_id,
+            'user_ip': self.user_ip,
+            'port': self.user_port,
+            'max_parallel_dials': self.max_parallel_dials,
+            'multiplex': self.multiplex_enabled,
+            'compression': self.compression_enabled,
+            'max_active_transfers': self.max_active_transfers,
+            'max_transfers_per_peer': self.max_transfers_per_peer,
+            'rate_limits': self.rate_limits,
+            'max_file_size_mb': self.max_file_size_mb,
+            'inline_file_limit': self.inline_file_limit,
+            'prewarm_channels': self.prewarm_channels,
+            'striping': self.striping_enabled,
+            'stripe_addresses': self.stripe_addresses,
+            'max_stripes': self.max_stripes,
+            'hub': self.hub_address,
+            'forwarding': self.forwarding_enabled,
+            'ipc': self.ipc_enabled,
+            'encryption': self.encryption_enabled,
+            'require_encryption': self.require_encryption,
+            'listen_backlog': self.listen_backlog,
+            'handshake_timeout': self.handshake_timeout,
+            'accept_rate': self.accept_rate,
+            'accept_burst': self.accept_burst,
+            'max_handshakes_per_ip': self.max_handshakes_per_ip,
+            'max_file_connections_per_ip': self.max_file_connections_per_ip
+        }
+        with open(self.config_file, 'w') as f:
+            json.dump(config, f, indent=2)
+        
+        # Save contacts
+        with open(self.contacts_file, 'w') as f:
+            json.dump(self.user_directory, f, indent=2)
+    
+    def start_messenger_server(self):
+        """Start server to listen for connections"""
+        try:
+            self.messenger_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.messenger_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.messenger_server.bind(('0.0.0.0', self.user_port))
+            self.messenger_server.listen(self.listen_backlog)
+            self.messenger_server.setblocking(False)
+        except Exception as e:
+            print(f"Error starting messenger server: {e}")
+    
+    def start_file_server(self):
+        """Start file transfer server"""
+        try:
+            self.file_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.file_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.file_server.bind(('0.0.0.0', self.file_port))
+            self.file_server.listen(self.listen_backlog)
+            self.file_server.setblocking(False)
+        except Exception as e:
+            print(f"Error starting file server: {e}")
+    
+    def send_file_to_many(self, user_ids, filepath, priority=1):
+        """Send one file to several users, reading each block from disk once"""
+        user_ids = [uid for uid in user_ids if uid in self.connected_users]
+        if len(user_ids) < 2 or os.path.isdir(filepath):
+            for user_id in user_ids:
+                self.send_file(user_id, filepath, priority)
+            return
+        
+        try:
+            reader = SharedFileReader(filepath)
+        except OSError as e:
+            self.add_chat_message(f"Error sending file: {str(e)}", "system")
+            return
+        
+        for user_id in user_ids:
+            self.send_file(user_id, filepath, priority, reader)
+        reader.close_if_idle()
+    
+    def send_file(self, user_id, filepath, priority=1, shared_reader=None):
+        """Send a file to a user (priority 0 = urgent, 2 = background).
+        
+        Callable from any thread (the IPC server uses it), front-end hooks
+        go through call_later.
+        """
+        try:
+            if not os.path.exists(filepath):
+                self.call_later(0, self.add_chat_message, f"File not found: {filepath}", "system")
+                return
+            
+            filename = os.path.basename(os.path.normpath(filepath))
+            entries = None
+            if os.path.isdir(filepath):
+                entries = self.directory_entries(filepath)
+                filesize = self.directory_stream_size(entries)
+            else:
+                filesize = os.path.getsize(filepath)
+            
+            if filesize > self.max_file_size_mb * 1024 * 1024:
+                self.call_later(0, self.add_chat_message,
+                                f"File too large: {filename} ({filesize/1024/1024:.1f}MB)", "system")
+                return
+            
+            # Generate transfer ID
+            transfer_id = self.file_transfers.new_id()
+            
+            # Add to transfers
+            self.file_transfers.add(transfer_id, {
+                'type': 'sending',
+                'filename': filename,
+                'size': filesize,
+                'progress': 0,
+                'status': 'offered',
+                'user_id': user_id,
+                'filepath': filepath,
+                'priority': priority,
+                'bytes_done': 0,
+                'cancelled': False,
+                'resume_event': threading.Event(),
+                'entries': entries
+            })
+            self.file_transfers[transfer_id]['resume_event'].set()
+            if shared_reader:
+                # One of several recipients reading from the same blocks
+                self.file_transfers[transfer_id]['shared_reader'] = shared_reader
+                shared_reader.attach(transfer_id)
+            
+            # Update transfers display
+            self.call_later(0, self.update_transfers_display)
+            
+            # Send file request
+            if user_id in self.connected_users:
+                request = {
+                    'type': 'file_request',
+                    'from_id': self.user_id,
+                    'from_name': self.current_user,
+                    'filename': filename,
+                    'filesize': filesize,
+                    'directory': entries is not None,
+                    'transfer_id': transfer_id
+                }
+                # Small files ride along with the offer, saving a round trip
+                if entries is None and filesize <= self.inline_file_limit:
+                    with open(filepath, 'rb') as f:
+                        request['data'] = base64.b64encode(f.read()).decode('ascii')
+                self.send_control(user_id, request, PRIORITY_CONTROL)
+                
+                if entries is not None:
+                    self.call_later(0, self.add_chat_message,
+                                    f"📂 Sending folder: {filename} ({len(entries)} entries, "
+                                    f"{filesize/1024/1024:.1f}MB)", "system")
+                else:
+                    self.call_later(0, self.add_chat_message,
+                                    f"📁 Sending file: {filename} ({filesize/1024/1024:.1f}MB)", "system")
+                self.call_later(0, self.set_status, f"📁 Sending file: {filename}", '#00FF00')
+                
+                # The transfer is queued once the recipient accepts
+                self.call_later(self.offer_timeout * 1000, lambda: self.expire_offer(transfer_id))
+                if (self.prewarm_channels and 'data' not in request
+                        and self.connected_users[user_id] not in self.mux_sessions):
+                    threading.Thread(target=self.prewarm_channel, args=(transfer_id,), daemon=True).start()
+                return transfer_id
+            else:
+                self.call_later(0, self.add_chat_message, f"User not connected", "system")
+                if shared_reader:
+                    shared_reader.release(transfer_id)
+                del self.file_transfers[transfer_id]
+        
+        except Exception as e:
+            self.call_later(0, self.add_chat_message, f"Error sending file: {str(e)}", "system")
+    
+    def on_offer_accepted(self, message):
+        """Recipient accepted: queue the data transfer, or finish if it was inlined"""
+        transfer_id = message.get('transfer_id')
+        transfer = self.file_transfers.get(transfer_id)
+        if not transfer or transfer['type'] != 'sending' or transfer['status'] != 'offered':
+            return
+        if message.get('from_id', transfer['user_id']) != transfer['user_id']:
+            return
+        
+        if message.get('received'):
+            transfer['progress'] = 100
+            transfer['bytes_done'] = transfer['size']
+            self.end_offer(transfer_id, 'completed')
+            self.call_later(0, self.add_chat_message, f"✓ File sent: {transfer['filename']}", "system")
+        else:
+            transfer['status'] = 'queued'
+            self.enqueue_transfer(transfer_id)
+    
+    def on_offer_rejected(self, message):
+        transfer_id = message.get('transfer_id')
+        transfer = self.file_transfers.get(transfer_id)
+        if not transfer or transfer['type'] != 'sending' or transfer['status'] != 'offered':
+            return
+        if message.get('from_id', transfer['user_id']) != transfer['user_id']:
+            return
+        self.end_offer(transfer_id, 'rejected')
+        name = self.user_directory.get(transfer['user_id'], {}).get('name', 'Recipient')
+        self.call_later(0, self.add_chat_message, f"✗ {name} declined {transfer['filename']}", "system")
+    
+    def expire_offer(self, transfer_id):
+        transfer = self.file_transfers.get(transfer_id)
+        if transfer and transfer['status'] == 'offered':
+            self.end_offer(transfer_id, 'failed')
+            self.add_chat_message(f"✗ No answer to file offer: {transfer['filename']}", "system")
+    
+    def end_offer(self, transfer_id, status):
+        """Settle an offer that never reached the transfer queue"""
+        transfer = self.file_transfers[transfer_id]
+        transfer['status'] = status
+        if 'shared_reader' in transfer:
+            transfer['shared_reader'].release(transfer_id)
+        channel = self.take_prewarmed_channel(transfer_id)
+        if channel is not None:
+            try:
+                channel.close()
+            except:
+                pass
+        self.call_later(0, self.update_transfers_display)
+    
+    def prewarm_channel(self, transfer_id):
+        """Connect the data channel while the recipient decides"""
+        transfer = self.file_transfers[transfer_id]
+        try:
+            channel = self.open_transfer_channel(transfer['user_id'])
+        except Exception:
+            return  # the transfer will connect normally
+        with self.transfer_lock:
+            if transfer['status'] in ('offered', 'queued') and transfer.get('channel') is None:
+                transfer['channel'] = channel
+                transfer['channel_opened_at'] = time.time()
+                channel = None
+        if channel is not None:
+            channel.close()
+    
+    def take_prewarmed_channel(self, transfer_id):
+        """The pre-connected data channel, if one is still fresh"""
+        transfer = self.file_transfers[transfer_id]
+        with self.transfer_lock:
+            channel = transfer.get('channel')
+            transfer['channel'] = None
+        # The receiver drops idle channels after offer_timeout
+        if channel is not None and time.time() - transfer['channel_opened_at'] > self.offer_timeout - 5:
+            channel.close()
+            channel = None
+        return channel
+    
+    def enqueue_transfer(self, transfer_id):
+        """Queue an outgoing transfer behind the concurrency limits"""
+        with self.transfer_lock:
+            self.file_transfers[transfer_id]['seq'] = self.transfer_seq
+            self.transfer_seq += 1
+            self.transfer_queue.append(transfer_id)
+        self.dispatch_transfers()
+    
+    def dispatch_transfers(self):
+        """Start queued transfers while global and per-peer slots are free"""
+        started = []
+        with self.transfer_lock:
+            # Priority first, then first come first served
+            self.transfer_queue.sort(key=lambda tid: (self.file_transfers[tid]['priority'],
+                                                      self.file_transfers[tid]['seq']))
+            running = sum(self.active_sends.values())
+            for transfer_id in list(self.transfer_queue):
+                transfer = self.file_transfers[transfer_id]
+                # Recipients of a shared read start together so they stay in step
+                if running >= self.max_active_transfers and 'shared_reader' not in transfer:
+                    continue
+                if not transfer['resume_event'].is_set():
+                    continue  # paused while queued
+                if self.active_sends.get(transfer['user_id'], 0) >= self.max_transfers_per_peer:
+                    continue
+                self.transfer_queue.remove(transfer_id)
+                self.active_sends[transfer['user_id']] = self.active_sends.get(transfer['user_id'], 0) + 1
+                running += 1
+                transfer['status'] = 'uploading'
+                transfer['queue_position'] = None
+                started.append(transfer_id)
+            
+            for position, transfer_id in enumerate(self.transfer_queue, 1):
+                self.file_transfers[transfer_id]['queue_position'] = position
+        
+        for transfer_id in started:
+            transfer = self.file_transfers[transfer_id]
+            threading.Thread(target=self.send_file_thread,
+                           args=(transfer['user_id'], transfer['filepath'], transfer_id),
+                           daemon=True).start()
+        self.call_later(0, self.update_transfers_display)
+    
+    def finish_transfer(self, transfer_id):
+        """Release the slot of a finished outgoing transfer"""
+        with self.transfer_lock:
+            user_id = self.file_transfers[transfer_id]['user_id']
+            self.active_sends[user_id] -= 1
+            if not self.active_sends[user_id]:
+                del self.active_sends[user_id]
+        self.fair_share.leave(transfer_id)
+        self.dispatch_transfers()
+    
+    def wait_transfer_turn(self, transfer_id, nbytes):
+        """Honour pause/cancel and the fair share before sending a chunk"""
+        transfer = self.file_transfers[transfer_id]
+        if not transfer['resume_event'].is_set():
+            # Paused transfers sit out of the bandwidth rounds
+            self.fair_share.leave(transfer_id)
+            transfer['resume_event'].wait()
+            self.fair_share.join(transfer_id)
+        if transfer['cancelled']:
+            raise Exception("Transfer cancelled")
+        self.fair_share.acquire(transfer_id, nbytes)
+    
+    def throttle(self, direction, user_id, nbytes):
+        """Wait on the global and per-peer rate limits for a direction"""
+        self.rate_buckets[direction].consume(nbytes)
+        self.peer_bucket(direction, user_id).consume(nbytes)
+    
+    def peer_bucket(self, direction, user_id):
+        with self.buckets_lock:
+            bucket = self.peer_buckets.get((direction, user_id))
+            if bucket is None:
+                bucket = TokenBucket(self.rate_limits['peer_' + direction] * 1024)
+                self.peer_buckets[(direction, user_id)] = bucket
+            return bucket
+    
+    def apply_rate_limits(self):
+        """Push rate_limits into the live buckets"""
+        for direction in ('upload', 'download'):
+            self.rate_buckets[direction].set_rate(self.rate_limits[direction] * 1024)
+        with self.buckets_lock:
+            for (direction, _), bucket in self.peer_buckets.items():
+                bucket.set_rate(self.rate_limits['peer_' + direction] * 1024)
+    
+    def set_rate_limits(self, **limits):
+        """Change limits at runtime, e.g. set_rate_limits(upload=500)"""
+        self.rate_limits.update(limits)
+        self.apply_rate_limits()
+        self.save_config()
+    
+    def pause_transfer(self, transfer_id):
+        transfer = self.file_transfers.get(transfer_id)
+        if transfer and transfer['type'] == 'sending' and transfer['status'] in ('queued', 'uploading'):
+            transfer['resume_event'].clear()
+            transfer['status'] = 'paused'
+            self.update_transfers_display()
+    
+    def resume_transfer(self, transfer_id):
+        transfer = self.file_transfers.get(transfer_id)
+        if transfer and transfer['status'] == 'paused':
+            transfer['status'] = 'queued' if transfer_id in self.transfer_queue else 'uploading'
+            transfer['resume_event'].set()
+            self.dispatch_transfers()
+    
+    def cancel_transfer(self, transfer_id):
+        transfer = self.file_transfers.get(transfer_id)
+        if not transfer or transfer['status'] in ('completed', 'failed', 'cancelled', 'rejected'):
+            return
+        transfer['cancelled'] = True
+        if transfer['status'] == 'offered':
+            if transfer['user_id'] in self.connected_users:
+                self.send_control(transfer['user_id'], {
+                    'type': 'file_cancel',
+                    'from_id': self.user_id,
+                    'transfer_id': transfer_id
+                }, PRIORITY_CONTROL)
+            self.end_offer(transfer_id, 'cancelled')
+        elif transfer['type'] == 'sending':
+            with self.transfer_lock:
+                queued = transfer_id in self.transfer_queue
+                if queued:
+                    self.transfer_queue.remove(transfer_id)
+            if queued:
+                transfer['status'] = 'cancelled'
+                if 'shared_reader' in transfer:
+                    transfer['shared_reader'].release(transfer_id)
+                self.dispatch_transfers()
+            transfer['resume_event'].set()
+        self.update_transfers_display()
+    
+    def prioritize_transfer(self, transfer_id):
+        """Move a queued transfer to the front of its peers"""
+        transfer = self.file_transfers.get(transfer_id)
+        if transfer and transfer_id in self.transfer_queue:
+            transfer['priority'] = 0
+            self.dispatch_transfers()
+    
+    def file_chunks(self, filepath, transfer_id):
+        """(chunk, progress) pairs of a file, from the shared reader when fanning out"""
+        reader = self.file_transfers[transfer_id].get('shared_reader')
+        if reader:
+            while True:
+                chunk = reader.read(transfer_id)
+                if not chunk:
+                    return
+                yield chunk, len(chunk)
+        
+        with open(filepath, 'rb') as f:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    return
+                yield chunk, len(chunk)
+    
+    def directory_entries(self, root):
+        """Relative paths and sizes under a folder, -1 marks an empty folder"""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            relative = os.path.relpath(dirpath, root).replace(os.sep, '/')
+            if not dirnames and not filenames and relative != '.':
+                entries.append((relative, -1))
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    entries.append((os.path.relpath(path, root).replace(os.sep, '/'), os.path.getsize(path)))
+        return entries
+    
+    def directory_entry_header(self, path, size):
+        header = json.dumps({'path': path, 'size': size}).encode('utf-8')
+        return struct.pack('!I', len(header)) + header
+    
+    def directory_stream_size(self, entries):
+        """Bytes on the wire for a folder, headers and end marker included"""
+        return sum(len(self.directory_entry_header(path, size)) + max(size, 0)
+                   for path, size in entries) + 4
+    
+    def directory_chunks(self, root, entries):
+        """Stream a folder as entry headers followed by file data.
+        
+        Small files are packed together so they go out in full-size chunks
+        instead of one write per file.
+        """
+        buffer = bytearray()
+        for path, size in entries:
+            buffer += self.directory_entry_header(path, size)
+            if size < 0:
+                continue
+            with open(os.path.join(root, *path.split('/')), 'rb') as f:
+                remaining = size
+                while remaining:
+                    data = f.read(min(65536, remaining))
+                    if not data:
+                        raise Exception(f"{path} changed while sending")
+                    buffer += data
+                    remaining -= len(data)
+                    if len(buffer) >= 65536:
+                        yield bytes(buffer), len(buffer)
+                        buffer.clear()
+        buffer += struct.pack('!I', 0)
+        yield bytes(buffer), len(buffer)
+    
+    def send_file_thread(self, user_id, filepath, transfer_id):
+        """Thread for sending file"""
+        client_socket = None
+        self.fair_share.join(transfer_id)
+        self.file_transfers[transfer_id]['started_at'] = time.time()
+        try:
+            if user_id not in self.user_directory:
+                self.call_later(0, lambda: self.add_chat_message("User not found", "system"))
+                return
+            
+            client_socket = self.take_prewarmed_channel(transfer_id) or self.open_transfer_channel(user_id)
+            
+            # Send file metadata
+            filename = self.file_transfers[transfer_id]['filename']
+            filesize = self.file_transfers[transfer_id]['size']
+            paths = self.stripe_paths(user_id, filepath, transfer_id)
+            compress = not paths and self.uses(user_id, handshake.DEFLATE) and (
+                os.path.isdir(filepath) or compression.worth_compressing(filepath))
+            
+            metadata = json.dumps({
+                'type': 'file_metadata',
+                'filename': filename,
+                'filesize': filesize,
+                'directory': os.path.isdir(filepath),
+                'delta': (not os.path.isdir(filepath) and 'shared_reader' not in self.file_transfers[transfer_id]
+                          and self.uses(user_id, handshake.DELTA)),
+                'compress': compress,
+                'striped': bool(paths),
+                'transfer_id': transfer_id,
+                'sender_id': self.user_id,
+                'sender_name': self.current_user
+            })
+            
+            # Send metadata length first
+            metadata = metadata.encode('utf-8')
+            client_socket.sendall(struct.pack('!I', len(metadata)) + metadata)
+            
+            # Wait for acknowledgment, a receiver with an older copy asks for a delta
+            ack = recv_exact(client_socket, 5).decode('utf-8')
+            signature = None
+            if ack == 'DELTA':
+                signature_len = struct.unpack('!I', recv_exact(client_socket, 4))[0]
+                signature = recv_exact(client_socket, signature_len)
+            elif ack == 'NOSPC':
+                raise Exception("Receiver is out of disk space")
+            elif ack == 'NOACC':
+                raise Exception("Receiver did not accept the transfer")
+            elif ack != 'READY':
+                raise Exception("Receiver not ready")
+            
+            # Send the data, folders as one stream of entries
+            sent_bytes = 0
+            wire_bytes = 0
+            if paths and not signature:
+                self.send_striped(user_id, filepath, transfer_id, paths, client_socket)
+                sent_bytes = wire_bytes = filesize
+            else:
+                if os.path.isdir(filepath):
+                    chunks = self.directory_chunks(filepath, self.file_transfers[transfer_id]['entries'])
+                elif signature:
+                    chunks = delta.delta_chunks(filepath, signature)
+                else:
+                    chunks = self.file_chunks(filepath, transfer_id)
+                if compress:
+                    chunks = compression.compress_chunks(chunks)
+                for chunk, advance in chunks:
+                    self.wait_transfer_turn(transfer_id, len(chunk))
+                    self.throttle('upload', user_id, len(chunk))
+                    client_socket.sendall(chunk)
+                    sent_bytes += advance
+                    wire_bytes += len(chunk)
+                    
+                    # Update progress
+                    progress = (sent_bytes / filesize) * 100
+                    if transfer_id in self.file_transfers:
+                        self.file_transfers[transfer_id]['progress'] = progress
+                        self.file_transfers[transfer_id]['bytes_done'] = sent_bytes
+                        self.call_later(0, self.update_transfers_display)
+            
+            # Wait for completion acknowledgment
+            completion = client_socket.recv(1024).decode('utf-8')
+            if completion == 'COMPLETE':
+                if transfer_id in self.file_transfers:
+                    self.file_transfers[transfer_id]['status'] = 'completed'
+                    self.file_transfers[transfer_id]['progress'] = 100
+                    self.call_later(0, self.update_transfers_display)
+                    if signature or wire_bytes < sent_bytes * 0.9:
+                        note = f" ({'delta' if signature else 'compressed'}, {wire_bytes/1024/1024:.1f}MB sent)"
+                    else:
+                        note = ""
+                    self.call_later(0, lambda: self.add_chat_message(f"✓ File sent: {filename}{note}", "system"))
+                
+                # How long chat waited behind this transfer on the shared link,
+                # kept with the transfer for the IPC transfers op
+                sock = self.connected_users.get(user_id)
+                if sock in self.mux_sessions and transfer_id in self.file_transfers:
+                    self.file_transfers[transfer_id]['link_latency'] = self.get_writer(sock).latency_stats()
+            else:
+                raise Exception("Transfer failed")
+            
+            client_socket.close()
+        
+        except Exception as e:
+            if client_socket is not None:
+                try:
+                    if isinstance(client_socket, MuxStream):
+                        client_socket.reset(str(e))
+                    else:
+                        client_socket.close()
+                except:
+                    pass
+            if transfer_id in self.file_transfers:
+                if self.file_transfers[transfer_id]['cancelled']:
+                    self.file_transfers[transfer_id]['status'] = 'cancelled'
+                    self.call_later(0, self.update_transfers_display)
+                else:
+                    self.file_transfers[transfer_id]['status'] = 'failed'
+                    self.call_later(0, self.update_transfers_display)
+                    error = str(e)
+                    self.call_later(0, lambda: self.add_chat_message(f"✗ File transfer failed: {error}", "system"))
+        finally:
+            if 'shared_reader' in self.file_transfers.get(transfer_id, {}):
+                self.file_transfers[transfer_id]['shared_reader'].release(transfer_id)
+            self.finish_transfer(transfer_id)
+    
+    def stripe_paths(self, user_id, filepath, transfer_id):
+        """Address pairs to stripe a send over, empty to send it as one stream"""
+        transfer = self.file_transfers[transfer_id]
+        remote = self.peer_addresses.get(user_id)
+        if (not self.striping_enabled or not remote or os.path.isdir(filepath)
+                or 'shared_reader' in transfer or transfer['size'] < self.stripe_min_size):
+            return []
+        paths = striping.pair_addresses(self.local_addresses(), remote, self.max_stripes)
+        return paths if len(paths) > 1 else []
+    
+    def send_striped(self, user_id, filepath, transfer_id, paths, channel):
+        """Send a file over several address pairs at once.
+        
+        Each path is a connection to the receiver's file port bound to one of
+        our addresses. A StripeScheduler hands out the ranges, so faster
+        paths carry more of the file and a failed path's range goes to the
+        others. DONE on the main channel tells the receiver to finish up.
+        """
+        filesize = self.file_transfers[transfer_id]['size']
+        scheduler = striping.StripeScheduler(filesize)
+        path_bytes = {path: 0 for path in paths}
+        errors = []
+        progress_lock = threading.Lock()
+        
+        def run_path(path):
+            local_ip, remote_ip = path
+            stripe_socket = None
+            span = None
+            try:
+                stripe_socket = socket.create_connection((remote_ip, self.file_port), timeout=30,
+                                                         source_address=(local_ip, 0))
+                stripe_socket = self.secure_channel(stripe_socket, user_id)
+                header = json.dumps({
+                    'type': 'file_stripe',
+                    'transfer_id': transfer_id,
+                    'sender_id': self.user_id
+                }).encode('utf-8')
+                stripe_socket.sendall(struct.pack('!I', len(header)) + header)
+                
+                with open(filepath, 'rb') as f:
+                    while True:
+                        span = scheduler.take(path)
+                        if span is None:
+                            break
+                        offset, length = span
+                        started = time.time()
+                        stripe_socket.sendall(striping.STRIPE_RANGE.pack(offset, length))
+                        f.seek(offset)
+                        remaining = length
+                        while remaining:
+                            if self.file_transfers[transfer_id]['cancelled']:
+                                raise Exception("Transfer cancelled")
+                            chunk = f.read(min(65536, remaining))
+                            if not chunk:
+                                raise Exception("File shrank while sending")
+                            self.wait_transfer_turn(transfer_id, len(chunk))
+                            self.throttle('upload', user_id, len(chunk))
+                            stripe_socket.sendall(chunk)
+                            remaining -= len(chunk)
+                            
+                            with progress_lock:
+                                path_bytes[path] += len(chunk)
+                                sent_bytes = min(filesize, sum(path_bytes.values()))
+                            self.file_transfers[transfer_id]['progress'] = (sent_bytes / filesize) * 100
+                            self.file_transfers[transfer_id]['bytes_done'] = sent_bytes
+                            self.call_later(0, self.update_transfers_display)
+                        
+                        # The receiver confirms each range once it is written
+                        if recv_exact(stripe_socket, 1) != b'K':
+                            raise Exception("Range not confirmed")
+                        scheduler.done(path, span, time.time() - started)
+                        span = None
+                
+                stripe_socket.sendall(striping.STRIPE_RANGE.pack(0, 0))
+            except Exception as e:
+                if span:
+                    scheduler.give_back(span)
+                errors.append(f"{local_ip} -> {remote_ip}: {e}")
+            finally:
+                if stripe_socket is not None:
+                    stripe_socket.close()
+        
+        threads = [threading.Thread(target=run_path, args=(path,), daemon=True) for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        for (local_ip, remote_ip), rate in scheduler.rates.items():
+            print(f"Stripe {local_ip} -> {remote_ip}: {path_bytes[(local_ip, remote_ip)]/1024/1024:.1f}MB "
+                  f"at {rate/1024/1024:.1f}MB/s")
+        for error in errors:
+            print(f"Stripe path failed: {error}")
+        if scheduler.completed < filesize:
+            channel.sendall(b'FAIL')
+            raise Exception("All stripe paths failed: " + "; ".join(errors))
+        channel.sendall(b'DONE')
+    
+    def open_transfer_channel(self, user_id):
+        """Get a byte stream for a file transfer to a user.
+        
+        Multiplexing peers get a new logical stream on the existing chat
+        connection, others a fresh connection to their file port.
+        """
+        sock = self.connected_users.get(user_id)
+        session = self.mux_sessions.get(sock)
+        if session:
+            stream = session.open_stream({'purpose': 'file'})
+            stream.settimeout(30)
+            return stream
+        
+        user_ip = self.user_directory[user_id]['ip']
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.settimeout(30)
+        try:
+            client_socket.connect((user_ip, self.file_port))
+            return self.secure_channel(client_socket, user_id)
+        except:
+            client_socket.close()
+            raise
+    
+    def check_file_transfers(self):
+        """Check for incoming file transfers"""
+        while self.messenger_active and self.file_server:
+            try:
+                readable, _, _ = select.select([self.file_server], [], [], 1.0)
+                
+                if readable:
+                    self.accept_file_connections()
+            
+            except Exception as e:
+                time.sleep(0.1)
+    
+    def accept_file_connections(self):
+        """Take every connection waiting on the file port, each on its own thread"""
+        while True:
+            try:
+                client_socket, addr = self.file_server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if self.messenger_active:
+                    print(f"Accept failed: {e}")
+                return
+            if not self.file_admission.admit(addr[0]):
+                client_socket.close()
+                continue
+            threading.Thread(target=self.serve_file_connection, args=(client_socket, addr), daemon=True).start()
+    
+    def serve_file_connection(self, sock, addr):
+        try:
+            self.handle_file_transfer(sock, addr)
+        finally:
+            self.file_admission.release(addr[0])
+    
+    def handle_file_transfer(self, sock, addr):
+        """Handle incoming file transfer"""
+        transfer_id = None
+        part_path = None
+        try:
+            # A pre-warmed channel sits idle until its offer is answered
+            if addr is not None:
+                sock = self.accept_tls(sock, self.offer_timeout)
+            sock.settimeout(self.offer_timeout)
+            
+            # Receive metadata length
+            metadata_len_data = sock.recv(4)
+            if not metadata_len_data:
+                sock.close()
+                return
+            
+            metadata_len_data += recv_exact(sock, 4 - len(metadata_len_data))
+            metadata_len = struct.unpack('!I', metadata_len_data)[0]
+            
+            # Receive metadata
+            sock.settimeout(30)
+            metadata = recv_exact(sock, metadata_len).decode('utf-8')
+            metadata_json = json.loads(metadata)
+            if not self.admit_peer(metadata_json.get('sender_id'), sock):
+                raise Exception("File connection refused")
+            
+            # Extra connections of a striped transfer carry ranges only
+            if metadata_json.get('type') == 'file_stripe':
+                self.receive_stripe(sock, metadata_json)
+                return
+            
+            filename = metadata_json.get('filename')
+            filesize = metadata_json.get('filesize')
+            sender_id = metadata_json.get('sender_id')
+            sender_name = metadata_json.get('sender_name', 'Unknown')
+            transfer_id = (sender_id, metadata_json.get('transfer_id'))
+            
+            # Only transfers the user accepted get a READY
+            if not self.wait_for_acceptance(transfer_id):
+                sock.sendall('NOACC'.encode('utf-8'))
+                transfer_id = None
+                raise Exception(f"Transfer of {filename} was not accepted")
+            
+            if not self.has_room_for(filesize):
+                sock.sendall('NOSPC'.encode('utf-8'))
+                raise Exception(f"Not enough disk space for {filename}")
+            
+            # Send ready signal, or the checksums of our last copy for a delta
+            basis = self.delta_basis(sender_id, filename) if metadata_json.get('delta') else None
+            signature = None
+            if basis:
+                signature = delta.file_signature(basis)
+                sock.sendall(b'DELTA' + struct.pack('!I', len(signature)) + signature)
+            else:
+                sock.sendall('READY'.encode('utf-8'))
+            
+            # Create unique filename, its .part reserved for us
+            save_path = self.unique_save_path(filename, metadata_json.get('directory'))
+            part_path = save_path + '.part'
+            
+            # Create transfer entry
+            if transfer_id not in self.file_transfers:
+                self.file_transfers.add(transfer_id, {
+                    'type': 'receiving',
+                    'filename': filename,
+                    'size': filesize,
+                    'progress': 0,
+                    'status': 'downloading',
+                    'user_id': sender_id,
+                    'save_path': save_path,
+                    'cancelled': False
+                })
+            else:
+                self.file_transfers[transfer_id]['status'] = 'downloading'
+                self.file_transfers[transfer_id]['save_path'] = save_path
+            self.file_transfers[transfer_id]['started_at'] = time.time()
+            self.call_later(0, self.update_transfers_display)
+            
+            # Receive into the .part file or folder, renamed once complete
+            # The download limit counts wire bytes, as the sender's upload limit does
+            data_sock = sock
+            if metadata_json.get('compress'):
+                data_sock = compression.InflatingReader(
+                    sock, lambda nbytes: self.throttle('download', sender_id, nbytes))
+            if metadata_json.get('directory'):
+                self.receive_directory(data_sock, part_path, filesize, transfer_id, sender_id)
+            elif signature:
+                def on_progress(written, received):
+                    if received and data_sock is sock:
+                        self.throttle('download', sender_id, received)
+                    if transfer_id in self.file_transfers:
+                        if self.file_transfers[transfer_id].get('cancelled'):
+                            raise Exception("Transfer cancelled")
+                        self.file_transfers[transfer_id]['progress'] = min(100, written / filesize * 100)
+                        self.file_transfers[transfer_id]['bytes_done'] = written
+                        self.call_later(0, self.update_transfers_display)
+                
+                with self.open_part_file(part_path, filesize) as f:
+                    if delta.apply_delta(data_sock, basis, signature, f, on_progress) != filesize:
+                        raise Exception("Delta result has the wrong size")
+                    self.sync_file(f)
+            elif metadata_json.get('striped'):
+                with self.open_part_file(part_path, filesize) as f:
+                    self.receive_striped(sock, f, filesize, transfer_id)
+                    self.sync_file(f)
+            else:
+                received_bytes = 0
+                with self.open_part_file(part_path, filesize) as f:
+                    while received_bytes < filesize:
+                        chunk = data_sock.recv(min(65536, filesize - received_bytes))
+                        if not chunk:
+                            break
+                        if data_sock is sock:
+                            self.throttle('download', sender_id, len(chunk))
+                        f.write(chunk)
+                        received_bytes += len(chunk)
+                        
+                        # Update progress
+                        progress = (received_bytes / filesize) * 100
+                        if transfer_id in self.file_transfers:
+                            if self.file_transfers[transfer_id].get('cancelled'):
+                                raise Exception("Transfer cancelled")
+                            self.file_transfers[transfer_id]['progress'] = progress
+                            self.file_transfers[transfer_id]['bytes_done'] = received_bytes
+                            self.call_later(0, self.update_transfers_display)
+                    
+                    if received_bytes < filesize:
+                        raise Exception("Sender closed the connection early")
+                    self.sync_file(f)
+            
+            os.replace(part_path, save_path)
+            part_path = None
+            
+            # Send completion acknowledgment
+            sock.sendall('COMPLETE'.encode('utf-8'))
+            sock.close()
+            if not metadata_json.get('directory'):
+                self.remember_received(sender_id, filename, save_path)
+            
+            # Update transfer status
+            if transfer_id in self.file_transfers:
+                self.file_transfers[transfer_id]['status'] = 'completed'
+                self.file_transfers[transfer_id]['progress'] = 100
+                self.call_later(0, self.update_transfers_display)
+                
+                # Show notification
+                self.call_later(0, lambda: self.add_chat_message(
+                    f"📁 Received file from {sender_name}: {filename}", "system"))
+                self.call_later(0, self.set_status, f"✓ File received: {filename}", '#00FF00')
+                
+                # Open file location button
+                self.call_later(3000, lambda: self.show_file_received_notification(save_path, filename))
+                self.emit('file_received', {'from_id': sender_id, 'filename': filename, 'path': save_path})
+        
+        except Exception as e:
+            print(f"File transfer error: {e}")
+            if part_path and os.path.isdir(part_path):
+                shutil.rmtree(part_path, ignore_errors=True)
+            elif part_path and os.path.exists(part_path):
+                try:
+                    os.remove(part_path)
+                except OSError:
+                    pass
+            if transfer_id in self.file_transfers:
+                if self.file_transfers[transfer_id].get('cancelled'):
+                    self.file_transfers[transfer_id]['status'] = 'cancelled'
+                else:
+                    self.file_transfers[transfer_id]['status'] = 'failed'
+                self.call_later(0, self.update_transfers_display)
+            try:
+                if isinstance(sock, MuxStream):
+                    sock.reset(str(e))
+                else:
+                    sock.close()
+            except:
+                pass
+    
+    def receive_striped(self, sock, f, filesize, transfer_id):
+        """Wait on the main channel while stripe connections fill the file"""
+        sink = striping.StripeSink(f, filesize)
+        self.stripe_sinks[transfer_id] = sink
+        try:
+            sock.settimeout(1)
+            status = b''
+            while True:
+                # Bytes that came before a timeout stay, the status may arrive in pieces
+                try:
+                    chunk = sock.recv(4 - len(status))
+                    if not chunk:
+                        raise ConnectionError("Connection closed")
+                    status += chunk
+                    if len(status) == 4:
+                        break
+                    continue
+                except socket.timeout:
+                    pass
+                if time.time() - sink.last_write > 30:
+                    raise Exception("Striped transfer stalled")
+                if transfer_id in self.file_transfers:
+                    if self.file_transfers[transfer_id].get('cancelled'):
+                        raise Exception("Transfer cancelled")
+                    self.file_transfers[transfer_id]['progress'] = (sink.received / filesize) * 100
+                    self.file_transfers[transfer_id]['bytes_done'] = sink.received
+                    self.call_later(0, self.update_transfers_display)
+        finally:
+            del self.stripe_sinks[transfer_id]
+        if status != b'DONE' or sink.received != filesize:
+            raise Exception("Striped transfer incomplete")
+    
+    def receive_stripe(self, sock, metadata_json):
+        """Write the ranges arriving on one stripe connection"""
+        key = (metadata_json.get('sender_id'), metadata_json.get('transfer_id'))
+        # The main channel registers the sink right after its READY
+        deadline = time.time() + 10
+        while key not in self.stripe_sinks:
+            if time.time() > deadline:
+                raise Exception("Stripe for an unknown transfer")
+            time.sleep(0.05)
+        sink = self.stripe_sinks[key]
+        
+        while True:
+            offset, length = striping.STRIPE_RANGE.unpack(recv_exact(sock, striping.STRIPE_RANGE.size))
+            if not length:
+                break
+            if offset + length > sink.size:
+                raise Exception("Stripe range past the end of the file")
+            remaining = length
+            while remaining:
+                chunk = sock.recv(min(65536, remaining))
+                if not chunk:
+                    raise Exception("Stripe connection closed early")
+                self.throttle('download', key[0], len(chunk))
+                sink.write(offset + length - remaining, chunk)
+                remaining -= len(chunk)
+            sink.range_done(offset, length)
+            sock.sendall(b'K')
+        sock.close()
+    
+    def free_disk_space(self):
+        try:
+            return shutil.disk_usage(self.download_dir).free
+        except OSError:
+            return None
+    
+    def has_room_for(self, filesize):
+        """Whether the download folder can take filesize bytes and keep a reserve"""
+        free = self.free_disk_space()
+        return free is None or free >= filesize + self.disk_reserve
+    
+    def open_part_file(self, part_path, filesize):
+        """Open a download's .part file with its full size reserved up front"""
+        f = open(part_path, 'wb')
+        if filesize and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, filesize)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    f.close()
+                    raise Exception("Not enough disk space")
+                # Filesystem can't preallocate, write as we go
+        return f
+    
+    def sync_file(self, f):
+        """Flush a finished download to disk before it gets its real name"""
+        f.flush()
+        os.fsync(f.fileno())
+    
+    def delta_basis(self, sender_id, filename):
+        """Our last copy of a file from this sender, if worth a delta"""
+        path = self.received_files.get(f"{sender_id}/{filename}")
+        if path and os.path.isfile(path) and os.path.getsize(path) >= delta.MIN_DELTA_SIZE:
+            return path
+        return None
+    
+    def remember_received(self, sender_id, filename, save_path):
+        """Record the latest copy of a received file for later deltas"""
+        with self.transfer_lock:
+            key = f"{sender_id}/{filename}"
+            self.received_files.pop(key, None)
+            self.received_files[key] = save_path
+            while len(self.received_files) > self.max_received_index:
+                del self.received_files[next(iter(self.received_files))]
+            try:
+                with open(self.received_index_file, 'w') as f:
+                    json.dump(self.received_files, f, indent=2)
+            except:
+                pass
+    
+    def receive_directory(self, sock, dest, filesize, transfer_id, sender_id):
+        """Extract a folder stream into dest without a temporary archive"""
+        os.makedirs(dest, exist_ok=True)  # unique_save_path reserved it
+        root = os.path.realpath(dest)
+        received_bytes = 0
+        shown_bytes = 0
+        while True:
+            header_len = struct.unpack('!I', recv_exact(sock, 4))[0]
+            received_bytes += 4
+            if not header_len:
+                break
+            entry = json.loads(recv_exact(sock, header_len).decode('utf-8'))
+            received_bytes += header_len
+            
+            target = self.safe_entry_path(root, entry.get('path', ''))
+            size = entry.get('size', 0)
+            if size < 0:
+                os.makedirs(target, exist_ok=True)
+                continue
+            
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                remaining = size
+                while remaining:
+                    chunk = sock.recv(min(65536, remaining))
+                    if not chunk:
+                        raise Exception("Sender closed the connection early")
+                    if not isinstance(sock, compression.InflatingReader):  # else it throttles wire bytes
+                        self.throttle('download', sender_id, len(chunk))
+                    f.write(chunk)
+                    remaining -= len(chunk)
+                    received_bytes += len(chunk)
+                    
+                    # Many small files: refresh the display once per 64KB, not per file
+                    if received_bytes - shown_bytes >= 65536 and transfer_id in self.file_transfers:
+                        if self.file_transfers[transfer_id].get('cancelled'):
+                            raise Exception("Transfer cancelled")
+                        shown_bytes = received_bytes
+                        self.file_transfers[transfer_id]['progress'] = min(100, received_bytes / filesize * 100)
+                        self.file_transfers[transfer_id]['bytes_done'] = received_bytes
+                        self.call_later(0, self.update_transfers_display)
+    
+    def safe_entry_path(self, root, path):
+        """Resolve a path from a folder stream, refusing anything outside root"""
+        parts = [part for part in path.split('/') if part not in ('', '.')]
+        if not parts or any(part == '..' or (self.system == "Windows" and (':' in part or '\\' in part))
+                            for part in parts):
+            raise Exception(f"Unsafe path in folder: {path}")
+        target = os.path.realpath(os.path.join(root, *parts))
+        if not target.startswith(root + os.sep):
+            raise Exception(f"Unsafe path in folder: {path}")
+        return target
+    
+    def transfer_eta(self, transfer):
+        """Seconds left for a running transfer, None if unknown"""
+        started = transfer.get('started_at')
+        done = transfer.get('bytes_done', 0)
+        if not started or not done:
+            return None
+        rate = done / max(time.time() - started, 0.001)
+        return (transfer['size'] - done) / rate
+    
+    def format_eta(self, seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return f"{hours}:{minutes:02d}:{seconds:02d}"
+        return f"{minutes}:{seconds:02d}"
+    
+    def try_connect_to_user(self, user_id, ip):
+        """Try to connect to user"""
+        threading.Thread(target=self.connect_thread, args=(user_id, ip), daemon=True).start()
+    
+    def connect_thread(self, user_id, ip):
+        """Thread for connecting to user"""
+        try:
+            self.dial_user(user_id, ip, timeout=5)
+            self.mark_alive(user_id)
+            
+            self.call_later(0, self.set_status, "✓ Connected to user", '#00FF00')
+            self.call_later(0, self.update_contacts_list)
+        
+        except Exception as e:
+            self.call_later(0, self.set_status, f"✗ Connection failed: {str(e)}", '#FF0000')
+    
+    def dial_user(self, user_id, ip, timeout=None, encrypt=True):
+        """Open a connection to a user and send our connect message"""
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.settimeout(timeout or self.dial_timeout)
+        try:
+            client_socket.connect((ip, self.user_port))
+            if encrypt and self.wants_tls(user_id):
+                try:
+                    client_socket = self.tls.dial(client_socket, user_id, timeout or self.dial_timeout)
+                except tls.PinMismatch:
+                    raise
+                except OSError:
+                    if self.require_encryption:
+                        raise
+                    # A version without TLS, or with encryption turned off
+                    client_socket.close()
+                    if user_id in self.user_directory:
+                        self.user_directory[user_id]['tls'] = False
+                    return self.dial_user(user_id, ip, timeout, encrypt=False)
+            elif self.require_encryption:
+                raise ConnectionError(f"{user_id} does not support encryption")
+            client_socket.setblocking(False)
+            
+            # They dialed us while we were connecting
+            if user_id in self.connected_users:
+                client_socket.close()
+                return self.connected_users[user_id]
+            
+            connect_msg = json.dumps(self.hello_message('connect'))
+            send_all(client_socket, connect_msg.encode('utf-8'))
+        except:
+            client_socket.close()
+            raise
+        
+        self.connected_users[user_id] = client_socket
+        self.wake_selector()
+        self.dial_times[user_id] = time.time()
+        
+        if user_id not in self.user_directory:
+            self.user_directory[user_id] = {
+                "name": "Unknown",
+                "ip": ip,
+                "last_seen": datetime.now().isoformat(),
+                "is_online": True,
+                "file_port": self.file_port
+            }
+        return client_socket
+    
+    def hub_link_loop(self):
+        """Keep a connection to the relay hub, redialing with backoff"""
+        attempts = 0
+        while self.messenger_active:
+            if self.hub_socket is None:
+                try:
+                    self.dial_hub()
+                    attempts = 0
+                except Exception as e:
+                    attempts += 1
+                    print(f"Hub connection failed: {e}")
+            self.hub_wakeup.wait(self.reconnect_delay(attempts) if self.hub_socket is None else None)
+            self.hub_wakeup.clear()
+    
+    def dial_hub(self):
+        host, _, port = self.hub_address.partition(':')
+        sock = socket.create_connection((host, int(port or self.user_port)), timeout=self.dial_timeout)
+        sock.setblocking(False)
+        self.hub_socket = sock
+        self.wake_selector()
+        self.get_writer(sock).write(encode_message({
+            'type': 'hub_hello',
+            'user_id': self.user_id,
+            'name': self.current_user,
+            'ip': self.user_ip,
+            'file_port': self.file_port,
+            'frames': True
+        }), PRIORITY_CONTROL)
+        self.hub_join_rooms(self.rooms.rooms_of(self.user_id))
+    
+    def on_hub_presence(self, user, online):
+        """A user came online at the hub or left it"""
+        user_id = user.get('user_id')
+        if not user_id or user_id == self.user_id:
+            return
+        if online:
+            self.hub_users.add(user_id)
+            info = self.user_directory.setdefault(user_id, {})
+            info.update({
+                "name": user.get('name') or info.get('name', 'Unknown'),
+                "ip": user.get('ip') or info.get('ip'),
+                "last_seen": datetime.now().isoformat(),
+                "is_online": True,
+                "file_port": user.get('file_port') or self.file_port
+            })
+            if user_id not in self.connected_users:
+                self.connected_users[user_id] = self.hub_socket
+            self.sync_rooms_with(user_id)
+            self.resume_delivery(user_id)
+        else:
+            self.hub_users.discard(user_id)
+            if self.connected_users.get(user_id) is self.hub_socket:
+                del self.connected_users[user_id]
+                if user_id in self.user_directory:
+                    self.user_directory[user_id]['is_online'] = False
+        self.call_later(0, self.update_contacts_list)
+    
+    def start_reconnect_manager(self):
+        """Dial every known contact concurrently and keep dropped ones retrying"""
+        now = time.time()
+        with self.reconnect_lock:
+            for user_id, info in self.user_directory.items():
+                if user_id != self.user_id and info.get("ip"):
+                    self.reconnect_state[user_id] = {"attempts": 0, "next_try": now}
+        threading.Thread(target=self.reconnect_loop, daemon=True).start()
+    
+    def reconnect_delay(self, attempts):
+        """Exponential backoff with jitter so peers don't redial in lockstep"""
+        ceiling = min(self.reconnect_max_delay, self.reconnect_base_delay * (2 ** attempts))
+        return random.uniform(ceiling / 2, ceiling)
+    
+    def schedule_reconnect(self, user_id):
+        """Queue a dropped contact for reconnection"""
+        if not self.messenger_active or user_id not in self.user_directory:
+            return
+        with self.reconnect_lock:
+            state = self.reconnect_state.setdefault(user_id, {"attempts": 0, "next_try": 0})
+            state["next_try"] = time.time() + self.reconnect_delay(state["attempts"])
+        self.reconnect_wakeup.set()
+    
+    def mark_alive(self, user_id):
+        """Liveness signal from a user - stop retrying it"""
+        with self.reconnect_lock:
+            self.reconnect_state.pop(user_id, None)
+    
+    def reconnect_loop(self):
+        """Dispatch due reconnect attempts, at most max_parallel_dials at once"""
+        while self.messenger_active:
+            now = time.time()
+            wait = self.reconnect_max_delay
+            due = []
+            
+            with self.reconnect_lock:
+                for user_id, state in list(self.reconnect_state.items()):
+                    if user_id in self.connected_users:
+                        del self.reconnect_state[user_id]
+                    elif user_id in self.dialing:
+                        continue
+                    elif state["next_try"] <= now:
+                        if len(self.dialing) < self.max_parallel_dials:
+                            self.dialing.add(user_id)
+                            due.append(user_id)
+                        else:
+                            wait = min(wait, 0.1)
+                    else:
+                        wait = min(wait, state["next_try"] - now)
+            
+            for user_id in due:
+                threading.Thread(target=self.reconnect_thread, args=(user_id,), daemon=True).start()
+            
+            self.reconnect_wakeup.wait(max(wait, 0.05))
+            self.reconnect_wakeup.clear()
+    
+    def reconnect_thread(self, user_id):
+        """Single reconnect attempt for a known contact"""
+        try:
+            ip = self.user_directory.get(user_id, {}).get("ip")
+            if ip and user_id not in self.connected_users:
+                self.dial_user(user_id, ip)
+            self.mark_alive(user_id)
+            self.call_later(0, self.update_contacts_list)
+        except Exception:
+            with self.reconnect_lock:
+                state = self.reconnect_state.get(user_id)
+                if state is not None and user_id not in self.connected_users:
+                    state["attempts"] += 1
+                    state["next_try"] = time.time() + self.reconnect_delay(state["attempts"])
+        finally:
+            with self.reconnect_lock:
+                self.dialing.discard(user_id)
+            self.reconnect_wakeup.set()
+    
+    def send_message_to_user(self, user_id, message):
+        """Send message to specific user, queueing it while they are away"""
+        message = {
+            'type': 'message',
+            'msg_id': uuid.uuid4().hex,
+            'from_id': self.user_id,
+            'from_name': self.current_user,
+            'message': message,
+            'timestamp': datetime.now().isoformat()
+        }
+        # Older queued and unacked messages go first
+        window = self.send_window(user_id)
+        if (self.reachable(user_id) and not self.outbox.pending(user_id)
+                and user_id not in self.resend_pending and not window.full()):
+            numbered = self.numbered(user_id)
+            if numbered:
+                window.add(message)
+            try:
+                self.send_control(user_id, message)
+            except:
+                # Still in the window, it is resent once they reconnect
+                self.resend_pending.add(user_id)
+                if user_id in self.connected_users:
+                    del self.connected_users[user_id]
+                if not numbered:
+                    self.queue_message(user_id, message)
+                self.call_later(0, self.update_contacts_list)
+                self.call_later(0, self.add_chat_message, "Connection lost, the message will be sent later", "system")
+            return message['msg_id']
+        self.queue_message(user_id, message)
+        return message['msg_id']
+    
+    def send_window(self, user_id):
+        window = self.send_windows.get(user_id)
+        if window is None:
+            window = self.send_windows[user_id] = SendWindow(self.delivery_epoch, self.max_in_flight)
+        return window
+    
+    def resume_delivery(self, user_id):
+        """After a (re)connect, resend what wasn't acked and drain the outbox"""
+        window = self.send_windows.get(user_id)
+        if window and window.unacked:
+            self.resend_pending.add(user_id)
+        self.drain_outbox(user_id)
+    
+    def queue_message(self, user_id, message):
+        """Put a message in a contact's outbox"""
+        message['queued'] = True
+        with self.outbox_lock:
+            self.outbox.append(user_id, message)
+        self.schedule_outbox_flush()
+        self.drain_outbox(user_id)
+    
+    def schedule_outbox_flush(self):
+        """Write the outbox shortly, a burst of messages shares one write"""
+        if not self.outbox_flush_pending:
+            self.outbox_flush_pending = True
+            self.call_later(500, self.flush_outbox)
+    
+    def flush_outbox(self):
+        self.outbox_flush_pending = False
+        try:
+            self.outbox.flush()
+        except OSError as e:
+            print(f"Could not write the outbox: {e}")
+    
+    def drain_outbox(self, user_id):
+        """Start sending a contact's queued messages if they are connected"""
+        with self.outbox_lock:
+            if (not self.reachable(user_id) or user_id in self.draining
+                    or not (self.outbox.pending(user_id) or user_id in self.resend_pending)):
+                return
+            self.draining.add(user_id)
+        threading.Thread(target=self.drain_thread, args=(user_id,), daemon=True).start()
+    
+    def drain_thread(self, user_id):
+        """Send queued messages in order, a batch at a time.
+        
+        They go out at bulk priority, so chat typed meanwhile isn't stuck
+        behind thousands of them. Messages the last connection lost go
+        first, but only those the receiver hasn't acked. Entries stay
+        queued until acked, and no more than the send window is in flight:
+        acks pace the drain, it goes as fast as the receiver keeps up.
+        """
+        cursor = -1
+        window = self.send_window(user_id)
+        try:
+            while self.messenger_active and self.reachable(user_id):
+                if user_id in self.resend_pending:
+                    self.resend_pending.discard(user_id)
+                    for message in window.pending():
+                        self.send_control(user_id, message, PRIORITY_BULK)
+                if not window.wait_for_space(self.outbox_pace):
+                    continue
+                with self.outbox_lock:
+                    batch = self.outbox.after(user_id, cursor, min(self.outbox_batch, window.limit - len(window.unacked)))
+                    if not batch and user_id not in self.resend_pending:
+                        self.draining.discard(user_id)
+                        return
+                for seq, message in batch:
+                    cursor = seq
+                    if message.get('msg_id') in window:
+                        continue  # in flight already, resent above if lost
+                    if self.numbered(user_id):
+                        window.add(message)
+                    self.send_control(user_id, message, PRIORITY_BULK)
+        except Exception as e:
+            print(f"Outbox drain to {user_id} stopped: {e}")
+        with self.outbox_lock:
+            self.draining.discard(user_id)
+    
+    def acknowledge_message(self, from_id, msg_id=None):
+        """Confirm a message, acks to one sender go out together.
+        
+        Numbered messages are acked cumulatively from the receive window,
+        unnumbered ones (from older versions) by msg_id.
+        """
+        scheduled = from_id in self.pending_acks
+        acks = self.pending_acks.setdefault(from_id, [])
+        if msg_id:
+            acks.append(msg_id)
+        window = self.receive_windows.get(from_id)
+        if window and window.unacked >= self.ack_every:
+            self.send_acks(from_id)
+        elif not scheduled:
+            self.call_later(self.ack_delay, self.send_acks, from_id)
+    
+    def send_acks(self, from_id):
+        msg_ids = self.pending_acks.pop(from_id, None)
+        if msg_ids is None or not self.reachable(from_id):
+            return
+        ack = {'type': 'message_ack', 'from_id': self.user_id, 'msg_ids': msg_ids}
+        window = self.receive_windows.get(from_id)
+        if window:
+            ack.update(window.ack_fields())
+        try:
+            self.send_control(from_id, ack, PRIORITY_CONTROL)
+        except:
+            pass
+    
+    def seen_message(self, msg_id):
+        """Whether a message was shown already, remembering it if not"""
+        if msg_id in self.seen_message_ids:
+            return True
+        self.seen_message_ids[msg_id] = True
+        while len(self.seen_message_ids) > self.max_seen_message_ids:
+            self.seen_message_ids.popitem(last=False)
+        return False
+    
+    def fan_out(self, user_ids, message, priority=PRIORITY_CHAT, via_room=False):
+        """Send one message to several users through their peer writers.
+        
+        The JSON is encoded once for everyone. Users reached through the hub
+        get a single copy the hub fans out by room when via_room is set,
+        otherwise one addressed copy each.
+        """
+        payload = json.dumps(message).encode('utf-8')
+        compressed = None
+        hub_users = []
+        for user_id in user_ids:
+            sock = self.connected_users.get(user_id)
+            if sock is None and user_id != self.user_id and self.routes.next_hop(user_id):
+                try:
+                    self.send_control(user_id, message, priority)
+                except Exception as e:
+                    print(f"Relaying to {user_id} failed: {e}")
+                continue
+            # The hub may route to users whose presence hasn't reached us yet
+            sock = sock or self.hub_socket
+            if sock is None or user_id == self.user_id:
+                continue
+            try:
+                session = self.mux_sessions.get(sock)
+                if sock is self.hub_socket:
+                    hub_users.append(user_id)
+                elif session is None:
+                    if self.uses(user_id, handshake.FRAMES):
+                        self.get_writer(sock).write(encode_frame(KIND_MESSAGE, 0, payload), priority)
+                    else:
+                        self.get_writer(sock).write(payload, priority)
+                elif self.uses(user_id, handshake.DEFLATE):
+                    if compressed is None:
+                        compressed = compression.deflate_message(payload)
+                    session.send_frame(KIND_MESSAGE, 0, compressed[0], compressed[1], priority)
+                else:
+                    session.send_frame(KIND_MESSAGE, 0, payload, 0, priority)
+            except Exception as e:
+                print(f"Fan-out to {user_id} failed: {e}")
+        
+        if hub_users and self.hub_socket:
+            try:
+                writer = self.get_writer(self.hub_socket)
+                if via_room:
+                    writer.write(encode_frame(KIND_MESSAGE, 0, payload), priority)
+                else:
+                    for user_id in hub_users:
+                        writer.write(encode_message(dict(message, to=user_id)), priority)
+            except Exception as e:
+                print(f"Fan-out through the hub failed: {e}")
+    
+    def create_room(self, name, user_ids):
+        room_id = RoomIndex.new_id()
+        self.rooms.create(room_id, name, {self.user_id: self.current_user})
+        self.hub_join_rooms([room_id])
+        self.invite_to_room(room_id, user_ids)
+        self.call_later(0, self.update_contacts_list)
+        return room_id
+    
+    def invite_to_room(self, room_id, user_ids):
+        """Add connected users to a room and send them its recent history"""
+        new = {uid: self.user_directory.get(uid, {}).get('name', 'Unknown')
+               for uid in user_ids if uid in self.connected_users}
+        if not new:
+            return
+        existing = [uid for uid in self.rooms.members_of(room_id) if uid != self.user_id]
+        for user_id, name in new.items():
+            self.rooms.join(room_id, user_id, name)
+        
+        self.fan_out(existing, {
+            'type': 'room_join',
+            'room': room_id,
+            'from_id': self.user_id,
+            'members': new
+        }, via_room=True)
+        self.fan_out(list(new), {
+            'type': 'room_invite',
+            'room': room_id,
+            'name': self.rooms.name_of(room_id),
+            'from_id': self.user_id,
+            'from_name': self.current_user,
+            'members': self.rooms.members_of(room_id),
+            'contacts': {uid: self.user_directory[uid]['ip'] for uid in self.rooms.members_of(room_id)
+                         if self.user_directory.get(uid, {}).get('ip')},
+            'history': self.rooms.catchup(room_id)
+        })
+        self.save_rooms()
+        self.call_later(0, self.update_contacts_list)
+    
+    def leave_room(self, room_id):
+        self.fan_out(list(self.rooms.members_of(room_id)), {
+            'type': 'room_leave',
+            'room': room_id,
+            'from_id': self.user_id
+        }, via_room=True)
+        if self.hub_socket:
+            self.get_writer(self.hub_socket).write(encode_message({'type': 'hub_leave', 'room': room_id}))
+        name = self.rooms.name_of(room_id)
+        self.rooms.remove(room_id)
+        self.save_rooms()
+        self.call_later(0, self.update_contacts_list)
+        self.call_later(0, self.add_chat_message, f"You left {name}", "system")
+    
+    def send_room_message(self, room_id, text):
+        message = {
+            'type': 'room_message',
+            'room': room_id,
+            'msg_id': uuid.uuid4().hex,
+            'from_id': self.user_id,
+            'from_name': self.current_user,
+            'message': text,
+            'timestamp': datetime.now().isoformat()
+        }
+        self.rooms.add_message(room_id, message)
+        self.fan_out(list(self.rooms.members_of(room_id)), message, via_room=True)
+        self.save_rooms()
+        return message['msg_id']
+    
+    def hub_join_rooms(self, room_ids):
+        """Have the hub fan out our rooms' messages to us"""
+        if self.hub_socket:
+            writer = self.get_writer(self.hub_socket)
+            for room_id in room_ids:
+                writer.write(encode_message({'type': 'hub_join', 'room': room_id}), PRIORITY_CONTROL)
+    
+    def sync_rooms_with(self, user_id):
+        """Ask a member who just came online for room messages we missed.
+        
+        One member per room is asked at most once a minute, and the answer
+        is bounded by the room's catch-up window.
+        """
+        now = time.time()
+        for room_id in self.rooms.rooms_of(user_id) & self.rooms.rooms_of(self.user_id):
+            if now - self.room_sync_times.get(room_id, 0) < 60:
+                continue
+            self.room_sync_times[room_id] = now
+            self.fan_out([user_id], {
+                'type': 'room_sync',
+                'room': room_id,
+                'from_id': self.user_id,
+                'since': self.rooms.latest(room_id)
+            })
+    
+    def on_room_message(self, message):
+        """A message for a room, live or from a catch-up"""
+        room_id = message.get('room')
+        if message.get('from_id') not in self.rooms.members_of(room_id):
+            return
+        if not self.rooms.add_message(room_id, message):
+            return
+        self.save_rooms()
+        self.call_later(0, self.on_room_chat, room_id, message)
+        self.emit('room_message', {'room': room_id, 'room_name': self.rooms.name_of(room_id),
+                                   'from_id': message.get('from_id'), 'from_name': message.get('from_name'),
+                                   'text': message.get('message'), 'msg_id': message.get('msg_id'),
+                                   'timestamp': message.get('timestamp')})
+    
+    def on_room_invite(self, message):
+        room_id = message.get('room')
+        members = message.get('members') or {}
+        if self.user_id not in members or message.get('from_id') not in members:
+            return
+        self.rooms.create(room_id, message.get('name', 'Room'), members)
+        for item in message.get('history', [])[-self.rooms.catchup_limit:]:
+            self.rooms.add_message(room_id, item)
+        
+        # Room messages go peer to peer, so get connected to the other members
+        for user_id, ip in (message.get('contacts') or {}).items():
+            if user_id == self.user_id or user_id not in members or user_id in self.connected_users:
+                continue
+            if user_id not in self.user_directory:
+                self.user_directory[user_id] = {
+                    "name": members[user_id],
+                    "ip": ip,
+                    "last_seen": datetime.now().isoformat(),
+                    "is_online": False,
+                    "file_port": self.file_port
+                }
+            self.schedule_reconnect(user_id)
+        self.hub_join_rooms([room_id])
+        self.save_rooms()
+        self.call_later(0, self.update_contacts_list)
+        self.call_later(0, self.add_chat_message,
+                      f"{message.get('from_name')} added you to {self.rooms.name_of(room_id)}", "system")
+    
+    def on_room_membership(self, message):
+        room_id = message.get('room')
+        from_id = message.get('from_id')
+        if from_id not in self.rooms.members_of(room_id):
+            return
+        if message.get('type') == 'room_join':
+            for user_id, name in (message.get('members') or {}).items():
+                self.rooms.join(room_id, user_id, name)
+        else:
+            self.rooms.leave(room_id, from_id)
+        self.save_rooms()
+        self.call_later(0, self.update_contacts_list)
+    
+    def on_room_sync(self, message):
+        """A member asks for what it missed while away"""
+        room_id = message.get('room')
+        from_id = message.get('from_id')
+        if from_id not in self.rooms.members_of(room_id):
+            return
+        self.fan_out([from_id], {
+            'type': 'room_history',
+            'room': room_id,
+            'from_id': self.user_id,
+            'messages': self.rooms.catchup(room_id, message.get('since'))
+        })  # chat priority: we are on the reader thread, bulk would wait behind file data
+    
+    def save_rooms(self):
+        """Write rooms.json shortly, a burst of changes shares one write"""
+        if not self.rooms_save_pending:
+            self.rooms_save_pending = True
+            self.call_later(1000, self.write_rooms)
+    
+    def write_rooms(self):
+        self.rooms_save_pending = False
+        try:
+            with open(self.rooms_file, 'w') as f:
+                json.dump(self.rooms.to_json(), f)
+        except:
+            pass
+    
+    def send_control(self, user_id, message, priority=PRIORITY_CHAT):
+        """Send a JSON message over a user's chat connection"""
+        sock = self.connected_users.get(user_id)
+        if sock is None:
+            # Not connected: through the neighbour with the shortest route
+            hop = self.routes.next_hop(user_id)
+            if hop is None or hop not in self.connected_users:
+                raise KeyError(user_id)
+            if message.get('type') != 'routed':
+                message = {'type': 'routed', 'id': uuid.uuid4().hex, 'from_id': self.user_id,
+                           'to': user_id, 'ttl': MAX_HOPS, 'message': message}
+                self.route_seen.check(message['id'])
+            user_id, sock = hop, self.connected_users[hop]
+        session = self.mux_sessions.get(sock)
+        if sock is self.hub_socket:
+            self.get_writer(sock).write(encode_message(dict(message, to=user_id)), priority)
+        elif session:
+            payload = json.dumps(message).encode('utf-8')
+            flags = 0
+            if self.uses(user_id, handshake.DEFLATE):
+                payload, flags = compression.deflate_message(payload)
+            session.send_frame(KIND_MESSAGE, 0, payload, flags, priority)
+        elif self.uses(user_id, handshake.FRAMES):
+            self.get_writer(sock).write(encode_message(message), priority)
+        else:
+            self.get_writer(sock).write(json.dumps(message).encode('utf-8'), priority)
+    
+    def reachable(self, user_id):
+        """Connected directly, through the hub or through a relay"""
+        return user_id in self.connected_users or self.routes.next_hop(user_id) is not None
+    
+    def schedule_advert(self):
+        """Advertise our routes shortly, a burst of changes shares one advert"""
+        if self.forwarding_enabled and not self.advert_pending:
+            self.advert_pending = True
+            self.call_later(1000, self.send_adverts)
+    
+    def send_adverts(self):
+        """Tell each direct neighbour who we can reach, if that changed"""
+        self.advert_pending = False
+        direct = [u for u, s in list(self.connected_users.items()) if s is not self.hub_socket]
+        for user_id in direct:
+            routes = self.routes.advert(direct, user_id)
+            if self.sent_adverts.get(user_id) == routes:
+                continue
+            try:
+                self.send_control(user_id, {'type': 'route_advert', 'from_id': self.user_id, 'routes': routes},
+                                  PRIORITY_CONTROL)
+                self.sent_adverts[user_id] = routes
+            except:
+                pass
+    
+    def on_routes_changed(self, user_ids):
+        """Routes to some users appeared, moved or went away"""
+        if not user_ids:
+            return
+        for user_id in user_ids:
+            if user_id not in self.connected_users and self.routes.next_hop(user_id):
+                self.sync_rooms_with(user_id)
+                self.resume_delivery(user_id)
+        self.schedule_advert()
+        self.call_later(0, self.update_contacts_list)
+    
+    def on_routed(self, envelope):
+        """A message relayed to us, or for us to pass on one hop"""
+        if self.route_seen.check(envelope.get('id')):
+            return
+        to = envelope.get('to')
+        if to == self.user_id:
+            inner = envelope.get('message')
+            if (isinstance(inner, dict) and inner.get('type') in ROUTABLE
+                    and inner.get('from_id') == envelope.get('from_id')):
+                self.process_message(inner, None)
+            return
+        if not self.forwarding_enabled or envelope.get('ttl', 0) <= 1:
+            return
+        try:
+            self.send_control(to, dict(envelope, ttl=envelope['ttl'] - 1))
+        except:
+            pass  # no route any more, the sender resends once acks stay out
+    
+    def get_writer(self, sock):
+        """Sender thread for a chat connection, created on first use"""
+        with self.writers_lock:
+            writer = self.peer_writers.get(sock)
+            if writer is None:
+                writer = self.peer_writers[sock] = PeerWriter(sock)
+            return writer
+    
+    def forget_socket(self, sock):
+        """Drop per-connection wire state"""
+        session = self.mux_sessions.pop(sock, None)
+        if session:
+            session.close()
+        self.decoders.pop(sock, None)
+        with self.writers_lock:
+            writer = self.peer_writers.pop(sock, None)
+        if writer:
+            writer.close()
+    
+    def broadcast_presence(self):
+        """Broadcast presence to network"""
+        pass
+    
+    def publish_own_record(self):
+        """Our directory entry, versioned anew whenever name, IP or port change"""
+        own = self.user_directory.setdefault(self.user_id, {})
+        current = {'name': self.current_user, 'ip': self.user_ip, 'file_port': self.file_port}
+        if not own.get('version') or any(own.get(k) != v for k, v in current.items()):
+            own.update(current)
+            own['version'] = max(own.get('version', 0) + 1, int(time.time()))
+            self.directory_digest = None
+            self.save_config()
+        own.update({'last_seen': datetime.now().isoformat(), 'is_online': True})
+    
+    def gossip_loop(self):
+        """Now and then compare directories with a random connected peer"""
+        while self.messenger_active:
+            time.sleep(self.gossip_interval * random.uniform(0.5, 1.5))
+            peers = list(self.connected_users)
+            if peers:
+                self.send_digest(random.choice(peers))
+    
+    def get_directory_digest(self):
+        digest = self.directory_digest
+        if digest is None:
+            versions = {user_id: info['version'] for user_id, info in list(self.user_directory.items())
+                        if isinstance(info.get('version'), int) and info['version'] > 0}
+            digest = self.directory_digest = gossip.DirectoryDigest(versions)
+        return digest
+    
+    def send_digest(self, user_id):
+        """Start a comparison: just our root hash, enough when nothing changed"""
+        try:
+            self.send_control(user_id, {'type': 'dir_digest', 'from_id': self.user_id,
+                                        'root': self.get_directory_digest().root}, PRIORITY_CONTROL)
+        except (OSError, ConnectionError, KeyError) as e:
+            print(f"Directory gossip to {user_id} failed: {e!r}")
+    
+    def on_directory_gossip(self, message):
+        """One step of a directory comparison.
+        
+        Roots differ -> swap bucket hashes -> the side that sees which buckets
+        differ sends its versions in those -> the other side sends entries it
+        has newer and pulls the ones it lacks.
+        """
+        from_id = message.get('from_id')
+        msg_type = message.get('type')
+        digest = self.get_directory_digest()
+        
+        if msg_type == 'dir_digest':
+            if message.get('root') == digest.root:
+                return
+            if 'buckets' not in message:
+                reply = {'type': 'dir_digest', 'root': digest.root, 'buckets': digest.buckets}
+            else:
+                differing = digest.differing(message.get('buckets'))
+                reply = {'type': 'dir_versions', 'buckets': differing, 'versions': digest.versions_in(differing)}
+        elif msg_type == 'dir_versions':
+            buckets = [b for b in message.get('buckets', []) if isinstance(b, int)]
+            send, pull = gossip.compare(digest.versions_in(buckets), message.get('versions') or {})
+            self.send_directory_entries(from_id, send)
+            if not pull:
+                return
+            reply = {'type': 'dir_pull', 'ids': pull}
+        elif msg_type == 'dir_pull':
+            self.send_directory_entries(from_id, message.get('ids') or [])
+            return
+        else:
+            self.merge_directory(message.get('entries') or {})
+            return
+        
+        # Small replies at control priority: this is the reader thread and
+        # bulk writes wait while file data is queued
+        reply['from_id'] = self.user_id
+        try:
+            self.send_control(from_id, reply, PRIORITY_CONTROL)
+        except (OSError, ConnectionError, KeyError) as e:
+            print(f"Directory gossip to {from_id} failed: {e!r}")
+    
+    def send_directory_entries(self, user_id, ids):
+        """Send records in batches, as bulk data from a thread of their own"""
+        entries = {uid: gossip.record(self.user_directory[uid]) for uid in ids if uid in self.user_directory}
+        if entries:
+            threading.Thread(target=self.send_entry_batches, args=(user_id, list(entries.items())),
+                             daemon=True).start()
+    
+    def send_entry_batches(self, user_id, items):
+        try:
+            for start in range(0, len(items), self.gossip_batch):
+                self.send_control(user_id, {'type': 'dir_entries', 'from_id': self.user_id,
+                                            'entries': dict(items[start:start + self.gossip_batch])}, PRIORITY_BULK)
+        except (OSError, ConnectionError, KeyError) as e:
+            print(f"Directory gossip to {user_id} failed: {e!r}")
+    
+    def merge_directory(self, entries):
+        """Take gossiped entries that are newer than ours"""
+        changed = False
+        for user_id, entry in entries.items():
+            if (not isinstance(entry, dict) or not isinstance(entry.get('version'), int)
+                    or not isinstance(entry.get('ip'), str)):
+                continue
+            if user_id == self.user_id:
+                # A copy of us newer than ours (our contacts file was lost): outbid it
+                own = self.user_directory[self.user_id]
+                if entry['version'] >= own.get('version', 0):
+                    own['version'] = entry['version'] + 1
+                    changed = True
+                continue
+            info = self.user_directory.get(user_id)
+            if info is not None and info.get('version', 0) >= entry['version']:
+                continue
+            if info is None:
+                info = self.user_directory[user_id] = {"last_seen": "", "is_online": False}
+            info.update(gossip.record(entry))
+            changed = True
+        
+        if changed:
+            self.directory_digest = None
+            self.save_directory()
+            self.call_later(0, self.update_contacts_list)
+    
+    def save_directory(self):
+        """Write contacts shortly, a burst of gossip shares one write"""
+        if not self.directory_save_pending:
+            self.directory_save_pending = True
+            self.call_later(1000, self.write_directory)
+    
+    def write_directory(self):
+        self.directory_save_pending = False
+        try:
+            self.save_config()
+        except:
+            pass
+    
+    def check_messages(self):
+        """Check for incoming messages"""
+        while self.messenger_active:
+            try:
+                # Users reached through the hub share its socket. Sockets added
+                # by other threads wake us, so an idle node hardly runs at all.
+                sockets = set(self.connected_users.values())
+                if self.hub_socket:
+                    sockets.add(self.hub_socket)
+                readable, _, _ = select.select([self.messenger_server, self.selector_wakeup[0]] + list(sockets)
+                                               + list(self.pending), [], [], 1.0)
+                
+                for sock in readable:
+                    if sock is self.selector_wakeup[0]:
+                        sock.recv(4096)
+                    elif sock == self.messenger_server:
+                        self.accept_connections()
+                    elif sock in self.pending:
+                        self.advance_handshake(self.pending[sock])
+                    else:
+                        try:
+                            if not self.read_socket(sock):
+                                self.remove_connection(sock)
+                        except:
+                            self.remove_connection(sock)
+            
+                self.expire_handshakes()
+            except Exception as e:
+                time.sleep(0.1)
+    
+    def accept_connections(self):
+        """Take every connection waiting on the chat port, not one per wakeup"""
+        while True:
+            try:
+                sock, addr = self.messenger_server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if self.messenger_active:
+                    print(f"Accept failed: {e}")
+                return
+            if len(self.pending) >= self.max_pending_handshakes or not self.chat_admission.admit(addr[0]):
+                sock.close()
+                continue
+            sock.setblocking(False)
+            self.pending[sock] = PendingConnection(sock, addr[0], time.monotonic() + self.handshake_timeout)
+    
+    def advance_handshake(self, pending):
+        """Take what a new chat connection sent, without blocking, until its connect is in"""
+        try:
+            if pending.conn is None or (pending.conn is not pending.sock and not pending.secured):
+                data = pending.sock.recv(65536)
+                if not data:
+                    raise ConnectionError("Closed during the handshake")
+                if pending.conn is None:
+                    # The first byte tells TLS from plaintext
+                    pending.received += data
+                    if pending.received[0] != tls.TLS_RECORD_START:
+                        pending.conn = pending.sock
+                        self.process_incoming_data(pending.received, pending.sock)
+                    elif self.tls is None:
+                        raise ConnectionError("TLS connection while encryption is off")
+                    else:
+                        pending.conn = self.tls.server_socket(pending.sock, pending.received)
+                        data = b''
+                if pending.conn is not None and pending.conn is not pending.sock:
+                    pending.secured = pending.conn.advance(data)
+                    if pending.secured and pending.conn.pending():
+                        self.read_socket(pending.conn)
+            elif not self.read_socket(pending.conn):
+                raise ConnectionError("Closed during the handshake")
+        except Exception:
+            self.drop_pending(pending, True)
+            return
+            
+        if pending.sock.fileno() == -1:
+            self.drop_pending(pending, False)  # refused or replaced while connecting
+        elif pending.conn is not None and any(s is pending.conn for s in self.connected_users.values()):
+            self.drop_pending(pending, False)  # a chat connection now
+    
+    def expire_handshakes(self):
+        now = time.monotonic()
+        for pending in [p for p in self.pending.values() if p.deadline <= now]:
+            self.drop_pending(pending, True)
+    
+    def drop_pending(self, pending, close):
+        """Stop tracking a new connection, closing it unless it became a chat connection"""
+        if self.pending.pop(pending.sock, None) is not None:
+            self.chat_admission.release(pending.ip)
+        if close:
+            conn = pending.conn or pending.sock
+            self.forget_socket(conn)
+            try:
+                conn.close()
+            except OSError:
+                pass
+    
+    def read_socket(self, sock):
+        """Process what a readable chat socket has, False once it closed"""
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return False
+                self.process_incoming_data(data, sock)
+                # TLS may hold more plaintext than one recv() returned
+                if not (isinstance(sock, tls.TlsSocket) and sock.pending()):
+                    return True
+        except BlockingIOError:
+            return True  # only part of a TLS record so far
+    
+    def process_incoming_data(self, data, sock):
+        """Process incoming data"""
+        decoder = self.decoders.setdefault(sock, FrameDecoder())
+        for item in decoder.feed(data):
+            if item[0] == 'json':
+                self.process_message(item[1], sock)
+            elif item[1] == KIND_MESSAGE:
+                try:
+                    payload = item[4]
+                    if item[2] & FLAG_COMPRESSED:
+                        payload = compression.inflate_message(payload)
+                    self.process_message(json.loads(payload.decode('utf-8')), sock)
+                except (json.JSONDecodeError, UnicodeDecodeError, ValueError, zlib.error):
+                    pass
+            else:
+                session = self.mux_sessions.get(sock)
+                if session:
+                    session.handle_frame(*item[1:])
+    
+    def capabilities(self):
+        """Wire features we offer in the handshake"""
+        caps = {handshake.FRAMES, handshake.RESUME, handshake.DELTA}
+        if self.multiplex_enabled:
+            caps.add(handshake.MUX)
+        if self.compression_enabled:
+            caps.add(handshake.DEFLATE)
+        if self.striping_enabled:
+            caps.add(handshake.STRIPE)
+        if self.tls is not None:
+            caps.add(handshake.TLS)
+        return caps
+    
+    def hello_message(self, msg_type):
+        """Our connect or connect_ack"""
+        message = {
+            'type': msg_type,
+            'user_id': self.user_id,
+            'name': self.current_user,
+            'ip': self.user_ip,
+            'file_port': self.file_port,
+            'addresses': self.local_addresses() if self.striping_enabled else [],
+            'version': self.user_directory.get(self.user_id, {}).get('version', 0)
+        }
+        message.update(handshake.hello(self.capabilities()))
+        return message
+    
+    def apply_handshake(self, user_id, message, sock):
+        """Use the features both sides offered on a new connection"""
+        protocol, caps = handshake.negotiate(self.capabilities(), message)
+        encryption = None
+        if isinstance(sock, tls.TlsSocket):
+            verified = sock.peer_id == user_id or self.tls.verified_id(sock) == user_id
+            encryption = 'pinned' if verified else 'unverified'
+        self.peer_features[user_id] = {'protocol': protocol, 'caps': caps, 'encryption': encryption}
+        if user_id in self.user_directory:
+            self.user_directory[user_id]['tls'] = handshake.TLS in handshake.offered(message)[1]
+        if handshake.MUX in caps:
+            self.start_mux_session(sock)
+        self.peer_addresses[user_id] = (message.get('addresses') or []) if handshake.STRIPE in caps else []
+    
+    def uses(self, user_id, cap):
+        """Whether our connection to a user negotiated a feature"""
+        features = self.peer_features.get(user_id)
+        return features is not None and cap in features['caps']
+    
+    def numbered(self, user_id):
+        """Whether chat to a user goes through the send window.
+        
+        Users behind the hub or a relay have no handshake with us, they
+        are taken to be current.
+        """
+        features = self.peer_features.get(user_id)
+        return features is None or handshake.RESUME in features['caps']
+    
+    def describe_connection(self, user_id):
+        features = self.peer_features.get(user_id)
+        if features is None:
+            return None
+        encryption = {'pinned': "encrypted, pinned", 'unverified': "encrypted, unverified"}.get(
+            features.get('encryption'), "unencrypted")
+        return f"protocol {features['protocol']}, {encryption}: {', '.join(sorted(features['caps'])) or 'basic'}"
+    
+    def start_mux_session(self, sock):
+        """Switch a connection to multiplexed framing"""
+        if sock not in self.mux_sessions:
+            self.mux_sessions[sock] = MuxSession(self.get_writer(sock), on_stream=self.on_mux_stream)
+    
+    def on_mux_stream(self, stream):
+        """Peer opened a logical stream on its chat connection"""
+        if stream.info.get('purpose') == 'file':
+            threading.Thread(target=self.handle_file_transfer,
+                           args=(stream, None), daemon=True).start()
+        else:
+            stream.reset("Unknown stream purpose")
+    
+    def process_message(self, message, sock):
+        """Process one incoming JSON message"""
+        try:
+            msg_type = message.get('type')
+            
+            if msg_type == 'connect':
+                user_id = message.get('user_id')
+                user_name = message.get('name')
+                user_ip = message.get('ip')
+                file_port = message.get('file_port', self.file_port)
+                if not self.admit_peer(user_id, sock):
+                    self.forget_socket(sock)
+                    self.close_socket(sock)
+                    return
+                
+                # Both sides dialed at once (e.g. after a restart): keep the
+                # connection opened by the lower user ID, drop the other one
+                existing = self.connected_users.get(user_id)
+                if existing is not None and existing is not sock and existing is not self.hub_socket:
+                    if (self.user_id < user_id
+                            and time.time() - self.dial_times.get(user_id, 0) < 10):
+                        self.forget_socket(sock)
+                        sock.close()
+                        return
+                    self.forget_socket(existing)
+                    self.close_socket(existing)
+                
+                self.user_directory[user_id] = {
+                    "name": user_name,
+                    "ip": user_ip,
+                    "last_seen": datetime.now().isoformat(),
+                    "is_online": True,
+                    "file_port": file_port,
+                    "version": message.get('version') or self.user_directory.get(user_id, {}).get('version', 0)
+                }
+                self.directory_digest = None
+                
+                self.connected_users[user_id] = sock
+                self.mark_alive(user_id)
+                self.save_config()
+                
+                # Answer before switching, the ack itself goes in the old format
+                response = json.dumps(self.hello_message('connect_ack'))
+                self.get_writer(sock).write(response.encode('utf-8'), PRIORITY_CONTROL)
+                self.apply_handshake(user_id, message, sock)
+                self.sync_rooms_with(user_id)
+                self.resume_delivery(user_id)
+                self.schedule_advert()
+                
+                self.call_later(0, self.update_contacts_list)
+                self.call_later(0, self.add_chat_message,
+                              f"{user_name} connected", "system")
+            
+            elif msg_type == 'connect_ack':
+                user_id = message.get('user_id')
+                user_name = message.get('name')
+                user_ip = message.get('ip')
+                file_port = message.get('file_port', self.file_port)
+                if not self.admit_peer(user_id, sock):
+                    self.remove_connection(sock)
+                    self.close_socket(sock)
+                    return
+                
+                self.user_directory[user_id] = {
+                    "name": user_name,
+                    "ip": user_ip,
+                    "last_seen": datetime.now().isoformat(),
+                    "is_online": True,
+                    "file_port": file_port,
+                    "version": message.get('version') or self.user_directory.get(user_id, {}).get('version', 0)
+                }
+                self.directory_digest = None
+                
+                self.apply_handshake(user_id, message, sock)
+                self.sync_rooms_with(user_id)
+                self.resume_delivery(user_id)
+                self.schedule_advert()
+                self.send_digest(user_id)
+                
+                self.mark_alive(user_id)
+                self.save_config()
+                self.call_later(0, self.update_contacts_list)
+                self.call_later(0, self.add_chat_message,
+                              f"Connected to {user_name}", "system")
+            
+            elif msg_type == 'hub_welcome':
+                for user in message.get('users', []):
+                    self.on_hub_presence(user, True)
+            
+            elif msg_type == 'hub_presence':
+                for change in message.get('changes', []):
+                    self.on_hub_presence(change.get('user') or {}, change.get('online'))
+            
+            elif msg_type == 'message':
+                from_id = message.get('from_id')
+                from_name = message.get('from_name')
+                msg_text = message.get('message')
+                
+                # Messages are acknowledged, and a resent copy only that
+                msg_id = message.get('msg_id')
+                seq = message.get('seq')
+                if seq is not None:
+                    window = self.receive_windows.get(from_id)
+                    if window is None:
+                        window = self.receive_windows[from_id] = ReceiveWindow()
+                    new = window.receive(message.get('epoch'), seq)
+                    self.acknowledge_message(from_id)
+                    if not new:
+                        return
+                elif msg_id and message.get('queued'):
+                    self.acknowledge_message(from_id, msg_id)
+                if msg_id and self.seen_message(msg_id):
+                    return
+                
+                if from_id in self.user_directory:
+                    self.user_directory[from_id]['last_seen'] = datetime.now().isoformat()
+                    self.user_directory[from_id]['is_online'] = True
+                self.mark_alive(from_id)
+                
+                self.call_later(0, self.on_chat_message, from_id, from_name, msg_text)
+                self.emit('message', {'from_id': from_id, 'from_name': from_name, 'text': msg_text,
+                                      'msg_id': msg_id, 'timestamp': message.get('timestamp')})
+            
+            elif msg_type in ('dir_digest', 'dir_versions', 'dir_pull', 'dir_entries'):
+                self.on_directory_gossip(message)
+            
+            elif msg_type == 'route_advert':
+                from_id = message.get('from_id')
+                if sock is not None and sock is self.connected_users.get(from_id) and sock is not self.hub_socket:
+                    self.on_routes_changed(self.routes.update(from_id, message.get('routes') or {}, self.user_id))
+            
+            elif msg_type == 'routed':
+                self.on_routed(message)
+            
+            elif msg_type == 'message_ack':
+                from_id = message.get('from_id')
+                msg_ids = list(message.get('msg_ids', []))
+                window = self.send_windows.get(from_id)
+                if window and 'ack' in message and message.get('epoch') == self.delivery_epoch:
+                    acked = window.ack(message['ack'], message.get('sack', []))
+                    msg_ids.extend(m.get('msg_id') for m in acked if m.get('queued'))
+                if msg_ids:
+                    with self.outbox_lock:
+                        if self.outbox.ack(from_id, msg_ids):
+                            self.schedule_outbox_flush()
+            
+            elif msg_type == 'room_message':
+                self.on_room_message(message)
+            
+            elif msg_type == 'room_history':
+                if message.get('from_id') in self.rooms.members_of(message.get('room')):
+                    for item in message.get('messages', [])[-self.rooms.catchup_limit:]:
+                        if item.get('room') == message.get('room'):
+                            self.on_room_message(item)
+            
+            elif msg_type == 'room_invite':
+                self.on_room_invite(message)
+            
+            elif msg_type in ('room_join', 'room_leave'):
+                self.on_room_membership(message)
+            
+            elif msg_type == 'room_sync':
+                self.on_room_sync(message)
+            
+            elif msg_type == 'file_request':
+                self.receive_offer(message)
+            
+            elif msg_type == 'file_accept':
+                self.on_offer_accepted(message)
+            
+            elif msg_type == 'file_reject':
+                self.on_offer_rejected(message)
+            
+            elif msg_type == 'file_cancel':
+                self.on_offer_cancelled(message)
+        
+        except Exception as e:
+            print(f"Error processing message: {e}")
+    
+    def receive_offer(self, message):
+        """Hold an incoming file offer until the user answers it"""
+        from_id = message.get('from_id')
+        transfer_id = message.get('transfer_id')
+        key = (from_id, transfer_id)
+        self.pending_offers[key] = {
+            'message': message,
+            'event': threading.Event(),  # set once the offer is answered
+            'accepted': False,
+            'dialog': None
+        }
+        
+        # Ask user to accept file
+        self.call_later(0, self.show_file_request_dialog, from_id, message.get('from_name'),
+                        message.get('filename'), message.get('filesize'), transfer_id)
+        
+        def auto_reject():
+            if self.reject_offer(key):
+                self.add_chat_message(f"Auto-rejected file: {message.get('filename')}", "system")
+        
+        self.call_later(self.offer_reply_timeout * 1000, auto_reject)
+        self.emit('file_offer', {'from_id': from_id, 'from_name': message.get('from_name'),
+                                 'transfer_id': transfer_id, 'filename': message.get('filename'),
+                                 'filesize': message.get('filesize')})
+    
+    def accept_offer(self, key):
+        """Accept an incoming offer: save inlined data or let the sender connect"""
+        offer = self.pending_offers.pop(key, None)
+        if offer is None:
+            return False
+        message = offer['message']
+        from_id, transfer_id = key
+        filename = message.get('filename')
+        
+        # Create transfer entry
+        transfer = self.file_transfers.add(key, {
+            'type': 'receiving',
+            'filename': filename,
+            'size': message.get('filesize'),
+            'progress': 0,
+            'status': 'pending',
+            'user_id': from_id
+        })
+        reply = {'type': 'file_accept', 'from_id': self.user_id, 'transfer_id': transfer_id}
+        
+        if 'data' in message:
+            try:
+                transfer['save_path'] = self.save_inline_file(from_id, filename, message['data'])
+                transfer['progress'] = 100
+                transfer['status'] = 'completed'
+                reply['received'] = True
+                self.call_later(0, self.add_chat_message,
+                                f"📁 Received file from {message.get('from_name')}: {filename}", "system")
+                self.call_later(3000, lambda: self.show_file_received_notification(transfer['save_path'], filename))
+                self.emit('file_received', {'from_id': from_id, 'filename': filename, 'path': transfer['save_path']})
+            except Exception as e:
+                print(f"File transfer error: {e}")
+                transfer['status'] = 'failed'
+                reply = {'type': 'file_reject', 'from_id': self.user_id, 'transfer_id': transfer_id}
+        
+        offer['accepted'] = True
+        offer['event'].set()
+        self.close_offer_dialog(offer)
+        if from_id in self.connected_users:
+            self.send_control(from_id, reply, PRIORITY_CONTROL)
+        self.call_later(0, self.update_transfers_display)
+        return True
+    
+    def reject_offer(self, key):
+        """Turn down an incoming offer, returns False if it was already answered"""
+        offer = self.pending_offers.pop(key, None)
+        if offer is None:
+            return False
+        offer['event'].set()
+        self.close_offer_dialog(offer)
+        from_id, transfer_id = key
+        if from_id in self.connected_users:
+            self.send_control(from_id, {
+                'type': 'file_reject',
+                'from_id': self.user_id,
+                'transfer_id': transfer_id
+            }, PRIORITY_CONTROL)
+        return True
+    
+    def on_offer_cancelled(self, message):
+        """The sender withdrew an offer we haven't answered"""
+        offer = self.pending_offers.pop((message.get('from_id'), message.get('transfer_id')), None)
+        if offer:
+            offer['event'].set()
+            self.close_offer_dialog(offer)
+            self.call_later(0, self.add_chat_message,
+                            f"File offer withdrawn: {offer['message'].get('filename')}", "system")
+    
+    def wait_for_acceptance(self, key):
+        """Whether an incoming data connection belongs to an accepted offer"""
+        transfer = self.file_transfers.get(key)
+        if transfer and transfer['type'] == 'receiving' and transfer['status'] == 'pending':
+            return True
+        offer = self.pending_offers.get(key)
+        if offer is None:
+            return False
+        # Older senders connect before the user answers, hold them until then
+        offer['event'].wait(self.offer_reply_timeout + 5)
+        return offer['accepted']
+    
+    def save_inline_file(self, from_id, filename, data):
+        """Write a file that came inside its offer, returns the saved path"""
+        data = base64.b64decode(data)
+        if not self.has_room_for(len(data)):
+            raise Exception(f"Not enough disk space for {filename}")
+        save_path = self.unique_save_path(filename)
+        with self.open_part_file(save_path + '.part', len(data)) as f:
+            f.write(data)
+            self.sync_file(f)
+        os.replace(save_path + '.part', save_path)
+        self.remember_received(from_id, filename, save_path)
+        return save_path
+    
+    def unique_save_path(self, filename, directory=False):
+        """A download path no other download has, with its .part file or folder created.
+        
+        Downloads of the same name in the same second get _2, _3, ... The
+        .part is created exclusively, so two receives can't pick one name.
+        """
+        safe_filename = "".join(c for c in filename if c.isalnum() or c in (' ', '.', '_', '-')).rstrip()
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        stem, ext = (safe_filename, '') if directory else os.path.splitext(safe_filename)
+        count = 1
+        while True:
+            suffix = f"_{count}" if count > 1 else ""
+            save_path = os.path.join(self.download_dir, f"{timestamp}_{stem}{suffix}{ext}")
+            count += 1
+            try:
+                if directory:
+                    os.mkdir(save_path + '.part')
+                else:
+                    os.close(os.open(save_path + '.part', os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            except FileExistsError:
+                continue
+            if not os.path.exists(save_path):
+                return save_path
+            # A finished download has the name, give the .part back
+            if directory:
+                os.rmdir(save_path + '.part')
+            else:
+                os.remove(save_path + '.part')
+    
+    def remove_connection(self, sock):
+        """Remove a connection"""
+        self.forget_socket(sock)
+        
+        if sock is self.hub_socket:
+            self.hub_socket = None
+            for user_id in [u for u, s in self.connected_users.items() if s is sock]:
+                del self.connected_users[user_id]
+                if user_id in self.user_directory:
+                    self.user_directory[user_id]['is_online'] = False
+                self.schedule_reconnect(user_id)
+            self.hub_users.clear()
+            self.call_later(0, self.update_contacts_list)
+            self.call_later(0, self.add_chat_message, "Lost connection to the hub", "system")
+            self.hub_wakeup.set()
+            self.close_socket(sock)
+            return
+        
+        user_id_to_remove = None
+        for user_id, user_sock in self.connected_users.items():
+            if user_sock == sock:
+                user_id_to_remove = user_id
+                break
+        
+        if user_id_to_remove:
+            del self.connected_users[user_id_to_remove]
+            self.peer_features.pop(user_id_to_remove, None)
+            self.peer_addresses.pop(user_id_to_remove, None)
+            
+            self.sent_adverts.pop(user_id_to_remove, None)
+            self.on_routes_changed(self.routes.drop(user_id_to_remove))
+            self.schedule_advert()
+            
+            window = self.send_windows.get(user_id_to_remove)
+            if user_id_to_remove in self.hub_users and self.hub_socket:
+                # Still reachable through the hub, resend what the old socket lost
+                self.connected_users[user_id_to_remove] = self.hub_socket
+                self.resume_delivery(user_id_to_remove)
+            elif self.routes.next_hop(user_id_to_remove):
+                # ...or through a relay
+                self.resume_delivery(user_id_to_remove)
+                self.schedule_reconnect(user_id_to_remove)
+            else:
+                if user_id_to_remove in self.user_directory:
+                    self.user_directory[user_id_to_remove]['is_online'] = False
+                
+                self.call_later(0, self.add_chat_message,
+                              f"User disconnected", "system")
+                if window and window.unacked:
+                    self.call_later(0, self.add_chat_message,
+                                  f"{len(window.unacked)} message(s) not confirmed yet, they will be resent", "system")
+                
+                self.schedule_reconnect(user_id_to_remove)
+            self.call_later(0, self.update_contacts_list)
+        
+        self.close_socket(sock)
+    
+    def close_socket(self, sock):
+        """Close a chat socket at once, even while check_messages is selecting on it"""
+        try:
+            # close() alone waits for select() to let go of the socket
+            sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            sock.close()
+        except:
+            pass
+        self.wake_selector()
+    
+    def shutdown(self):
+        """Stop the threads, save state and close every socket"""
+        self.messenger_active = False
+        self.reconnect_wakeup.set()
+        self.wake_selector()
+        if self.ipc_server:
+            self.ipc_server.close()
+        
+        # Close all connections
+        self.hub_wakeup.set()
+        self.write_rooms()
+        # Unacked messages are numbered for this run only, keep them as queued
+        with self.outbox_lock:
+            for user_id, window in self.send_windows.items():
+                for message in window.pending():
+                    if not message.get('queued'):
+                        self.outbox.append(user_id, dict(message, queued=True))
+        self.flush_outbox()
+        for sock in set(self.connected_users.values()) | ({self.hub_socket} if self.hub_socket else set()):
+            self.forget_socket(sock)
+            self.close_socket(sock)
+        for pending in list(self.pending.values()):
+            self.drop_pending(pending, True)
+        
+        if self.messenger_server:
+            try:
+                self.messenger_server.close()
+            except:
+                pass
+        
+        if self.file_server:
+            try:
+                self.file_server.close()
+            except:
+                pass
+
+
+def main(argv=None):
+    """Run a node without a window: python messenger.py --headless"""
+    parser = argparse.ArgumentParser(description="Run the messenger without a window")
+    parser.add_argument('--headless', action='store_true', help="accepted for messenger.py compatibility")
+    parser.add_argument('--name', help="user name on first start (default: the login name)")
+    args = parser.parse_args(argv)
+    
+    core = MessengerCore()
+    if not (core.current_user and core.user_id):
+        core.current_user = args.name or getpass.getuser()
+        core.user_id = core.generate_user_id(core.current_user)
+        core.user_ip = core.get_local_ip()
+        core.save_config()
+    core.start_network()
+    print(f"Running headless as {core.current_user} ({core.user_id}) on {core.user_ip}:{core.user_port}")
+    
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    while not stop.wait(1):
+        pass
+    core.shutdown()
+
+if __name__ == "__main__":
+    main()
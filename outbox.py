@@ -0,0 +1,112 @@
+import collections
+import json
+import os
+import threading
+
+
+class Outbox:
+    """Undelivered messages per recipient, persisted as JSON lines.
+    
+    append() only buffers; flush() writes the buffered lines with one append
+    per recipient, and rewrites a recipient's file once acks have removed
+    entries from it. Entries are numbered per recipient, so a drain can walk
+    the queue with a cursor while acks remove entries from the front.
+    """
+    
+    def __init__(self, directory, max_per_user=10000):
+        self.directory = directory
+        self.max_per_user = max_per_user
+        self.queues = {}    # user_id: OrderedDict of seq: message
+        self.msg_seqs = {}  # user_id: {msg_id: seq}
+        self.next_seq = collections.Counter()
+        self.unwritten = collections.defaultdict(list)  # user_id: lines to append
+        self.rewrite = set()  # user_ids whose file lost entries
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+    
+    def path(self, user_id):
+        safe = "".join(c for c in user_id if c.isalnum() or c in '-_')
+        return os.path.join(self.directory, f"{safe}.jsonl")
+    
+    def load(self):
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.jsonl'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), 'r') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue  # torn last line after a crash
+                        self.add(entry['to'], entry['seq'], entry['message'])
+            except (OSError, KeyError):
+                pass
+    
+    def add(self, user_id, seq, message):
+        queue = self.queues.setdefault(user_id, collections.OrderedDict())
+        queue[seq] = message
+        self.msg_seqs.setdefault(user_id, {})[message.get('msg_id')] = seq
+        self.next_seq[user_id] = max(self.next_seq[user_id], seq + 1)
+        while len(queue) > self.max_per_user:
+            _, dropped = queue.popitem(last=False)
+            self.msg_seqs[user_id].pop(dropped.get('msg_id'), None)
+            self.rewrite.add(user_id)
+    
+    def append(self, user_id, message):
+        with self.lock:
+            seq = self.next_seq[user_id]
+            self.add(user_id, seq, message)
+            self.unwritten[user_id].append(json.dumps({'to': user_id, 'seq': seq, 'message': message}) + '\n')
+            return seq
+    
+    def after(self, user_id, seq, limit):
+        """Up to limit (seq, message) entries numbered above seq, oldest first"""
+        with self.lock:
+            entries = []
+            for entry_seq, message in self.queues.get(user_id, {}).items():
+                if entry_seq > seq:
+                    entries.append((entry_seq, message))
+                    if len(entries) >= limit:
+                        break
+            return entries
+    
+    def ack(self, user_id, msg_ids):
+        """Drop delivered messages, returns how many were still queued"""
+        with self.lock:
+            queue = self.queues.get(user_id)
+            seqs = self.msg_seqs.get(user_id, {})
+            removed = 0
+            for msg_id in msg_ids:
+                seq = seqs.pop(msg_id, None)
+                if seq is not None and queue.pop(seq, None) is not None:
+                    removed += 1
+            if removed:
+                self.rewrite.add(user_id)
+            return removed
+    
+    def pending(self, user_id):
+        return len(self.queues.get(user_id, ()))
+    
+    def flush(self):
+        """Write buffered appends and compact files that lost entries"""
+        with self.lock:
+            for user_id in list(self.rewrite):
+                path = self.path(user_id)
+                queue = self.queues.get(user_id)
+                if not queue:
+                    if os.path.exists(path):
+                        os.remove(path)
+                else:
+                    with open(path + '.tmp', 'w') as f:
+                        for seq, message in queue.items():
+                            f.write(json.dumps({'to': user_id, 'seq': seq, 'message': message}) + '\n')
+                    os.replace(path + '.tmp', path)
+                self.unwritten.pop(user_id, None)
+            self.rewrite.clear()
+            
+            for user_id, lines in self.unwritten.items():
+                with open(self.path(user_id), 'a') as f:
+                    f.write(''.join(lines))
+            self.unwritten.clear()
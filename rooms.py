@@ -0,0 +1,114 @@
+import collections
+import threading
+import uuid
+
+
+class RoomIndex:
+    """Named rooms, indexed by room and by member, with bounded history.
+    
+    Each room keeps its last history_limit messages. Message IDs already in
+    a room are remembered so copies arriving over two paths (direct and via
+    the hub) are only shown once. Late joiners and reconnecting members get
+    at most catchup_limit messages.
+    """
+    
+    def __init__(self, history_limit=500, catchup_limit=50):
+        self.history_limit = history_limit
+        self.catchup_limit = catchup_limit
+        self.rooms = {}  # room_id: {"name": "", "members": {user_id: name}}
+        self.member_rooms = collections.defaultdict(set)  # user_id: room_ids
+        self.history = {}  # room_id: deque of messages, oldest first
+        self.seen = {}     # room_id: msg_ids in its history
+        self.lock = threading.RLock()
+    
+    @staticmethod
+    def new_id():
+        return 'r' + uuid.uuid4().hex[:12]
+    
+    def create(self, room_id, name, members=None):
+        with self.lock:
+            if room_id not in self.rooms:
+                self.rooms[room_id] = {'name': name, 'members': {}}
+                self.history[room_id] = collections.deque(maxlen=self.history_limit)
+                self.seen[room_id] = set()
+            for user_id, user_name in (members or {}).items():
+                self.join(room_id, user_id, user_name)
+            return self.rooms[room_id]
+    
+    def join(self, room_id, user_id, name):
+        """Add a member, returns False if they were in already"""
+        with self.lock:
+            members = self.rooms[room_id]['members']
+            new = user_id not in members
+            members[user_id] = name
+            self.member_rooms[user_id].add(room_id)
+            return new
+    
+    def leave(self, room_id, user_id):
+        with self.lock:
+            room = self.rooms.get(room_id)
+            if room:
+                room['members'].pop(user_id, None)
+            rooms = self.member_rooms.get(user_id)
+            if rooms is not None:
+                rooms.discard(room_id)
+                if not rooms:
+                    del self.member_rooms[user_id]
+    
+    def remove(self, room_id):
+        """Forget a room we left"""
+        with self.lock:
+            for user_id in list(self.rooms.get(room_id, {}).get('members', ())):
+                self.leave(room_id, user_id)
+            self.rooms.pop(room_id, None)
+            self.history.pop(room_id, None)
+            self.seen.pop(room_id, None)
+    
+    def members_of(self, room_id):
+        with self.lock:
+            return dict(self.rooms.get(room_id, {}).get('members', {}))
+    
+    def rooms_of(self, user_id):
+        with self.lock:
+            return set(self.member_rooms.get(user_id, ()))
+    
+    def name_of(self, room_id):
+        return self.rooms.get(room_id, {}).get('name', room_id)
+    
+    def add_message(self, room_id, message):
+        """Store a message, returns False for one we have already"""
+        with self.lock:
+            history = self.history.get(room_id)
+            if history is None or message.get('msg_id') in self.seen[room_id]:
+                return False
+            if len(history) == history.maxlen:
+                self.seen[room_id].discard(history[0].get('msg_id'))
+            history.append(message)
+            self.seen[room_id].add(message.get('msg_id'))
+            return True
+    
+    def catchup(self, room_id, since=None):
+        """Messages newer than `since` (a timestamp), at most catchup_limit"""
+        with self.lock:
+            history = self.history.get(room_id, ())
+            messages = [m for m in history if since is None or m.get('timestamp', '') > since]
+            return messages[-self.catchup_limit:]
+    
+    def latest(self, room_id):
+        """Timestamp of the newest message we have"""
+        with self.lock:
+            history = self.history.get(room_id)
+            return history[-1].get('timestamp') if history else None
+    
+    def to_json(self):
+        with self.lock:
+            return {room_id: {'name': room['name'], 'members': room['members'],
+                              'history': list(self.history[room_id])}
+                    for room_id, room in self.rooms.items()}
+    
+    def load_json(self, data):
+        with self.lock:
+            for room_id, room in data.items():
+                self.create(room_id, room.get('name', room_id), room.get('members'))
+                for message in room.get('history', []):
+                    self.add_message(room_id, message)
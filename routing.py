@@ -0,0 +1,91 @@
+import collections
+import threading
+
+MAX_HOPS = 4  # routes longer than this are not advertised, routed messages die after it
+
+# Messages that may travel through relays. Everything else (connects,
+# file transfers) needs a direct connection.
+ROUTABLE = {'message', 'message_ack', 'room_message', 'room_invite', 'room_join', 'room_leave',
+            'room_sync', 'room_history'}
+
+
+class RouteTable:
+    """Routes to users we can't reach directly, learned from neighbour adverts.
+    
+    Each forwarding neighbour advertises how many hops it is from every user
+    it can reach. A user is reached through the neighbour with the fewest
+    hops, so a message follows one path instead of being flooded. Routes a
+    neighbour taught us are not advertised back to it (split horizon), which
+    with the hop limit keeps stale routes from counting up forever.
+    """
+    
+    def __init__(self, max_hops=MAX_HOPS):
+        self.max_hops = max_hops
+        self.adverts = {}  # neighbour_id: {user_id: hops from that neighbour}
+        self.lock = threading.Lock()
+    
+    def snapshot(self):
+        with self.lock:
+            return {user_id: self.best(user_id) for routes in self.adverts.values() for user_id in routes}
+    
+    def best(self, user_id):
+        """(neighbour, hops) of the shortest route, ties go to the lowest ID"""
+        found = None
+        for neighbour, routes in self.adverts.items():
+            hops = routes.get(user_id)
+            if hops is not None and (found is None or (hops + 1, neighbour) < (found[1], found[0])):
+                found = (neighbour, hops + 1)
+        return found
+    
+    def update(self, neighbour, routes, own_id):
+        """Replace a neighbour's advert, returns the users whose route changed"""
+        routes = {user_id: hops for user_id, hops in routes.items()
+                  if user_id not in (own_id, neighbour) and isinstance(hops, int) and 0 < hops < self.max_hops}
+        before = self.snapshot()
+        with self.lock:
+            self.adverts[neighbour] = routes
+        return self.changed(before)
+    
+    def drop(self, neighbour):
+        """Forget a neighbour that disconnected, returns the users whose route changed"""
+        before = self.snapshot()
+        with self.lock:
+            self.adverts.pop(neighbour, None)
+        return self.changed(before)
+    
+    def changed(self, before):
+        after = self.snapshot()
+        return {user_id for user_id in set(before) | set(after) if before.get(user_id) != after.get(user_id)}
+    
+    def next_hop(self, user_id):
+        with self.lock:
+            found = self.best(user_id)
+        return found[0] if found else None
+    
+    def advert(self, direct, to):
+        """What we tell neighbour `to`: our direct peers, then learned routes"""
+        routes = {user_id: 1 for user_id in direct if user_id != to}
+        for user_id, (neighbour, hops) in self.snapshot().items():
+            if user_id not in routes and user_id != to and neighbour != to and hops < self.max_hops:
+                routes[user_id] = hops
+        return routes
+
+
+class SeenCache:
+    """Bounded LRU of message IDs, so copies and loops are dropped"""
+    
+    def __init__(self, limit=10000):
+        self.limit = limit
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+    
+    def check(self, msg_id):
+        """Whether an ID was seen, remembering it if not"""
+        with self.lock:
+            if msg_id in self.ids:
+                self.ids.move_to_end(msg_id)
+                return True
+            self.ids[msg_id] = True
+            while len(self.ids) > self.limit:
+                self.ids.popitem(last=False)
+            return False
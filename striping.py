@@ -0,0 +1,121 @@
+import os
+import struct
+import threading
+import time
+
+# On a stripe connection: offset, length, then the bytes. A zero length
+# ends the connection. Each range is confirmed with b'K' once written.
+STRIPE_RANGE = struct.Struct('!QI')
+
+
+def pair_addresses(local, remote, limit):
+    """Source/destination address pairs for the paths of a striped transfer.
+    
+    Each local address is matched with an unused remote one on the same /24
+    where possible (wired to wired, Wi-Fi to Wi-Fi), otherwise round-robin.
+    """
+    pairs = []
+    unused = list(remote)
+    for index in range(min(max(len(local), len(remote)), limit)):
+        source = local[index % len(local)]
+        prefix = source.rsplit('.', 1)[0]
+        same_subnet = [ip for ip in unused if ip.rsplit('.', 1)[0] == prefix]
+        if same_subnet:
+            destination = same_subnet[0]
+        elif unused:
+            destination = unused[0]
+        else:
+            destination = remote[index % len(remote)]
+        if destination in unused:
+            unused.remove(destination)
+        if (source, destination) not in pairs:
+            pairs.append((source, destination))
+    return pairs
+
+
+class StripeScheduler:
+    """Hands out file ranges to the paths of a striped transfer.
+    
+    Faster paths come back for work more often, and each range is sized to
+    about target_seconds of the asking path's measured rate, so a slow path
+    never holds a big range at the end. A range whose path fails is given
+    back and picked up by another one.
+    """
+    
+    def __init__(self, size, min_range=256 * 1024, max_range=8 * 1024 * 1024, target_seconds=0.25):
+        self.size = size
+        self.min_range = min_range
+        self.max_range = max_range
+        self.target_seconds = target_seconds
+        self.cond = threading.Condition()
+        self.next_offset = 0
+        self.retry = []
+        self.outstanding = set()
+        self.completed = 0
+        self.rates = {}  # path: bytes per second, smoothed
+    
+    def take(self, path):
+        """Next (offset, length) for a path, None once everything is sent"""
+        with self.cond:
+            while True:
+                if self.retry:
+                    span = self.retry.pop()
+                elif self.next_offset < self.size:
+                    rate = self.rates.get(path)
+                    length = int(rate * self.target_seconds) if rate else 4 * self.min_range
+                    length = max(self.min_range, min(self.max_range, length))
+                    length = min(length, self.size - self.next_offset)
+                    span = (self.next_offset, length)
+                    self.next_offset += length
+                elif self.outstanding:
+                    # Another path may fail and give its range back
+                    self.cond.wait()
+                    continue
+                else:
+                    return None
+                self.outstanding.add(span)
+                return span
+    
+    def done(self, path, span, elapsed):
+        with self.cond:
+            self.outstanding.discard(span)
+            self.completed += span[1]
+            rate = span[1] / max(elapsed, 0.001)
+            previous = self.rates.get(path)
+            self.rates[path] = rate if previous is None else 0.7 * previous + 0.3 * rate
+            self.cond.notify_all()
+    
+    def give_back(self, span):
+        with self.cond:
+            self.outstanding.discard(span)
+            self.retry.append(span)
+            self.cond.notify_all()
+
+
+class StripeSink:
+    """Positional writes from several stripe connections into one file"""
+    
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+        self.lock = threading.Lock()
+        self.received = 0  # bytes of fully received ranges
+        self.done = set()  # offsets of those ranges, a range given back and resent counts once
+        self.last_write = time.time()
+    
+    def write(self, offset, data):
+        if offset + len(data) > self.size:
+            raise ValueError("Stripe range past the end of the file")
+        if hasattr(os, 'pwrite'):
+            os.pwrite(self.f.fileno(), data, offset)
+        else:
+            with self.lock:
+                self.f.seek(offset)
+                self.f.write(data)
+        self.last_write = time.time()
+    
+    def range_done(self, offset, length):
+        with self.lock:
+            if offset not in self.done:
+                self.done.add(offset)
+                self.received += length
@@ -0,0 +1,121 @@
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compression
+import messenger_core
+import striping
+from messenger_core import MessengerCore
+
+
+class UniqueSavePathTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = tempfile.mkdtemp()
+        self.core = MessengerCore()
+        # Every name below is picked in the same second
+        frozen = messenger_core.datetime(2026, 1, 2, 3, 4, 5)
+        patcher = mock.patch.object(messenger_core, 'datetime', wraps=messenger_core.datetime)
+        self.addCleanup(patcher.stop)
+        patcher.start().now.return_value = frozen
+    
+    def tearDown(self):
+        if self.home is not None:
+            os.environ['HOME'] = self.home
+    
+    def test_same_name_same_second_gets_own_part_file(self):
+        first = self.core.unique_save_path('report.pdf')
+        second = self.core.unique_save_path('report.pdf')
+        self.assertNotEqual(first, second)
+        self.assertTrue(second.endswith('20260102_030405_report_2.pdf'))
+        self.assertTrue(os.path.isfile(first + '.part'))
+        self.assertTrue(os.path.isfile(second + '.part'))
+    
+    def test_skips_names_of_finished_downloads(self):
+        first = self.core.unique_save_path('report.pdf')
+        os.replace(first + '.part', first)
+        second = self.core.unique_save_path('report.pdf')
+        self.assertNotEqual(first, second)
+        self.assertFalse(os.path.exists(first + '.part'))
+    
+    def test_folders_reserve_a_part_folder(self):
+        first = self.core.unique_save_path('photos', directory=True)
+        second = self.core.unique_save_path('photos', directory=True)
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.isdir(first + '.part'))
+        self.assertTrue(os.path.isdir(second + '.part'))
+
+
+class StripedStatusTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = tempfile.mkdtemp()
+        self.core = MessengerCore()
+    
+    def tearDown(self):
+        if self.home is not None:
+            os.environ['HOME'] = self.home
+    
+    def test_status_split_across_a_timeout(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        
+        def send_in_pieces():
+            theirs.sendall(b'DO')
+            time.sleep(1.5)  # longer than the 1s read timeout
+            theirs.sendall(b'NE')
+        threading.Thread(target=send_in_pieces, daemon=True).start()
+        with tempfile.TemporaryFile() as f:
+            self.core.receive_striped(ours, f, 0, ('aaaa0001', 1))
+
+
+    def test_resent_range_counts_once(self):
+        with tempfile.TemporaryFile() as f:
+            sink = striping.StripeSink(f, 8)
+            sink.write(0, b'abcd')
+            sink.range_done(0, 4)
+            # Its K was lost, the sender gives it back and another stripe resends it
+            sink.write(0, b'abcd')
+            sink.range_done(0, 4)
+            sink.write(4, b'efgh')
+            sink.range_done(4, 4)
+            self.assertEqual(sink.received, 8)
+
+
+
+class CompressedStreamTest(unittest.TestCase):
+    
+    def test_reader_reports_wire_bytes(self):
+        data = b'all work and no play ' * 20000
+        wire = b''.join(chunk for chunk, _ in compression.compress_chunks([(data, len(data))]))
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        theirs.sendall(wire)
+        theirs.shutdown(socket.SHUT_WR)
+        
+        counted = []
+        reader = compression.InflatingReader(ours, counted.append)
+        received = b''
+        while True:
+            chunk = reader.recv(65536)
+            if not chunk:
+                break
+            received += chunk
+        self.assertEqual(received, data)
+        self.assertEqual(sum(counted), len(wire))
+        self.assertLess(sum(counted), len(data) / 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import socket
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from messenger_core import MessengerCore
+from transport import FrameDecoder
+
+
+def make_core(user_id):
+    """A core with its own app data folder and no network started"""
+    os.environ['HOME'] = tempfile.mkdtemp()
+    core = MessengerCore()
+    core.user_id = user_id
+    core.current_user = user_id
+    return core
+
+
+def link(a, b):
+    """Connect two cores directly over a socket pair, returns (a's end, b's end)"""
+    a_end, b_end = socket.socketpair()
+    a.connected_users[b.user_id] = a_end
+    b.connected_users[a.user_id] = b_end
+    return a_end, b_end
+
+
+def receive(sock, decoder):
+    """Next JSON message written to sock's peer"""
+    sock.settimeout(5)
+    while True:
+        items = decoder.feed(sock.recv(65536))
+        if items:
+            return items[0][1]
+
+
+class RelayedRoomMembershipTest(unittest.TestCase):
+    """alice - bob - carol: alice and carol only reach each other through bob"""
+    
+    def setUp(self):
+        self.home = os.environ.get('HOME')
+        self.alice = make_core('aaaa0001')
+        self.bob = make_core('bbbb0002')
+        self.carol = make_core('cccc0003')
+        self.dave = make_core('dddd0004')
+        self.bob.forwarding_enabled = True
+        _, self.bob_from_alice = link(self.alice, self.bob)
+        _, self.carol_from_bob = link(self.bob, self.carol)
+        _, self.dave_from_alice = link(self.alice, self.dave)
+        self.alice.routes.update('bbbb0002', {'cccc0003': 1}, 'aaaa0001')
+        
+        self.room = 'r000000000001'
+        members = {'aaaa0001': 'alice', 'cccc0003': 'carol'}
+        self.alice.rooms.create(self.room, 'Team', members)
+        self.carol.rooms.create(self.room, 'Team', members)
+    
+    def tearDown(self):
+        for core in (self.alice, self.bob, self.carol, self.dave):
+            for sock in core.connected_users.values():
+                sock.close()
+        if self.home is not None:
+            os.environ['HOME'] = self.home
+    
+    def relay_to_carol(self):
+        """Pass what alice sent through bob and let carol process it"""
+        envelope = receive(self.bob_from_alice, FrameDecoder())
+        self.assertEqual(envelope['type'], 'routed')
+        self.bob.process_message(envelope, self.bob_from_alice)
+        relayed = receive(self.carol_from_bob, FrameDecoder())
+        self.carol.process_message(relayed, self.carol_from_bob)
+        return relayed['message']
+    
+    def test_join_reaches_member_behind_relay(self):
+        self.alice.invite_to_room(self.room, ['dddd0004'])
+        self.assertEqual(self.relay_to_carol()['type'], 'room_join')
+        self.assertIn('dddd0004', self.carol.rooms.members_of(self.room))
+    
+    def test_leave_reaches_member_behind_relay(self):
+        self.alice.leave_room(self.room)
+        self.assertEqual(self.relay_to_carol()['type'], 'room_leave')
+        self.assertNotIn('aaaa0001', self.carol.rooms.members_of(self.room))
+
+
+if __name__ == '__main__':
+    unittest.main()
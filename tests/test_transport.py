@@ -0,0 +1,41 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transport import FairShare
+
+
+class FairShareTest(unittest.TestCase):
+    
+    def acquire_in_thread(self, share, flow, nbytes):
+        done = threading.Event()
+        
+        def run():
+            share.acquire(flow, nbytes)
+            done.set()
+        threading.Thread(target=run, daemon=True).start()
+        return done.wait(2)
+    
+    def test_request_larger_than_full_deficit_goes_through(self):
+        share = FairShare(quantum=1024)
+        share.join('big')
+        self.assertTrue(self.acquire_in_thread(share, 'big', 10 * 1024))
+        self.assertLess(share.deficits['big'], 0)  # paid back in later rounds
+    
+    def test_debt_is_paid_back_before_sending_again(self):
+        share = FairShare(quantum=1024)
+        share.join('big')
+        share.join('small')
+        share.acquire('big', 4 * 1024)
+        share.acquire('small', 1024)
+        with share.cond:
+            share.new_round()
+        self.assertTrue(self.acquire_in_thread(share, 'small', 1024))
+        self.assertLess(share.deficits['big'], 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,453 @@
+import base64
+import hashlib
+import json
+import os
+import select
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from transport import send_all
+
+# Encrypted connections with certificates pinned per user_id.
+#
+# Every user has a self-signed certificate. The first certificate seen for
+# a user_id is pinned (like SSH host keys) and later connections must
+# present the same one. The dialer puts its own user_id in the SNI field;
+# the listener reads it from the ClientHello before the handshake and, if
+# it has a pin for that user, uses a context that demands exactly that
+# certificate. A listener without a pin for the dialer takes the connection
+# unverified and pins once it dials that user itself. Session tickets are
+# per context, so an unverified session can't be resumed as a verified one.
+#
+# Listeners tell TLS from plaintext by the first byte (a TLS record starts
+# with 0x16, messages with "{" or the frame magic), so one port serves both.
+
+TLS_RECORD_START = 0x16
+RAW_READ = 256 * 1024        # ciphertext read per recv() on the raw socket
+WRITE_BATCH = 256 * 1024     # plaintext encrypted per pass: whole 16KB records, buffers stay in cache
+RECORD_SIZE = 16 * 1024      # largest TLS record; read() allocates what it is asked for
+
+
+class PinMismatch(ConnectionError):
+    """A user presented a certificate other than the one pinned for them"""
+
+
+def tls_available():
+    return shutil.which('openssl') is not None
+
+
+def generate_identity(cert_path, key_path, common_name):
+    """Create a self-signed EC certificate and key with the openssl tool"""
+    command = ['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+               '-nodes', '-keyout', key_path, '-out', cert_path, '-days', '3650', '-subj', f'/CN={common_name}']
+    old_umask = os.umask(0o077)  # the key stays private
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+    finally:
+        os.umask(old_umask)
+
+
+def fingerprint(der):
+    return hashlib.sha256(der).hexdigest()
+
+
+def client_hello_name(data):
+    """(complete, server name) from the first TLS record of a connection"""
+    if len(data) < 5 or len(data) < 5 + int.from_bytes(data[3:5], 'big'):
+        return False, None
+    hello = data[5:5 + int.from_bytes(data[3:5], 'big')]
+    try:
+        if hello[0] != 1:  # not a ClientHello
+            return True, None
+        pos = 4 + 2 + 32                                          # header, version, random
+        pos += 1 + hello[pos]                                     # session id
+        pos += 2 + int.from_bytes(hello[pos:pos + 2], 'big')      # cipher suites
+        pos += 1 + hello[pos]                                     # compression methods
+        end = pos + 2 + int.from_bytes(hello[pos:pos + 2], 'big')
+        pos += 2
+        while pos + 4 <= end:
+            ext_type = int.from_bytes(hello[pos:pos + 2], 'big')
+            ext_len = int.from_bytes(hello[pos + 2:pos + 4], 'big')
+            if ext_type == 0:  # server_name: list length, name type, name length, name
+                name_len = int.from_bytes(hello[pos + 7:pos + 9], 'big')
+                return True, hello[pos + 9:pos + 9 + name_len].decode('ascii')
+            pos += 4 + ext_len
+    except (IndexError, UnicodeDecodeError):
+        pass
+    return True, None
+
+
+def sniff(sock, timeout):
+    """Whether a freshly accepted connection starts a TLS handshake"""
+    sock.settimeout(timeout)
+    first = sock.recv(1, socket.MSG_PEEK)
+    return first[:1] == bytes([TLS_RECORD_START])
+
+
+class TlsSocket:
+    """A socket wrapped in TLS through memory BIOs.
+    
+    ssl.SSLSocket may not be read on one thread while another writes, which
+    is how chat connections are used (check_messages reads, a PeerWriter
+    writes). Here one lock guards the TLS state and the socket only moves
+    ciphertext, so both can run at once. Records leave in the order they
+    were produced, under the send lock.
+    """
+    
+    def __init__(self, sock, context, server_side, server_hostname=None, session=None, received=b''):
+        self.sock = sock
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.incoming.write(received)
+        self.tls = context.wrap_bio(self.incoming, self.outgoing, server_side, server_hostname, session)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.peer_id = None     # user_id we dialed and checked the pin of, on the dialing side
+        self.claimed_id = None  # user_id a dialer named in the SNI field, on the listening side
+        self.on_close = None    # called with the socket once, before it closes
+    
+    def handshake(self, timeout):
+        deadline = time.time() + timeout
+        while not self.advance():
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.sock], [], [], remaining)[0]:
+                raise socket.timeout("TLS handshake timed out")
+            data = self.sock.recv(RAW_READ)
+            if not data:
+                raise ConnectionError("Connection closed during the TLS handshake")
+            with self.lock:
+                self.incoming.write(data)
+    
+    def advance(self, data=b''):
+        """One handshake step with newly received bytes, True once it is done"""
+        with self.lock:
+            if data:
+                self.incoming.write(data)
+            try:
+                self.tls.do_handshake()
+                done = True
+            except ssl.SSLWantReadError:
+                done = False
+        self.flush()
+        return done
+    
+    def flush(self):
+        """Send the records the TLS state produced"""
+        with self.send_lock:
+            with self.lock:
+                data = self.outgoing.read()
+            if data:
+                send_all(self.sock, data, self.sock.gettimeout() or 30)
+    
+    def recv(self, size):
+        """Up to size bytes of plaintext, b'' once the peer closed.
+        
+        Raises BlockingIOError on a non-blocking socket when no whole record
+        has arrived yet.
+        """
+        while True:
+            chunks = []
+            wanted = size
+            closed = False
+            with self.lock:
+                try:
+                    while wanted > 0:
+                        data = self.tls.read(min(wanted, RECORD_SIZE))
+                        if not data:
+                            break
+                        chunks.append(data)
+                        wanted -= len(data)
+                except ssl.SSLWantReadError:
+                    pass
+                except ssl.SSLZeroReturnError:
+                    closed = True  # close_notify
+                produced = self.outgoing.pending
+            if produced:
+                self.flush()  # reading may answer with records (key updates)
+            if chunks or closed:
+                return b''.join(chunks)
+            data = self.sock.recv(RAW_READ)
+            if not data:
+                return b''
+            with self.lock:
+                self.incoming.write(data)
+    
+    def pending(self):
+        """Plaintext or ciphertext already read from the socket"""
+        with self.lock:
+            return self.tls.pending() + self.incoming.pending
+    
+    def sendall(self, data):
+        view = memoryview(data)
+        with self.send_lock:
+            for start in range(0, len(view), WRITE_BATCH):
+                with self.lock:
+                    self.tls.write(view[start:start + WRITE_BATCH])
+                    records = self.outgoing.read()
+                send_all(self.sock, records, self.sock.gettimeout() or 30)
+    
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+    
+    def peer_certificate(self):
+        return self.tls.getpeercert(binary_form=True)
+    
+    @property
+    def session(self):
+        return self.tls.session
+    
+    @property
+    def session_reused(self):
+        return self.tls.session_reused
+    
+    def close(self):
+        callback, self.on_close = self.on_close, None
+        if callback:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"TLS close hook failed: {e}")
+        self.sock.close()
+    
+    def fileno(self):
+        return self.sock.fileno()
+    
+    def __getattr__(self, name):
+        # settimeout, setblocking, shutdown, getpeername... act on the raw socket
+        return getattr(self.sock, name)
+
+
+class TlsIdentity:
+    """Our certificate, the pins of other users, TLS contexts and saved sessions"""
+    
+    def __init__(self, directory, user_id):
+        self.user_id = user_id
+        self.cert_path = os.path.join(directory, 'tls_cert.pem')
+        self.key_path = os.path.join(directory, 'tls_key.pem')
+        self.pins_path = os.path.join(directory, 'tls_pins.json')
+        if not (os.path.exists(self.cert_path) and os.path.exists(self.key_path)):
+            generate_identity(self.cert_path, self.key_path, user_id)
+        self.pins = {}  # user_id: DER of their certificate, base64
+        self.lock = threading.Lock()
+        self.peer_contexts = {}  # user_id: server context that demands their pinned certificate
+        self.sessions = {}       # user_id: ssl.SSLSession to resume with
+        try:
+            with open(self.pins_path, 'r') as f:
+                self.pins = json.load(f)
+        except (OSError, ValueError):
+            pass
+        
+        self.client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        # Pins replace CA checks: the peer's certificate is compared after the handshake
+        self.client_context.check_hostname = False
+        self.client_context.verify_mode = ssl.CERT_NONE
+        self.client_context.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.client_context.load_cert_chain(self.cert_path, self.key_path)
+        self.server_context = self.make_server_context()
+    
+    def make_server_context(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(self.cert_path, self.key_path)
+        return context
+    
+    def peer_context(self, user_id):
+        with self.lock:
+            context = self.peer_contexts.get(user_id)
+            pin = self.pins.get(user_id)
+            if context is None and pin:
+                context = self.make_server_context()
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(cadata=base64.b64decode(pin))
+                self.peer_contexts[user_id] = context
+            return context
+    
+    def pinned(self, user_id):
+        return user_id in self.pins
+    
+    def check_pin(self, user_id, der):
+        """True if der is the user's pinned certificate, pins it if they have none"""
+        if not der:
+            return False
+        encoded = base64.b64encode(der).decode('ascii')
+        with self.lock:
+            pin = self.pins.get(user_id)
+            if pin is not None:
+                return pin == encoded
+            self.pins[user_id] = encoded
+            self.save_pins()
+        return True
+    
+    def forget_pin(self, user_id):
+        """Drop a pin, e.g. after the user reinstalled and has a new certificate"""
+        with self.lock:
+            self.pins.pop(user_id, None)
+            self.peer_contexts.pop(user_id, None)
+            self.sessions.pop(user_id, None)
+            self.save_pins()
+    
+    def save_pins(self):
+        try:
+            with open(self.pins_path + '.tmp', 'w') as f:
+                json.dump(self.pins, f)
+            os.replace(self.pins_path + '.tmp', self.pins_path)
+        except OSError as e:
+            print(f"Could not save certificate pins: {e}")
+    
+    def fingerprint_of(self, user_id):
+        pin = self.pins.get(user_id)
+        return fingerprint(base64.b64decode(pin)) if pin else None
+    
+    def dial(self, sock, user_id, timeout):
+        """TLS client side of a connection to user_id, resuming a saved session"""
+        tls_sock = TlsSocket(sock, self.client_context, False, self.user_id, self.sessions.get(user_id))
+        try:
+            tls_sock.handshake(timeout)
+        except ssl.SSLError:
+            # A stale session can't be resumed, the next dial starts over
+            self.sessions.pop(user_id, None)
+            raise
+        if not self.check_pin(user_id, tls_sock.peer_certificate()):
+            raise PinMismatch(f"Certificate of {user_id} does not match its pin")
+        tls_sock.peer_id = user_id
+        tls_sock.on_close = lambda s: self.save_session(user_id, s)
+        return tls_sock
+    
+    def accept(self, sock, timeout):
+        """TLS server side of an accepted connection"""
+        deadline = time.time() + timeout
+        received = b''
+        tls_sock = None
+        while tls_sock is None:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                raise socket.timeout("TLS handshake timed out")
+            data = sock.recv(RAW_READ)
+            if not data:
+                raise ConnectionError("Connection closed during the TLS handshake")
+            received += data
+            tls_sock = self.server_socket(sock, received)
+        tls_sock.handshake(max(deadline - time.time(), 0.1))
+        return tls_sock
+    
+    def server_socket(self, sock, received):
+        """TlsSocket for an accepted connection once received holds the whole ClientHello.
+        
+        Nothing is sent yet; handshake() or advance() take it from there.
+        """
+        complete, claimed = client_hello_name(received)
+        if not complete:
+            return None
+        context = (claimed and self.peer_context(claimed)) or self.server_context
+        tls_sock = TlsSocket(sock, context, True, received=received)
+        tls_sock.claimed_id = claimed
+        return tls_sock
+    
+    def verified_id(self, tls_sock):
+        """The user_id a listening-side connection proved, None if unverified"""
+        claimed = tls_sock.claimed_id
+        if claimed and self.pinned(claimed):
+            der = tls_sock.peer_certificate()
+            if der and base64.b64encode(der).decode('ascii') == self.pins.get(claimed):
+                return claimed
+        return None
+    
+    def save_session(self, user_id, tls_sock):
+        session = tls_sock.session
+        if session is not None:
+            self.sessions[user_id] = session
+
+
+def benchmark(megabytes=256, rounds=50):
+    """Loopback cost of TLS: bulk throughput against plaintext, full and resumed handshakes"""
+    directory = tempfile.mkdtemp()
+    for name in ('server', 'client'):
+        os.makedirs(os.path.join(directory, name))
+    server_identity = TlsIdentity(os.path.join(directory, 'server'), 'server')
+    client_identity = TlsIdentity(os.path.join(directory, 'client'), 'client')
+    listener = socket.create_server(('127.0.0.1', 0))
+    address = listener.getsockname()
+    
+    def serve():
+        # Read until the connection closes, answer every "." that ends a read
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            try:
+                if sniff(sock, 5):
+                    sock = server_identity.accept(sock, 5)
+                sock.settimeout(30)
+                while True:
+                    data = sock.recv(RAW_READ)
+                    if not data:
+                        break
+                    if data.endswith(b'.'):
+                        sock.sendall(b'.')
+            except OSError:
+                pass
+            finally:
+                sock.close()
+    
+    def connect(encrypted):
+        sock = socket.create_connection(address)
+        sock.settimeout(30)
+        return client_identity.dial(sock, 'server', 5) if encrypted else sock
+    
+    def throughput(encrypted):
+        sock = connect(encrypted)
+        chunk = bytes(1024 * 1024)
+        start = time.perf_counter()
+        for _ in range(megabytes):
+            sock.sendall(chunk)
+        sock.sendall(b'.')
+        sock.recv(1)
+        elapsed = time.perf_counter() - start
+        cipher = sock.tls.cipher()[0] if encrypted else None
+        sock.close()
+        return megabytes / elapsed, cipher
+    
+    def handshake_time(resume):
+        total = 0
+        reused = 0
+        for _ in range(rounds):
+            if not resume:
+                client_identity.sessions.pop('server', None)
+            start = time.perf_counter()
+            sock = connect(True)
+            sock.sendall(b'.')
+            sock.recv(1)  # also takes in the session ticket
+            total += time.perf_counter() - start
+            reused += sock.session_reused
+            sock.close()
+        return total / rounds * 1000, reused
+    
+    threading.Thread(target=serve, daemon=True).start()
+    try:
+        plain, _ = throughput(False)
+        encrypted, cipher = throughput(True)
+        full, _ = handshake_time(False)
+        handshake_time(True)  # have a ticket
+        resumed, reused = handshake_time(True)
+    finally:
+        listener.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    
+    print(f"Bulk, {megabytes}MB over loopback:")
+    print(f"  plaintext  {plain:8.0f} MB/s")
+    print(f"  TLS        {encrypted:8.0f} MB/s  {cipher}, {encrypted / plain:.0%} of plaintext")
+    print(f"Connect and one round trip, {rounds} connections:")
+    print(f"  full handshake     {full:6.2f} ms")
+    print(f"  resumed handshake  {resumed:6.2f} ms  ({reused}/{rounds} resumed)")
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 256)
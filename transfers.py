@@ -0,0 +1,167 @@
+import collections
+import threading
+import time
+
+ACTIVE_STATUSES = ('offered', 'pending', 'queued', 'uploading', 'downloading', 'paused')
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled', 'rejected')
+
+FIELDS = ('type', 'filename', 'size', 'progress', 'status', 'user_id', 'filepath', 'save_path',
+          'priority', 'bytes_done', 'cancelled', 'resume_event', 'seq', 'queue_position',
+          'started_at', 'finished_at', 'entries', 'shared_reader', 'channel', 'channel_opened_at',
+          'link_latency')
+
+
+class TransferRecord:
+    """One transfer, read and written like a dict.
+    
+    Slots keep long-lived records small. Status changes are reported to the
+    registry so it can keep its counts without scanning.
+    """
+    
+    __slots__ = ('registry', 'key', '_status') + tuple(f for f in FIELDS if f != 'status')
+    
+    def __init__(self, registry, key, fields):
+        self.registry = registry
+        self.key = key
+        self._status = None
+        self.progress = 0
+        self.bytes_done = 0
+        self.cancelled = False
+        status = fields.pop('status', None)
+        for name, value in fields.items():
+            self[name] = value
+        self.status = status
+    
+    @property
+    def status(self):
+        return self._status
+    
+    @status.setter
+    def status(self, value):
+        old, self._status = self._status, value
+        self.registry.status_changed(self, old, value)
+    
+    def __getitem__(self, name):
+        if name not in FIELDS:
+            raise KeyError(name)
+        return getattr(self, name, None)
+    
+    def __setitem__(self, name, value):
+        if name not in FIELDS:
+            raise KeyError(name)
+        setattr(self, name, value)
+    
+    def __contains__(self, name):
+        return name in FIELDS and getattr(self, name, None) is not None
+    
+    def get(self, name, default=None):
+        value = getattr(self, name, None) if name in FIELDS else None
+        return default if value is None else value
+
+
+class TransferRegistry:
+    """Transfers by key, with finished ones aged out.
+    
+    Outgoing transfers are keyed by an ID from new_id(), incoming ones by
+    (sender_id, sender's ID), so two senders can't collide. Finished records
+    are kept for `ttl` seconds and at most `max_finished` of them, the least
+    recently finished or touched going first; running ones are never evicted.
+    """
+    
+    def __init__(self, max_finished=200, ttl=3600):
+        self.max_finished = max_finished
+        self.ttl = ttl
+        self.records = {}
+        self.active = {}  # key: record, for transfers still running or waiting
+        self.finished = collections.OrderedDict()  # key: time, oldest first
+        self.active_counts = collections.Counter()  # type: active records
+        self.lock = threading.RLock()
+        # Milliseconds since the epoch, so IDs stay unique across restarts
+        self.next_id = int(time.time() * 1000)
+    
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+    
+    def add(self, key, fields):
+        """Create or replace the record for a key"""
+        with self.lock:
+            if key in self.records:
+                self.remove(key)
+            record = TransferRecord(self, key, dict(fields))
+            self.records[key] = record
+            self.evict()
+            return record
+    
+    def remove(self, key):
+        with self.lock:
+            record = self.records.pop(key)
+            if self.active.pop(key, None):
+                self.active_counts[record.type] -= 1
+            self.finished.pop(key, None)
+    
+    def status_changed(self, record, old, new):
+        with self.lock:
+            was_active = record.key in self.active
+            if new in ACTIVE_STATUSES and not was_active:
+                self.active[record.key] = record
+                self.active_counts[record.type] += 1
+            elif new not in ACTIVE_STATUSES and was_active:
+                del self.active[record.key]
+                self.active_counts[record.type] -= 1
+            
+            if new in FINISHED_STATUSES:
+                record.finished_at = time.time()
+                self.finished[record.key] = record.finished_at
+                self.finished.move_to_end(record.key)
+            else:
+                self.finished.pop(record.key, None)
+    
+    def touch(self, key):
+        """Keep a finished record around a while longer"""
+        with self.lock:
+            if key in self.finished:
+                self.finished[key] = time.time()
+                self.finished.move_to_end(key)
+    
+    def evict(self):
+        """Drop finished records past the TTL or over the limit"""
+        with self.lock:
+            now = time.time()
+            while self.finished:
+                key, finished_at = next(iter(self.finished.items()))
+                if len(self.finished) <= self.max_finished and now - finished_at <= self.ttl:
+                    break
+                del self.finished[key]
+                del self.records[key]
+    
+    def active_count(self, transfer_type):
+        return self.active_counts[transfer_type]
+    
+    def active_records(self):
+        with self.lock:
+            return list(self.active.values())
+    
+    def items(self):
+        with self.lock:
+            return list(self.records.items())
+    
+    def values(self):
+        with self.lock:
+            return list(self.records.values())
+    
+    def get(self, key, default=None):
+        return self.records.get(key, default)
+    
+    def __getitem__(self, key):
+        return self.records[key]
+    
+    def __delitem__(self, key):
+        self.remove(key)
+    
+    def __contains__(self, key):
+        return key in self.records
+    
+    def __len__(self):
+        return len(self.records)
@@ -0,0 +1,600 @@
+import json
+import select
+import socket
+import struct
+import threading
+import time
+import collections
+
+# Frame layout: magic, kind, flags, stream id, payload length.
+# Legacy peers send bare JSON objects, which always start with "{", so the
+# magic byte lets one receive path accept both.
+FRAME_MAGIC = 0xA5
+FRAME_HEADER = struct.Struct('!BBBII')
+
+KIND_MESSAGE = 0   # JSON control/chat message (stream 0)
+KIND_OPEN = 1      # open a logical stream, payload is JSON info
+KIND_DATA = 2      # stream data
+KIND_WINDOW = 3    # flow control credit, payload is a 4-byte increment
+KIND_CLOSE = 4     # sender is done writing to the stream
+KIND_RESET = 5     # abort the stream
+
+FLAG_OPENER = 0x01  # frame was sent by the side that opened the stream
+FLAG_COMPRESSED = 0x02  # message payload is deflated, see compression.py
+
+# Sender priority classes, lower goes first
+PRIORITY_CONTROL = 0  # handshakes, flow control, heartbeats
+PRIORITY_CHAT = 1     # interactive messages
+PRIORITY_BULK = 2     # file data
+PRIORITY_NAMES = {PRIORITY_CONTROL: 'control', PRIORITY_CHAT: 'chat', PRIORITY_BULK: 'bulk'}
+
+STREAM_WINDOW = 256 * 1024   # per-stream receive window
+MAX_FRAME_DATA = 16 * 1024   # bulk slice: a chat frame waits at most one of these
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+BULK_QUEUE_SLICES = 8        # bulk frames queued per peer before senders block
+NOTSENT_LOWAT = 64 * 1024    # keep the kernel's unsent backlog short
+
+
+def encode_frame(kind, stream_id=0, payload=b'', flags=0):
+    """Build one wire frame"""
+    return FRAME_HEADER.pack(FRAME_MAGIC, kind, flags, stream_id, len(payload)) + payload
+
+
+def encode_message(message):
+    """Frame a JSON message for a multiplexing peer"""
+    return encode_frame(KIND_MESSAGE, 0, json.dumps(message).encode('utf-8'))
+
+
+def frame_priority(kind):
+    """Default priority class for a frame kind"""
+    if kind in (KIND_DATA, KIND_CLOSE):
+        # A close must not overtake the stream's queued data
+        return PRIORITY_BULK
+    if kind == KIND_MESSAGE:
+        return PRIORITY_CHAT
+    return PRIORITY_CONTROL
+
+
+def send_all(sock, data, timeout=30):
+    """sendall() that also works on non-blocking sockets"""
+    view = memoryview(data)
+    deadline = time.time() + timeout
+    while view:
+        try:
+            sent = sock.send(view)
+            view = view[sent:]
+        except (BlockingIOError, InterruptedError):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("send timed out")
+            select.select([], [sock], [], remaining)
+
+
+def recv_exact(sock, size):
+    """Read exactly size bytes or fail"""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+class FrameDecoder:
+    """Split a byte stream into bare JSON messages and frames"""
+    
+    def __init__(self):
+        self.buffer = bytearray()
+        self.json_decoder = json.JSONDecoder()
+    
+    def feed(self, data):
+        """Add received bytes, return the complete items.
+        
+        Items are ('json', message) or ('frame', kind, flags, stream_id, payload).
+        """
+        self.buffer.extend(data)
+        items = []
+        while self.buffer:
+            if self.buffer[0] == FRAME_MAGIC:
+                if len(self.buffer) < FRAME_HEADER.size:
+                    break
+                _, kind, flags, stream_id, length = FRAME_HEADER.unpack_from(self.buffer)
+                if length > MAX_FRAME_SIZE:
+                    raise ValueError("Frame too large")
+                end = FRAME_HEADER.size + length
+                if len(self.buffer) < end:
+                    break
+                payload = bytes(self.buffer[FRAME_HEADER.size:end])
+                del self.buffer[:end]
+                items.append(('frame', kind, flags, stream_id, payload))
+            elif self.buffer[0] in b' \t\r\n':
+                del self.buffer[0]
+            else:
+                message, used = self.decode_json()
+                if message is None:
+                    break
+                del self.buffer[:used]
+                items.append(('json', message))
+        return items
+    
+    def decode_json(self):
+        """Decode one bare JSON object from the front of the buffer"""
+        try:
+            text = self.buffer.decode('utf-8')
+        except UnicodeDecodeError as e:
+            # Multi-byte character split across reads
+            text = self.buffer[:e.start].decode('utf-8')
+        try:
+            message, end = self.json_decoder.raw_decode(text)
+        except json.JSONDecodeError:
+            if len(self.buffer) > MAX_FRAME_SIZE:
+                raise ValueError("Undecodable data from peer")
+            return None, 0
+        return message, len(text[:end].encode('utf-8'))
+
+
+class PeerWriter:
+    """Sender thread for one connection, draining frames by priority class.
+    
+    Control frames go before chat, chat before bulk. Bulk producers block
+    once BULK_QUEUE_SLICES frames are waiting, so a chat message never sits
+    behind more than a few slices of file data.
+    """
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.queues = [collections.deque() for _ in PRIORITY_NAMES]
+        self.cond = threading.Condition()
+        self.closed = False
+        self.error = None
+        self.stats = {p: {'frames': 0, 'total_delay': 0.0, 'max_delay': 0.0} for p in PRIORITY_NAMES}
+        
+        # Bytes buffered in the kernel count as queueing delay too
+        if hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, NOTSENT_LOWAT)
+            except OSError:
+                pass
+        
+        threading.Thread(target=self.run, daemon=True).start()
+    
+    def write(self, data, priority=PRIORITY_CHAT):
+        """Queue bytes for sending"""
+        with self.cond:
+            if priority == PRIORITY_BULK:
+                while (len(self.queues[PRIORITY_BULK]) >= BULK_QUEUE_SLICES
+                       and not self.error and not self.closed):
+                    self.cond.wait()
+            if self.error:
+                raise self.error
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            self.queues[priority].append((data, time.time()))
+            self.cond.notify_all()
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.closed and not any(self.queues):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                priority = next(p for p, queue in enumerate(self.queues) if queue)
+                data, queued_at = self.queues[priority].popleft()
+                self.cond.notify_all()
+            try:
+                send_all(self.sock, data)
+            except Exception as e:
+                with self.cond:
+                    self.error = ConnectionError(f"Send failed: {e}")
+                    self.cond.notify_all()
+                # Let the reader notice and tear the connection down
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+            delay = time.time() - queued_at
+            stats = self.stats[priority]
+            stats['frames'] += 1
+            stats['total_delay'] += delay
+            stats['max_delay'] = max(stats['max_delay'], delay)
+    
+    def latency_stats(self):
+        """Average and worst queue-to-wire delay per priority class, in ms"""
+        result = {}
+        for priority, stats in self.stats.items():
+            if stats['frames']:
+                result[PRIORITY_NAMES[priority]] = {
+                    'frames': stats['frames'],
+                    'avg_ms': stats['total_delay'] / stats['frames'] * 1000,
+                    'max_ms': stats['max_delay'] * 1000
+                }
+        return result
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for queue in self.queues:
+                queue.clear()
+            self.cond.notify_all()
+
+
+class MuxStream:
+    """One logical stream inside a MuxSession, usable like a socket"""
+    
+    def __init__(self, session, stream_id, local_opener, info=None):
+        self.session = session
+        self.stream_id = stream_id
+        self.local_opener = local_opener
+        self.info = info or {}
+        self.cond = threading.Condition()
+        self.send_window = STREAM_WINDOW
+        self.recv_buffer = collections.deque()
+        self.recv_buffered = 0
+        self.recv_consumed = 0
+        self.remote_closed = False
+        self.local_closed = False
+        self.error = None
+        self.timeout = None
+    
+    @property
+    def flags(self):
+        return FLAG_OPENER if self.local_opener else 0
+    
+    def settimeout(self, timeout):
+        self.timeout = timeout
+    
+    def wait(self, predicate):
+        """Wait on the stream condition honouring the timeout"""
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while not predicate():
+            if self.error:
+                raise self.error
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout("stream timed out")
+            self.cond.wait(remaining)
+    
+    def sendall(self, data):
+        """Send data, blocking while the peer's window is exhausted"""
+        view = memoryview(data)
+        while view:
+            with self.cond:
+                self.wait(lambda: self.send_window > 0 or self.error)
+                if self.error:
+                    raise self.error
+                size = min(len(view), self.send_window, MAX_FRAME_DATA)
+                self.send_window -= size
+            self.session.send_frame(KIND_DATA, self.stream_id, bytes(view[:size]), self.flags)
+            view = view[size:]
+    
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+    
+    def recv(self, size):
+        """Receive up to size bytes, b'' once the peer closed the stream"""
+        chunk = b''
+        credit = 0
+        with self.cond:
+            self.wait(lambda: self.recv_buffer or self.remote_closed or self.error)
+            if self.recv_buffer:
+                chunk = self.recv_buffer.popleft()
+                if len(chunk) > size:
+                    self.recv_buffer.appendleft(chunk[size:])
+                    chunk = chunk[:size]
+                self.recv_buffered -= len(chunk)
+                self.recv_consumed += len(chunk)
+                if self.recv_consumed >= STREAM_WINDOW // 2:
+                    credit, self.recv_consumed = self.recv_consumed, 0
+            elif self.error:
+                raise self.error
+        if not chunk:
+            self.session.forget_if_done(self)
+        elif credit and not self.remote_closed:
+            self.session.send_frame(KIND_WINDOW, self.stream_id, struct.pack('!I', credit), self.flags)
+        return chunk
+    
+    def close(self):
+        """Half-close: tell the peer we won't send any more"""
+        with self.cond:
+            if self.local_closed or self.error:
+                return
+            self.local_closed = True
+        try:
+            self.session.send_frame(KIND_CLOSE, self.stream_id, b'', self.flags)
+        except Exception:
+            pass
+        self.session.forget_if_done(self)
+    
+    def reset(self, reason="Stream reset"):
+        """Abort the stream on both ends"""
+        if not self.error:
+            try:
+                self.session.send_frame(KIND_RESET, self.stream_id, b'', self.flags)
+            except Exception:
+                pass
+        self.fail(ConnectionResetError(reason))
+    
+    def fail(self, error):
+        with self.cond:
+            if not self.error:
+                self.error = error
+            self.cond.notify_all()
+        self.session.forget(self)
+    
+    def on_frame(self, kind, payload):
+        """Handle a frame addressed to this stream"""
+        with self.cond:
+            if kind == KIND_DATA:
+                if self.recv_buffered + len(payload) > STREAM_WINDOW:
+                    raise ValueError("Peer overran the stream window")
+                self.recv_buffer.append(payload)
+                self.recv_buffered += len(payload)
+            elif kind == KIND_WINDOW:
+                self.send_window += struct.unpack('!I', payload)[0]
+            elif kind == KIND_CLOSE:
+                self.remote_closed = True
+            self.cond.notify_all()
+        if kind == KIND_RESET:
+            self.fail(ConnectionResetError("Stream reset by peer"))
+        elif kind == KIND_CLOSE:
+            self.session.forget_if_done(self)
+
+
+class MuxSession:
+    """Numbered logical streams carried over one peer connection"""
+    
+    def __init__(self, writer, on_stream=None):
+        self.writer = writer
+        self.on_stream = on_stream
+        self.streams = {}  # (local_opener, stream_id): MuxStream
+        self.lock = threading.Lock()
+        self.next_stream_id = 1
+    
+    def send_frame(self, kind, stream_id=0, payload=b'', flags=0, priority=None):
+        if priority is None:
+            priority = frame_priority(kind)
+        self.writer.write(encode_frame(kind, stream_id, payload, flags), priority)
+    
+    def send_message(self, message, priority=PRIORITY_CHAT):
+        """Send a JSON message on the control stream"""
+        self.send_frame(KIND_MESSAGE, 0, json.dumps(message).encode('utf-8'), 0, priority)
+    
+    def open_stream(self, info=None):
+        """Open a new outgoing stream"""
+        with self.lock:
+            stream_id = self.next_stream_id
+            self.next_stream_id += 1
+            stream = MuxStream(self, stream_id, True, info)
+            self.streams[(True, stream_id)] = stream
+        self.send_frame(KIND_OPEN, stream_id, json.dumps(info or {}).encode('utf-8'), FLAG_OPENER)
+        return stream
+    
+    def handle_frame(self, kind, flags, stream_id, payload):
+        """Route an incoming stream frame"""
+        key = (not flags & FLAG_OPENER, stream_id)
+        if kind == KIND_OPEN:
+            stream = MuxStream(self, stream_id, False, json.loads(payload.decode('utf-8')))
+            with self.lock:
+                self.streams[key] = stream
+            if self.on_stream:
+                self.on_stream(stream)
+            return
+        with self.lock:
+            stream = self.streams.get(key)
+        if stream is None:
+            return
+        try:
+            stream.on_frame(kind, payload)
+        except ValueError as e:
+            stream.reset(str(e))
+    
+    def forget(self, stream):
+        with self.lock:
+            self.streams.pop((stream.local_opener, stream.stream_id), None)
+    
+    def forget_if_done(self, stream):
+        if stream.local_closed and stream.remote_closed and not stream.recv_buffer:
+            self.forget(stream)
+    
+    def close(self):
+        """Fail every open stream, the connection is gone"""
+        with self.lock:
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams:
+            stream.fail(ConnectionResetError("Connection lost"))
+
+
+class FairShare:
+    """Deficit round-robin between concurrent senders.
+    
+    Every active flow gets a quantum of bytes per round; a new round starts
+    once all flows have spent their share, or after round_timeout if some
+    flow is busy elsewhere, so one stalled transfer can't hold the others.
+    A request larger than a full deficit goes through once the deficit is
+    full and leaves the flow in debt for the following rounds.
+    """
+    
+    def __init__(self, quantum=256 * 1024, round_timeout=0.02):
+        self.quantum = quantum
+        self.round_timeout = round_timeout
+        self.cond = threading.Condition()
+        self.deficits = {}  # flow: bytes it may still send this round
+        self.waiting = set()
+    
+    def join(self, flow):
+        with self.cond:
+            self.deficits[flow] = self.quantum
+    
+    def leave(self, flow):
+        with self.cond:
+            self.deficits.pop(flow, None)
+            self.waiting.discard(flow)
+            self.cond.notify_all()
+    
+    def acquire(self, flow, nbytes):
+        """Block until flow may send nbytes"""
+        with self.cond:
+            while flow in self.deficits:
+                if self.deficits[flow] >= min(nbytes, 2 * self.quantum):
+                    self.deficits[flow] -= nbytes
+                    return
+                self.waiting.add(flow)
+                if self.waiting >= set(self.deficits):
+                    self.new_round()
+                elif not self.cond.wait(self.round_timeout) and flow in self.waiting:
+                    self.new_round()
+    
+    def new_round(self):
+        for flow in self.deficits:
+            # Cap carry-over so a flow that sat out can't burst afterwards
+            self.deficits[flow] = min(self.deficits[flow] + self.quantum, 2 * self.quantum)
+        self.waiting.clear()
+        self.cond.notify_all()
+
+
+class TokenBucket:
+    """Byte rate limiter, a rate of 0 means unlimited.
+    
+    A consumer may take a whole chunk as long as the bucket isn't in debt;
+    the debt is then paid back at the configured rate, so the long-run rate
+    holds regardless of chunk size. Waiting is done on a condition, and
+    set_rate() wakes waiters so limits can change mid-transfer.
+    """
+    
+    def __init__(self, rate=0, burst=None):
+        self.cond = threading.Condition()
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate, burst)
+    
+    def set_rate(self, rate, burst=None):
+        """Change the rate in bytes per second"""
+        with self.cond:
+            self.refill()
+            self.rate = rate
+            self.burst = burst or max(rate / 20, 16 * 1024)
+            self.tokens = min(self.tokens, self.burst)
+            self.cond.notify_all()
+    
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def consume(self, nbytes):
+        """Block until nbytes may pass"""
+        with self.cond:
+            while self.rate:
+                self.refill()
+                if self.tokens >= 0:
+                    self.tokens -= nbytes
+                    return
+                self.cond.wait(-self.tokens / self.rate)
+
+
+class SharedFileReader:
+    """Reads a file once on behalf of several consumers.
+    
+    Each block stays in memory until every attached consumer has taken it.
+    A consumer that falls `window` blocks behind the reader is detached and
+    carries on from its own file handle, so a slow receiver costs extra disk
+    reads instead of holding back the others.
+    """
+    
+    def __init__(self, path, block_size=64 * 1024, window=64):
+        self.path = path
+        self.block_size = block_size
+        self.window = window
+        self.file = open(path, 'rb')
+        self.cond = threading.Condition()
+        self.blocks = {}     # block index: data
+        self.cursors = {}    # attached consumer: next block index
+        self.private = {}    # detached consumer: own file object
+        self.low = 0         # oldest block still buffered
+        self.next_block = 0  # next block to read from disk
+        self.eof = False
+        self.reading = False
+        self.disk_bytes = 0  # shared and private reads together
+    
+    def attach(self, consumer):
+        with self.cond:
+            self.cursors[consumer] = 0
+    
+    def read(self, consumer):
+        """Next block for a consumer, b'' at end of file"""
+        with self.cond:
+            while consumer in self.cursors:
+                index = self.cursors[consumer]
+                if index in self.blocks:
+                    self.cursors[consumer] = index + 1
+                    data = self.blocks[index]
+                    self.trim()
+                    return data
+                if self.eof:
+                    return b''
+                if self.reading:
+                    self.cond.wait()
+                    continue
+                
+                # This consumer is at the front, it reads for everyone
+                self.detach_stragglers()
+                self.reading = True
+                self.cond.release()
+                try:
+                    data = self.file.read(self.block_size)
+                finally:
+                    self.cond.acquire()
+                    self.reading = False
+                    self.cond.notify_all()
+                self.disk_bytes += len(data)
+                if data:
+                    self.blocks[self.next_block] = data
+                    self.next_block += 1
+                else:
+                    self.eof = True
+            f = self.private[consumer]
+        
+        data = f.read(self.block_size)
+        with self.cond:
+            self.disk_bytes += len(data)
+        return data
+    
+    def detach_stragglers(self):
+        for consumer, index in list(self.cursors.items()):
+            if self.next_block - index >= self.window:
+                f = open(self.path, 'rb')
+                f.seek(index * self.block_size)
+                self.private[consumer] = f
+                del self.cursors[consumer]
+        self.trim()
+    
+    def trim(self):
+        low = min(self.cursors.values(), default=self.next_block)
+        while self.low < low:
+            self.blocks.pop(self.low, None)
+            self.low += 1
+    
+    def release(self, consumer):
+        """Drop a finished or failed consumer"""
+        with self.cond:
+            self.cursors.pop(consumer, None)
+            f = self.private.pop(consumer, None)
+            if f:
+                f.close()
+            self.trim()
+            self.cond.notify_all()
+        self.close_if_idle()
+    
+    def close_if_idle(self):
+        with self.cond:
+            if not self.cursors and not self.private and not self.file.closed:
+                self.file.close()
+                self.blocks.clear()